@@ -0,0 +1,240 @@
+"""
+Benchmark link setup and teardown of the CLI backends against fake devices.
+
+For each backend a fake device (opennsa.backends.common.fakedevice) is started
+on localhost, and the command sender of the backend is used to set up and tear
+down a number of links, first one at a time (latency), then all at once
+(throughput).
+
+Usage:
+
+    python benchmarks/cli_backends.py [-n links] [--command-latency s] [--commit-latency s] [backend ...]
+
+Backends: junosmx juniperex force10 brocade ciena (default all)
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+from twisted.python import log
+from twisted.internet import defer, task
+
+from opennsa.backends.common import ssh, fakedevice
+from opennsa.backends import junosmx, juniperex, force10, brocade, ciena
+
+
+USER            = 'opennsa'
+PASSWORD        = 'opennsa'
+ENABLE_PASSWORD = 'enable'
+FIRST_VLAN      = 1000
+
+
+
+def writeClientKeys(directory):
+    key = fakedevice.generateKey()
+    public_key_path  = os.path.join(directory, 'id_rsa.pub')
+    private_key_path = os.path.join(directory, 'id_rsa')
+    with open(public_key_path, 'wb') as f:
+        f.write(key.public().toString('openssh'))
+    with open(private_key_path, 'wb') as f:
+        f.write(key.toString('openssh'))
+    return public_key_path, private_key_path
+
+
+# Each benchmark returns (sender, setup(i), teardown(i)) for a sender to the
+# given fake device. setup and teardown return a deferred.
+
+def junosMXBenchmark(host, port, fingerprint, keys):
+    sender = junosmx.JUNOSCommandSender(host, port, fingerprint, USER, keys[0], keys[1], {}, 'bench')
+
+    def commands(i):
+        vlan = FIRST_VLAN + i
+        ports = [ { 'port' : 'xe-0/0/%i' % p, 'vlan' : vlan } for p in (0, 1) ]
+        cmds = []
+        for p in ports:
+            cmds += [ junosmx.COMMAND_SET_INTERFACES_VLAN % p, junosmx.COMMAND_SET_VLAN_ENCAP % p, junosmx.COMMAND_SET_VLAN_ID % p ]
+        for p in ports:
+            cmds.append(junosmx.COMMAND_LOCAL_CONNECTIONS % { 'switch' : 'bench-%i' % i, 'interface' : p['port'], 'subinterface' : vlan })
+        return cmds
+
+    def setup(i):
+        return sender._sendCommands(commands(i))
+
+    def teardown(i):
+        vlan = FIRST_VLAN + i
+        cmds = [ junosmx.COMMAND_DELETE_INTERFACES_VL % { 'port' : 'xe-0/0/%i' % p, 'vlan' : vlan } for p in (0, 1) ]
+        cmds.append(junosmx.COMMAND_DELETE_CONNECTIONS % { 'switch' : 'bench-%i' % i })
+        return sender._sendCommands(cmds)
+
+    return sender, setup, teardown
+
+
+def juniperEXBenchmark(host, port, fingerprint, keys):
+    sender = juniperex.JuniperEXCommandSender(host, port, fingerprint, USER, keys[0], keys[1])
+
+    def setup(i):
+        return sender.setupLink('ge-0/0/0', 'ge-0/0/1', FIRST_VLAN + i)
+
+    def teardown(i):
+        return sender.teardownLink('ge-0/0/0', 'ge-0/0/1', FIRST_VLAN + i)
+
+    return sender, setup, teardown
+
+
+def force10Benchmark(host, port, fingerprint, keys):
+    creator = ssh.SSHConnectionCreator(host, port, [ fingerprint ], USER, password=PASSWORD)
+    sender = force10.Force10CommandSender(creator, ENABLE_PASSWORD)
+
+    def setup(i):
+        return sender.sendCommands(force10._createSetupCommands('te 0/0.%i' % (FIRST_VLAN + i), 'te 0/1.%i' % (FIRST_VLAN + i)))
+
+    def teardown(i):
+        return sender.sendCommands(force10._createTeardownCommands('te 0/0.%i' % (FIRST_VLAN + i), 'te 0/1.%i' % (FIRST_VLAN + i)))
+
+    return sender, setup, teardown
+
+
+def brocadeBenchmark(host, port, fingerprint, keys):
+    sender = brocade.BrocadeCommandSender(host, port, fingerprint, USER, keys[0], keys[1], ENABLE_PASSWORD)
+
+    def setup(i):
+        return sender.sendCommands(brocade._createSetupCommands('1/1.%i' % (FIRST_VLAN + i), '1/2.%i' % (FIRST_VLAN + i)))
+
+    def teardown(i):
+        return sender.sendCommands(brocade._createTeardownCommands('1/1.%i' % (FIRST_VLAN + i), '1/2.%i' % (FIRST_VLAN + i)))
+
+    return sender, setup, teardown
+
+
+def cienaBenchmark(host, port, fingerprint, keys):
+    sender = ciena.CienaCommandSender(host, port, fingerprint, USER, PASSWORD, 'bench')
+
+    def connectionId(i):
+        return 'Ciena-%06i' % i
+
+    def setup(i):
+        ctag = connectionId(i)[-6:]
+        ports = ( '1-A-%i-1' % (i % 8 + 1), '1-A-%i-2' % (i % 8 + 1) )
+        cmds = []
+        for p in ports:
+            cmds.append(ciena.COMMAND_CRT_PTP_ETH10GFLEX % { 'port' : p, 'CTAG' : ctag })
+            cmds.append(ciena.COMMAND_CONFIGURE_NUMSLOTS % { 'port' : p, 'CTAG' : ctag, 'numslots' : 1 })
+        cmds.append(ciena.COMMAND_CRT_CRSCNT_ODUCTP % { 'sport' : ports[0], 'sportFacilityID' : 1, 'dport' : ports[1], 'dportFacilityID' : 1, 'CTAG' : ctag, 'dir' : '2WAY' })
+        return sender._sendCommands(cmds, connectionId(i))
+
+    def teardown(i):
+        ctag = connectionId(i)[-6:]
+        ports = ( '1-A-%i-1' % (i % 8 + 1), '1-A-%i-2' % (i % 8 + 1) )
+        cmds = [ ciena.COMMAND_DLT_CRSCNT_ODUCTP % { 'sport' : ports[0], 'sportFacilityID' : 1, 'dport' : ports[1], 'dportFacilityID' : 1, 'CTAG' : ctag, 'dir' : '2WAY' } ]
+        for p in ports:
+            cmds.append(ciena.COMMAND_PTP_OOS % { 'port' : p, 'CTAG' : ctag })
+            cmds.append(ciena.COMMAND_PTP_DLT % { 'port' : p, 'CTAG' : ctag })
+        return sender._sendCommands(cmds, connectionId(i))
+
+    return sender, setup, teardown
+
+
+BENCHMARKS = {
+    'junosmx'   : (fakedevice.JunosDialect,     junosMXBenchmark),
+    'juniperex' : (fakedevice.JunosDialect,     juniperEXBenchmark),
+    'force10'   : (fakedevice.Force10Dialect,   force10Benchmark),
+    'brocade'   : (fakedevice.BrocadeDialect,   brocadeBenchmark),
+    'ciena'     : (fakedevice.CienaTL1Dialect,  cienaBenchmark)
+}
+
+
+
+def summary(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    mean = sum(latencies) / n
+    median = latencies[n // 2]
+    p95 = latencies[min(n - 1, int(n * 0.95))]
+    return '%-24s %5i %8.1f %8.1f %8.1f %8.1f %8.1f' % \
+        (name, n, mean * 1000, median * 1000, p95 * 1000, latencies[-1] * 1000, n / elapsed)
+
+
+@defer.inlineCallbacks
+def timed(operation, i, latencies):
+    start = time.time()
+    yield operation(i)
+    latencies.append(time.time() - start)
+
+
+@defer.inlineCallbacks
+def runBenchmark(name, options, keys):
+
+    dialect, benchmark = BENCHMARKS[name]
+
+    device = fakedevice.FakeDevice(dialect, password=PASSWORD, enable_password=ENABLE_PASSWORD,
+                                   command_latency=options.command_latency, commit_latency=options.commit_latency)
+    server = fakedevice.FakeDeviceServer(device)
+    listening_port = server.listen()
+
+    try:
+        sender, setup, teardown = benchmark('127.0.0.1', listening_port.getHost().port, server.fingerprint, keys)
+
+        results = []
+        for phase, operation in ( ('setup', setup), ('teardown', teardown) ):
+            latencies = []
+            start = time.time()
+            for i in range(options.links):
+                yield timed(operation, i, latencies)
+            results.append(summary('%s %s serial' % (name, phase), latencies, time.time() - start))
+
+        for phase, operation in ( ('setup', setup), ('teardown', teardown) ):
+            latencies = []
+            start = time.time()
+            yield defer.gatherResults( [ timed(operation, i, latencies) for i in range(options.links) ], consumeErrors=True)
+            results.append(summary('%s %s parallel' % (name, phase), latencies, time.time() - start))
+
+        if hasattr(sender, 'shutdown'):
+            sender.shutdown()
+
+        results.append('%-24s sessions %i, commits %i' % (name, device.sessions, device.commits))
+        defer.returnValue(results)
+
+    finally:
+        yield server.stopListening()
+
+
+@defer.inlineCallbacks
+def main(reactor, options):
+
+    directory = tempfile.mkdtemp(prefix='opennsa-bench-')
+    try:
+        keys = writeClientKeys(directory)
+
+        print('%-24s %5s %8s %8s %8s %8s %8s' % ('benchmark', 'n', 'mean ms', 'p50 ms', 'p95 ms', 'max ms', 'ops/s'))
+        for name in options.backends or sorted(BENCHMARKS):
+            results = yield runBenchmark(name, options, keys)
+            for line in results:
+                print(line)
+    finally:
+        shutil.rmtree(directory)
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark CLI backends against fake devices.')
+    parser.add_argument('-n', '--links', type=int, default=20, help='Number of links to set up and tear down')
+    parser.add_argument('--command-latency', type=float, default=0.0, help='Seconds per command on the fake device')
+    parser.add_argument('--commit-latency', type=float, default=0.0, help='Seconds per commit on the fake device')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log to stdout')
+    parser.add_argument('backends', nargs='*', help='Backends to benchmark: %s' % ' '.join(sorted(BENCHMARKS)))
+    options = parser.parse_args()
+
+    for name in options.backends:
+        if name not in BENCHMARKS:
+            parser.error('Unknown backend: %s' % name)
+
+    if options.verbose:
+        log.startLogging(sys.stdout)
+
+    task.react(main, [ options ])
+
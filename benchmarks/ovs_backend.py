@@ -0,0 +1,110 @@
+"""
+Benchmark link setup and teardown of the OVS backend against a fake switch.
+
+A fake switch (opennsa.backends.common.fakeovs) is started on localhost, and
+the command sender of the OVS backend sets up and tears down a number of
+links between two ports, first one at a time (latency), then all at once
+(throughput), and checks the flow table of the switch afterwards. Every
+other link rewrites the VLAN.
+
+Usage:
+
+    python benchmarks/ovs_backend.py [-n links] [--batch-window s] [--transact-latency s] [--cfg-latency s] [--commit-latency s]
+"""
+
+import sys
+import time
+import argparse
+
+from twisted.python import log
+from twisted.internet import defer, task
+
+from opennsa.backends.common import fakeovs
+from opennsa.backends import ovs
+
+
+PORTS      = [ 'eth1', 'eth2' ]
+FIRST_VLAN = 1000
+
+
+
+def summary(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    mean = sum(latencies) / n
+    median = latencies[n // 2]
+    p95 = latencies[min(n - 1, int(n * 0.95))]
+    return '%-24s %5i %8.1f %8.1f %8.1f %8.1f %8.1f' % \
+        (name, n, mean * 1000, median * 1000, p95 * 1000, latencies[-1] * 1000, n / elapsed)
+
+
+@defer.inlineCallbacks
+def timed(operation, i, latencies):
+    start = time.time()
+    yield operation(i)
+    latencies.append(time.time() - start)
+
+
+def targets(i):
+    source_vlan = FIRST_VLAN + i
+    dest_vlan   = source_vlan if i % 2 == 0 else source_vlan + 1000
+    return ovs.OVSTarget(PORTS[0], source_vlan), ovs.OVSTarget(PORTS[1], dest_vlan)
+
+
+@defer.inlineCallbacks
+def main(reactor, options):
+
+    switch = fakeovs.FakeSwitch(PORTS, transact_latency=options.transact_latency, cfg_latency=options.cfg_latency,
+                                commit_latency=options.commit_latency)
+    server = fakeovs.FakeOVSServer(switch)
+    ovsdb_port, openflow_port = server.listen()
+
+    sender = ovs.OVSCommandSender('127.0.0.1', ovsdb_port, openflow_port, options.batch_window)
+    try:
+        yield sender.warmUp()
+
+        def setup(i):
+            return sender.setupLink(*targets(i))
+
+        def teardown(i):
+            return sender.teardownLink(*targets(i))
+
+        print('%-24s %5s %8s %8s %8s %8s %8s' % ('benchmark', 'n', 'mean ms', 'p50 ms', 'p95 ms', 'max ms', 'ops/s'))
+
+        for mode in ('serial', 'parallel'):
+            for phase, operation in ( ('setup', setup), ('teardown', teardown) ):
+                latencies = []
+                start = time.time()
+                if mode == 'serial':
+                    for i in range(options.links):
+                        yield timed(operation, i, latencies)
+                else:
+                    yield defer.gatherResults( [ timed(operation, i, latencies) for i in range(options.links) ], consumeErrors=True)
+                print(summary('ovs %s %s' % (phase, mode), latencies, time.time() - start))
+
+                expected = 2 * options.links if phase == 'setup' else 0
+                assert len(switch.flows) == expected, 'Expected %i flows after %s, switch has %i' % (expected, phase, len(switch.flows))
+
+        print('%-24s transactions %i, bundles %i, flow mods %i' % ('ovs', switch.transactions, switch.bundles, switch.flow_mods))
+
+    finally:
+        sender.shutdown()
+        yield server.stopListening()
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the OVS backend against a fake switch.')
+    parser.add_argument('-n', '--links', type=int, default=100, help='Number of links to set up and tear down')
+    parser.add_argument('--batch-window', type=float, default=ovs.DEFAULT_BATCH_WINDOW, help='Seconds to collect link changes into a batch')
+    parser.add_argument('--transact-latency', type=float, default=0.0, help='Seconds per OVSDB transaction on the fake switch')
+    parser.add_argument('--cfg-latency', type=float, default=0.0, help='Seconds for the fake switch to apply a configuration')
+    parser.add_argument('--commit-latency', type=float, default=0.0, help='Seconds per bundle commit on the fake switch')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log to stdout')
+    options = parser.parse_args()
+
+    if options.verbose:
+        log.startLogging(sys.stdout)
+
+    task.react(main, [ options ])
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of payload building for the REST backends.
+
+Compares building the NCS VPN and CSD payloads with the precompiled templates
+(opennsa.backends.common.templates) to %-formatting the same template strings
+and encoding the result, as the backends did before. Note that the
+%-formatting does not escape the values, the templates do.
+
+Usage:
+
+    python benchmarks/payload_templates.py [-n iterations]
+"""
+
+import timeit
+import argparse
+
+from opennsa.backends.common import templates
+from opennsa.backends import ncsvpn, junoscsd
+
+
+NCS_VPN_TEMPLATE = ncsvpn.BOD_PAYLOAD_START + """    <vlan>%(vlan)i</vlan>
+""" + ncsvpn.BOD_PAYLOAD_END
+
+NCS_VPN_VALUES = {
+    'service_id'    : 'ON-123456',
+    'service_name'  : 'ON-123456',
+    'router_a'      : 'router-a',
+    'interface_a'   : 'ge-1/0/1',
+    'router_b'      : 'router-b',
+    'interface_b'   : 'ge-1/0/2',
+    'vlan'          : 1720
+}
+
+CSD_ORDER_VALUES = {
+    'service_name'      : 'ON-123456',
+    'description'       : 'OpenNSA router-a.router-b.1500000000 OpenNSA build',
+    'router_a_name'     : 'router-a',
+    'router_a_id'       : '131074',
+    'interface_a'       : 'ge-1/0/1',
+    'router_b_name'     : 'router-b',
+    'router_b_id'       : '131075',
+    'interface_b'       : 'ge-1/0/2',
+    'cus_key'           : '98305',
+    'service_def_id'    : '1245184',
+    'vlan_a'            : 1720,
+    'vlan_b'            : 1720
+}
+
+
+def run(name, template, values, iterations):
+    compiled = templates.XMLTemplate(template)
+    assert compiled.render(values) == (template % values).encode('utf-8'), 'Template output differs for %s' % name
+
+    formatted = timeit.timeit(lambda: (template % values).encode('utf-8'), number=iterations)
+    rendered  = timeit.timeit(lambda: compiled.render(values), number=iterations)
+    compiling = timeit.timeit(lambda: templates.XMLTemplate(template), number=iterations)
+
+    for method, elapsed in ( ('%-format + encode', formatted), ('XMLTemplate.render', rendered), ('XMLTemplate compile', compiling) ):
+        print('%-12s %-20s %8.2f us' % (name, method, elapsed / iterations * 1e6))
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark payload templates of the REST backends.')
+    parser.add_argument('-n', '--iterations', type=int, default=100000, help='Payloads to build per method')
+    options = parser.parse_args()
+
+    run('ncsvpn', NCS_VPN_TEMPLATE, NCS_VPN_VALUES, options.iterations)
+    run('junoscsd', junoscsd.ORDER_PAYLOAD_BASE, CSD_ORDER_VALUES, options.iterations)
+
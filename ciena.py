@@ -1,13 +1,19 @@
 """
 OpenNSA backend for Ciena OTN-capable switches.
+
+Commands are sent as TL1 over one logged-in SSH session per node. Each command
+gets a unique CTAG, and responses are matched to commands on it, so the
+commands of several link operations can be in flight at once.
 """
 
+import math
+import codecs
 import random
 
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
-from opennsa import config
+from opennsa import config, error
 from opennsa import constants as cnt
 from opennsa.backends.common import genericbackend, ssh
 
@@ -24,7 +30,9 @@ COMMAND_ATTACH_SUBPORT          = 'virtual-switch interface attach sub-port %(na
 
 # parameterized commands for TL1 (OTN)
 MAX_TIMESLOT = 80
+TIMESLOT_BANDWIDTH = 1000 # Mbps, 1 slot = 1 Gbps ethernet
 COMMAND_LOGIN = 'ACT-USER::%(user)s:%(CTAG)s::%(pass)s'
+COMMAND_LOGOUT = 'CANC-USER::%(user)s:%(CTAG)s'
 
 COMMAND_CRT_PTP_ETH10GFLEX = 'ENT-PTP::PTP-%(port)s:%(CTAG)s:::CONDTYPE=NONE,SERVICETYPE=ETH10GFLEX:IS,AINS' # Configure client port as 10G subrated port
 COMMAND_CONFIGURE_NUMSLOTS = 'ED-ODUCTP::ODUCTP-%(port)s-FP1:%(CTAG)s:::NUMTS=%(numslots)s' # Select number of time slots to be assigned, 1 slot = 1 Gbps ethernet
@@ -42,104 +50,368 @@ COMMAND_PTP_DLT = 'DLT-PTP::PTP-%(port)s:%(CTAG)s' # Delete client port
 COMMAND_CRT_CRSCNT_ODUCTP = 'ENT-CRS-ODUCTP::ODUCTP-%(sport)s-FP%(sportFacilityID)s,ODUCTP-%(dport)s-FP%(dportFacilityID)s:%(CTAG)s::%(dir)s:' # Create crossconnect between two ports
 COMMAND_DLT_CRSCNT_ODUCTP = 'DLT-CRS-ODUCTP::ODUCTP-%(sport)s-FP%(sportFacilityID)s,ODUCTP-%(dport)s-FP%(dportFacilityID)s:%(CTAG)s::%(dir)s:' # Delete crossconnect between two ports
 
+COMMAND_RTRV_ODUCTP = 'RTRV-ODUCTP::ALL:%(CTAG)s' # Retrieve all ODUCTP facilities, with their timeslots
+COMMAND_RTRV_CRSCNT_ODUCTP = 'RTRV-CRS-ODUCTP::ALL:%(CTAG)s' # Retrieve all crossconnects between ODUCTP facilities
+
+COMMAND_TIMEOUT = 120 # seconds, for the response to a TL1 command
+CTAG_MODULUS    = 1000000
+
+# TL1 response completion codes
+COMPLD  = 'COMPLD'
+DENY    = 'DENY'
+PRTL    = 'PRTL'
+DELAY   = 'DELAY'
+RTRV    = 'RTRV'
+COMPLETION_CODES = (COMPLD, DENY, PRTL, DELAY, RTRV)
+
 # String to show in logs
 LOG_SYSTEM = 'CIENA'
 
 
-class CienaLT1SSHChannel(ssh.SSHChannel):
+class TL1Error(Exception):
 
-    name = 'session'
+    def __init__(self, message, response=None):
+        Exception.__init__(self, message)
+        self.response = response
 
-    def __init__(self, conn):
-        ssh.SSHChannel.__init__(self, conn=conn)
 
-        self.linecache = ''
 
-        self.wait_defer = None
-        self.wait_line  = None
+class TL1Response(object):
+    """
+    A complete response to a command: the source identifier and time from the
+    header, the CTAG, the completion code, and the text block. For DENY, the
+    error code is the first line of the text block, and the error text the
+    comments (/* ... */) in it.
+    """
 
+    def __init__(self, sid, timestamp, ctag, code):
+        self.sid        = sid
+        self.timestamp  = timestamp
+        self.ctag       = ctag
+        self.code       = code
+        self.lines      = []   # text block, without comments
+        self.comments   = []
 
-    @defer.inlineCallbacks
-    def sendCommands(self, commands, username, password, CTAG):
-        LT = ";" # Terminates a line in TL1.
+    @property
+    def success(self):
+        return self.code in (COMPLD, RTRV)
 
-        try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+    @property
+    def error_code(self):
+        return self.lines[0].strip('"') if self.code == DENY and self.lines else None
 
-            result = yield self.executeCommand(COMMAND_LOGIN % {'user':username, 'pass':password, 'CTAG':CTAG})
-            if not result:
-                raise Exception("Login Failed")
+    @property
+    def error_text(self):
+        return ' '.join(self.comments)
 
-            log.msg('Entered configure mode', system=LOG_SYSTEM)
+    def __str__(self):
+        if self.code == DENY:
+            return '%s %s %s %s' % (self.ctag, self.code, self.error_code or '', self.error_text)
+        return '%s %s' % (self.ctag, self.code)
+
+
+
+class TL1ResponseParser:
+    """
+    Streaming parser for TL1 output. Data is split into lines as it arrives,
+    and each line is looked at once, so the work is linear in the output.
+
+    A response starts with a header line ("SID" date time), followed by the
+    response identification (M CTAG code), the text block, and ends with a
+    ';' line. A '>' line ends a partial response which is continued in the
+    next block, for the same CTAG. Complete responses are passed to
+    response_received. Autonomous messages, acknowledgments and prompts are
+    skipped.
+    """
+
+    def __init__(self, response_received):
+        self.response_received = response_received
+        self.partial  = []   # pieces of the current incomplete line
+        self.header   = None # (sid, timestamp) of the current block
+        self.response = None # response being collected
+        self.skipping = False
+
+
+    def feed(self, data):
+        start = 0
+        while True:
+            end = data.find('\n', start)
+            if end == -1:
+                break
+            self.partial.append(data[start:end])
+            line = ''.join(self.partial)
+            self.partial = []
+            self.lineReceived(line.strip())
+            start = end + 1
+
+        if start < len(data):
+            self.partial.append(data[start:])
+            # the terminator is usually followed by the prompt, not a newline
+            if len(self.partial) == 1 and self.partial[0].strip() in (';', '>'):
+                self.lineReceived(self.partial.pop().strip())
+
+
+    def lineReceived(self, line):
+        if not line:
+            return
+
+        if line in (';', '>'):
+            if self.response is not None and line == ';':
+                response, self.response = self.response, None
+                self.response_received(response)
+            self.header = None
+            self.skipping = False
+            return
+
+        if self.skipping:
+            return
+
+        if self.header is None:
+            if line.startswith('"'):
+                # header: "SID" YY-MM-DD HH:MM:SS
+                end = line.find('"', 1)
+                self.header = ( line[1:end], line[end+1:].strip() )
+            return # otherwise prompt or echo
+
+        if line.startswith('M '):
+            fields = line.split()
+            if len(fields) >= 3 and fields[2] in COMPLETION_CODES:
+                if self.response is None or self.response.ctag != fields[1]: # else continuation of a partial response
+                    self.response = TL1Response(self.header[0], self.header[1], fields[1], fields[2])
+                return
+
+        if self.response is None:
+            # autonomous message (A / *C / ** / *) or acknowledgment (IP, PF, OK, ...)
+            self.skipping = True
+        elif line.startswith('/*'):
+            self.response.comments.append(line[2:-2].strip() if line.endswith('*/') else line[2:].strip())
+        else:
+            self.response.lines.append(line)
+
+
+
+def withCTAG(command, ctag):
+    # the CTAG is the fourth field of a TL1 command: VERB-MOD:TID:AID:CTAG:...
+    fields = command.split(':')
+    if len(fields) < 4:
+        fields += [ '' ] * (4 - len(fields))
+    fields[3] = ctag
+    return ':'.join(fields)
+
+
+
+def parseFacility(aid):
+    # ODUCTP-<port>-FP<facility id> -> (port, facility id), None for other AIDs
+    if not aid.startswith('ODUCTP-') or '-FP' not in aid:
+        return None
+    port, facility_id = aid[len('ODUCTP-'):].rsplit('-FP', 1)
+    return port, int(facility_id)
+
+
+def parseTimeSlotAssignment(tsassignment):
+    # TSASSIGNMENT bitmask -> slots, the inverse of CienaCommandGenerator.generateTimeSlotAssignment
+    bitmask = int(tsassignment.replace('-', ''), 16)
+    return [ slot for slot in range(1, MAX_TIMESLOT + 1) if bitmask & (1 << (MAX_TIMESLOT - slot)) ]
+
+
+def parseResponseLine(line):
+    # "AID:...:KEY=VALUE,KEY=VALUE,...:..." -> (AID, { KEY : VALUE })
+    fields = line.strip().strip('"').split(':')
+    params = {}
+    for field in fields[1:]:
+        for param in field.split(','):
+            if '=' in param:
+                key, value = param.split('=', 1)
+                params[key.strip()] = value.strip().strip('\\"')
+    return fields[0], params
+
+
+
+class TimeslotAllocator:
+    """
+    Keeps a bitmap of the used ODU timeslots (1 to max_timeslot) of each port,
+    across all connections.
+
+    A request gets the smallest run of free contiguous slots it fits in
+    (best-fit), so large runs are kept for large ODUflex requests. If no run is
+    large enough, the request is spread over the free slots, using the
+    smallest fragments first.
+    """
+
+    def __init__(self, max_timeslot=MAX_TIMESLOT):
+        self.max_timeslot = max_timeslot
+        self.used = {} # port -> bitmap, bit slot - 1 is set when slot is used
+
+
+    def _freeRuns(self, port, candidates=None):
+        # returns the runs of free slots as (first slot, length)
+        used = self.used.get(port, 0)
+        allowed = set(candidates) if candidates is not None else None
+        runs = []
+        start = None
+        for slot in range(1, self.max_timeslot + 2):
+            free = slot <= self.max_timeslot and not used & (1 << (slot - 1)) and (allowed is None or slot in allowed)
+            if free and start is None:
+                start = slot
+            elif not free and start is not None:
+                runs.append( (start, slot - start) )
+                start = None
+        return runs
+
+
+    def allocate(self, port, numslots, candidates=None):
+        """
+        Allocate numslots slots on port, only using slots in candidates if
+        given. Returns the slots in ascending order.
+        """
+        runs = self._freeRuns(port, candidates)
+        fitting = [ run for run in runs if run[1] >= numslots ]
+        if fitting:
+            start, _ = min(fitting, key=lambda run : (run[1], run[0]))
+            slots = list(range(start, start + numslots))
+        elif sum( length for _, length in runs ) >= numslots:
+            slots = []
+            for start, length in sorted(runs, key=lambda run : (run[1], run[0])):
+                slots += range(start, start + min(length, numslots - len(slots)))
+                if len(slots) == numslots:
+                    break
+            slots.sort()
+        else:
+            raise error.STPUnavailableError('Not enough free timeslots on %s for %i slots (%s)' % (port, numslots, self.describe(port)))
 
-            for cmd in commands:
-                log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
-                result = yield self.executeCommand(cmd)
-                if not result:
-                    raise Exception("Command failed: %s" % cmd + LT)
+        self.reserve(port, slots)
+        return slots
 
-            log.msg('Successfully configured', system=LOG_SYSTEM)
 
-        except Exception, e:
-            log.msg('Error while sending commands: %s' % str(e), debug=True, system=LOG_SYSTEM)
-            raise e
+    def reserve(self, port, slots):
+        mask = 0
+        for slot in slots:
+            if not 1 <= slot <= self.max_timeslot:
+                raise error.STPUnavailableError('Invalid timeslot %s on %s' % (slot, port))
+            mask |= 1 << (slot - 1)
+        if self.used.get(port, 0) & mask:
+            raise error.STPUnavailableError('Timeslots %s on %s already in use' % (slots, port))
+        self.used[port] = self.used.get(port, 0) | mask
+
+
+    def release(self, port, slots):
+        for slot in slots:
+            self.used[port] = self.used.get(port, 0) & ~(1 << (slot - 1))
+
+
+    def fragmentation(self, port):
+        """
+        Returns (free slots, largest free run, number of free runs, fragmentation),
+        where fragmentation is the part of the free slots outside the largest run
+        (0.0 when all free slots are contiguous).
+        """
+        runs = self._freeRuns(port)
+        free = sum( length for _, length in runs )
+        largest = max( [ length for _, length in runs ] or [ 0 ] )
+        return free, largest, len(runs), (1 - float(largest) / free) if free else 0.0
 
-        finally:
-            self.sendEOF()
-            self.closeIt()
+
+    def describe(self, port):
+        return '%i free, largest run %i, %i runs, fragmentation %.2f' % self.fragmentation(port)
+
+
+
+class CienaTL1SSHChannel(ssh.SSHChannel):
+    """
+    Logged-in TL1 session. Every command is sent with its own CTAG, and the
+    response is matched on it, so commands from different operations can be
+    in flight at the same time.
+    """
+
+    name = b'session'
+
+    def __init__(self, conn):
+        ssh.SSHChannel.__init__(self, conn=conn)
+
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.parser = TL1ResponseParser(self.responseReceived)
+        self.username = None
+        self.next_ctag = 0
+        self.pending = {} # ctag -> deferred
+        self.is_closed = False
 
 
     @defer.inlineCallbacks
+    def login(self, username, password):
+        yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
+        self.username = username
+        try:
+            yield self.executeCommand(COMMAND_LOGIN % {'user':username, 'pass':password, 'CTAG':''})
+        except TL1Error as e:
+            raise TL1Error('Login failed: %s' % e)
+        log.msg('TL1 session logged in', debug=True, system=LOG_SYSTEM)
+
+
+    def logout(self):
+        LT = ";" # Terminates a line in TL1.
+        self.write(COMMAND_LOGOUT % {'user':self.username, 'CTAG':self._createCTAG()} + LT)
+        self.sendEOF()
+        self.closeIt()
+
+
+    def _createCTAG(self):
+        # TL1 CTAGs are at most 6 alphanumeric characters
+        while True:
+            self.next_ctag = (self.next_ctag + 1) % CTAG_MODULUS
+            ctag = str(self.next_ctag)
+            if ctag not in self.pending:
+                return ctag
+
+
     def executeCommand(self, cmd):
+        """
+        Send a command with a CTAG of its own. Returns a deferred, which fires
+        with the response on COMPLD, and fails with TL1Error on DENY.
+        """
         LT = ";" # Terminates a line in TL1.
-        d = self.expectedLine(";")
-        self.write(cmd + LT)
-        lines = yield d
-        done = False
-        result = False
-        terminators = ["COMPLD", "DENY"]
-        while not done:
-            # wait for a complete line
-            # check if the line contains our 'command-termination' (either COMPLD or DENY)
-            if len(lines) > 2:
-                for line in lines:
-                    if any(s in line for s in terminators):
-                        done = True
-                        if line.find("COMPLD") >= 0:
-                            result = True
-            if not done:
-                d = self.expectedLine(";")
-                lines = yield d
-        defer.returnValue(result)
-
-
-    def expectedLine(self, line):
-        self.wait_line = line
-        self.wait_defer = defer.Deferred()
-        return self.wait_defer
-
-
-    def waitForLine(self, lines):
-        for line in lines:
-            if self.wait_line and self.wait_defer:
-                if self.wait_line == line.strip():
-                    d = self.wait_defer
-                    self.wait_line  = None
-                    self.wait_defer = None
-                    d.callback(lines)
-                else:
-                    pass
+        if self.is_closed:
+            return defer.fail(ssh.ChannelClosedError('TL1 session closed'))
+
+        ctag = self._createCTAG()
+
+        def cancel(_):
+            self.pending.pop(ctag, None)
+
+        d = defer.Deferred(cancel)
+        self.pending[ctag] = d
+        self.write(withCTAG(cmd, ctag) + LT)
+        d.addTimeout(COMMAND_TIMEOUT, reactor)
+        return d
+
+
+    def responseReceived(self, response):
+        if response.code == DELAY:
+            return # the command was accepted, the result comes in a later response
+
+        d = self.pending.pop(response.ctag, None)
+        if d is None:
+            log.msg('TL1 response for unknown CTAG %s' % response.ctag, debug=True, system=LOG_SYSTEM)
+        elif response.success:
+            d.callback(response)
+        else:
+            d.errback(TL1Error('Command failed: %s' % response, response))
+
+
+    def closed(self):
+        self.is_closed = True
+        pending, self.pending = self.pending, {}
+        for d in pending.values():
+            d.errback(ssh.ChannelClosedError('TL1 session closed while waiting for response'))
 
 
     def dataReceived(self, data):
         if len(data) == 0:
             pass
         else:
-            self.linecache += data
-            if '\n' in data:
-                lines = [line.strip() for line in self.linecache.split('\n') if line.strip()]
-                self.linecache = ''
-                self.waitForLine(lines)
+            # channel data is bytes, the parser works on text
+            self.parser.feed(self.decoder.decode(data))
+
+
 
 def CienaBackend(network_name, nrm_ports, parent_requester, cfg):
 
@@ -152,23 +424,102 @@ def CienaBackend(network_name, nrm_ports, parent_requester, cfg):
     host_fingerprint = cfg[config.CIENA_HOST_FINGERPRINT]
     user             = cfg[config.CIENA_USER]
     password         = cfg[config.CIENA_PASSWORD]
+    warmup, refresh_interval = ssh.warmUpOptions(cfg)
 
     cm = CienaConnectionManager(port_map, host, port, host_fingerprint, user, password,
-                                network_name)
+                                network_name, warmup, refresh_interval)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
 
 class CienaConnectionManager:
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, password, network_name):
+    def __init__(self, port_map, host, port, host_fingerprint, user, password, network_name,
+                 warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
         self.network_name = network_name
         self.port_map = port_map
-        self.command_sender = CienaCommandSender(host, port, host_fingerprint, user, password, network_name)
+        self.command_sender = CienaCommandSender(host, port, host_fingerprint, user, password, network_name,
+                                                 warmup, refresh_interval)
+        self.timeslots = TimeslotAllocator()
+        self.allocations = {} # connection id -> [ (interface, slots) ]
+        # the allocations are kept in memory only, so the bitmap is rebuilt from the node before first use
+        self.restored = False
+        self.restore_waiters = None # list of deferreds while retrieving
+        self.facilities = {}    # (interface, facility id) -> slots, on the node when restored
+        self.crossconnects = [] # [ ((interface, facility id), (interface, facility id)) ], on the node when restored
         self.supportedLabelPairs = {
             "otn"  : ['port'],
             "port" : ['otn']
         }
 
 
+    def warmUp(self):
+        d = self.command_sender.warmUp()
+        if self.command_sender.warmup:
+            d.addCallback(lambda _ : self._restoreTimeslots())
+        return d
+
+
+    def shutdown(self):
+        self.command_sender.shutdown()
+
+
+    @defer.inlineCallbacks
+    def _restoreTimeslots(self):
+        # reserve the slots of the facilities already on the node (set up before a restart)
+        if self.restored:
+            return
+
+        if self.restore_waiters is not None:
+            d = defer.Deferred()
+            self.restore_waiters.append(d)
+            yield d
+            return
+
+        self.restore_waiters = []
+        try:
+            facilities, crossconnects = yield self.command_sender.retrieveTimeslots()
+            for (interface, facility_id), slots in facilities.items():
+                try:
+                    self.timeslots.reserve(interface, slots)
+                except error.STPUnavailableError as e:
+                    log.msg('Facility %s-FP%s on node: %s' % (interface, facility_id, e), system=LOG_SYSTEM)
+            self.facilities = facilities
+            self.crossconnects = crossconnects
+            self.restored = True
+            log.msg('Restored timeslots of %i facilities and %i crossconnects from node' % (len(facilities), len(crossconnects)), system=LOG_SYSTEM)
+        except Exception as e:
+            log.msg('Error retrieving timeslots from node: %s' % e, system=LOG_SYSTEM)
+            waiters, self.restore_waiters = self.restore_waiters, None
+            for d in waiters:
+                d.errback(e)
+            raise
+        else:
+            waiters, self.restore_waiters = self.restore_waiters, None
+            for d in waiters:
+                d.callback(None)
+
+
+    def _findAllocations(self, source_target, dest_target):
+        # the slots of a link set up before the restart, from its crossconnect on the node
+        targets = [ target for target in (source_target, dest_target) if target.port.label is not None and target.lst is not None ]
+        if not targets:
+            return []
+
+        interfaces = set( [ source_target.port.interface, dest_target.port.interface ] )
+        matches = []
+        for crossconnect in self.crossconnects:
+            facility_ids = dict(crossconnect)
+            if set(facility_ids) != interfaces:
+                continue
+            allocations = [ (target.port.interface, self.facilities.get( (target.port.interface, facility_ids[target.port.interface]) )) for target in targets ]
+            # the slots must be within the label of the link
+            if all( slots and set(slots) <= set(target.lst) for target, (_, slots) in zip(targets, allocations) ):
+                matches.append(allocations)
+
+        if len(matches) != 1:
+            raise error.InternalNRMError('Cannot determine timeslots of link %s -> %s, %i matching crossconnects on node' % (source_target, dest_target, len(matches)))
+        return matches[0]
+
+
     def getResource(self, port, label):
         assert label is None or label.type_ in (cnt.OTN), 'Label must be None or OTN'
         val = '' if label is None else str(label.labelValue())
@@ -190,20 +541,64 @@ class CienaConnectionManager:
         return True
 
 
+    def _allocateTimeslots(self, connection_id, targets, bandwidth):
+        # pick the slots of the OTN targets from their label values, and use them in the commands
+        allocations = []
+        try:
+            for target in targets:
+                if target.port.label is None or target.lst is None:
+                    continue
+                numslots = int(math.ceil(float(bandwidth) / TIMESLOT_BANDWIDTH)) if bandwidth else len(target.lst)
+                slots = self.timeslots.allocate(target.port.interface, numslots, target.lst)
+                allocations.append( (target.port.interface, slots) )
+                target.lst = slots
+                log.msg('Timeslots %s on %s for %s (%s)' % (slots, target.port.interface, connection_id, self.timeslots.describe(target.port.interface)), debug=True, system=LOG_SYSTEM)
+        except Exception:
+            self._releaseTimeslots(allocations)
+            raise
+        self.allocations[connection_id] = allocations
+
+
+    def _releaseTimeslots(self, allocations):
+        for interface, slots in allocations:
+            self.timeslots.release(interface, slots)
+
+
+    @defer.inlineCallbacks
     def setupLink(self, connection_id, source_target, dest_target, bandwidth):
-        def linkUp(_):
-            log.msg('Link %s -> %s up' % (source_target, dest_target), system=LOG_SYSTEM)
-        d = self.command_sender.setupLink(connection_id,source_target, dest_target,bandwidth)
-        d.addCallback(linkUp)
-        return d
+
+        yield self._restoreTimeslots()
+        self._allocateTimeslots(connection_id, [ source_target, dest_target ], bandwidth)
+
+        try:
+            yield self.command_sender.setupLink(connection_id,source_target, dest_target,bandwidth)
+        except Exception:
+            self._releaseTimeslots(self.allocations.pop(connection_id, []))
+            raise
+
+        log.msg('Link %s -> %s up' % (source_target, dest_target), system=LOG_SYSTEM)
 
 
+    @defer.inlineCallbacks
     def teardownLink(self, connection_id, source_target, dest_target, bandwidth):
-        def linkDown(_):
-            log.msg('Link %s -> %s down' % (source_target, dest_target), system=LOG_SYSTEM)
-        d = self.command_sender.teardownLink(connection_id,source_target, dest_target, bandwidth)
-        d.addCallback(linkDown)
-        return d
+
+        yield self._restoreTimeslots()
+
+        # use the slots the link was set up with, found on the node if set up before a restart
+        if connection_id in self.allocations:
+            allocations = self.allocations[connection_id]
+        else:
+            allocations = self._findAllocations(source_target, dest_target)
+        allocated = dict(allocations)
+        for target in (source_target, dest_target):
+            if target.port.interface in allocated:
+                target.lst = allocated[target.port.interface]
+
+        yield self.command_sender.teardownLink(connection_id,source_target, dest_target, bandwidth)
+
+        self.allocations.pop(connection_id, None)
+        self._releaseTimeslots(allocations)
+        log.msg('Link %s -> %s down' % (source_target, dest_target), system=LOG_SYSTEM)
 
     def canConnect(self, source_port, dest_port, source_label, dest_label):
         src_label_type = 'port' if source_label is None else source_label.type_
@@ -220,32 +615,115 @@ class CienaConnectionManager:
 class CienaCommandSender:
 
     def __init__(self, host, port, ssh_host_fingerprint, user, password,
-            network_name):
+            network_name, warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
         self.username = user
         self.password = password
 
         self.ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], username=self.username, password=self.password)
+        self.ssh_connection_cache = ssh.SSHConnectionCache(self.ssh_connection_creator, LOG_SYSTEM, refresh_interval)
+        self.warmup = warmup
         self.network_name = network_name
 
-    def _getSSHChannel(self):
-
-        def openSSHChannel(ssh_connection):
-            channel = CienaLT1SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(channel)
-            return channel.channel_open
+        self.channel = None
+        self.channel_waiters = None # list of deferreds while logging in
 
-        log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-        d = self.ssh_connection_creator.getSSHConnection()
-        d.addCallback(openSSHChannel)
+    def warmUp(self):
+        if not self.warmup:
+            return defer.succeed(None)
+        d = self.ssh_connection_cache.warmUp()
+        d.addCallback(lambda _ : self._getChannel())
         return d
 
+    def shutdown(self):
+        self._closeChannel()
+        self.ssh_connection_cache.close()
+
+
+    @defer.inlineCallbacks
+    def _getChannel(self):
+
+        # one logged-in session is shared by all operations
+        if self.channel is None or self.channel.is_closed:
+            if self.channel_waiters is not None:
+                d = defer.Deferred()
+                self.channel_waiters.append(d)
+                channel = yield d
+                defer.returnValue(channel)
+
+            self.channel_waiters = []
+            try:
+                ssh_connection = yield self.ssh_connection_cache.getSSHConnection()
+                channel = CienaTL1SSHChannel(conn = ssh_connection)
+                ssh_connection.openChannel(channel)
+                yield channel.channel_open
+                yield channel.login(self.username, self.password)
+                self.channel = channel
+            except Exception as e:
+                waiters, self.channel_waiters = self.channel_waiters, None
+                for d in waiters:
+                    d.errback(e)
+                raise
+            else:
+                waiters, self.channel_waiters = self.channel_waiters, None
+                for d in waiters:
+                    d.callback(channel)
+
+        defer.returnValue(self.channel)
+
+
+    def _closeChannel(self):
+        if self.channel is not None and not self.channel.is_closed:
+            self.channel.logout()
+        self.channel = None
+
+
     @defer.inlineCallbacks
     def _sendCommands(self, commands, connection_id):
 
-        channel = yield self._getSSHChannel()
+        # the commands of an operation depend on each other and are sent in order,
+        # commands of different operations are interleaved on the session
+        channel = yield self._getChannel()
+
+        try:
+            for cmd in commands:
+                log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
+                yield channel.executeCommand(cmd)
+
+        except Exception as e:
+            log.msg('Error while sending commands for %s: %s' % (connection_id, str(e)), debug=True, system=LOG_SYSTEM)
+            raise
 
-        yield channel.sendCommands(commands, self.username, self.password, connection_id[-6:])
+        log.msg('Successfully configured %s' % connection_id, system=LOG_SYSTEM)
+
+
+    @defer.inlineCallbacks
+    def retrieveTimeslots(self):
+        """
+        Returns the ODUCTP facilities on the node as { (port, facility id) : slots },
+        and the crossconnects between them as [ ((port, facility id), (port, facility id)) ].
+        """
+        channel = yield self._getChannel()
+
+        responses = yield defer.gatherResults( [ channel.executeCommand(COMMAND_RTRV_ODUCTP % { 'CTAG' : '' }),
+                                                 channel.executeCommand(COMMAND_RTRV_CRSCNT_ODUCTP % { 'CTAG' : '' }) ], consumeErrors=True)
+        facility_response, crossconnect_response = responses
+
+        facilities = {}
+        for line in facility_response.lines:
+            aid, params = parseResponseLine(line)
+            facility = parseFacility(aid)
+            if facility is not None and 'TSASSIGNMENT' in params:
+                facilities[facility] = parseTimeSlotAssignment(params['TSASSIGNMENT'])
+
+        crossconnects = []
+        for line in crossconnect_response.lines:
+            aid, _ = parseResponseLine(line)
+            ends = [ parseFacility(end) for end in aid.split(',') ]
+            if len(ends) == 2 and None not in ends:
+                crossconnects.append( tuple(ends) )
+
+        defer.returnValue( (facilities, crossconnects) )
 
 
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
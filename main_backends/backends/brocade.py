@@ -18,23 +18,38 @@ Teardown:
 configure terminal
 no vlan $vlan_id
 end
+
+The backend keeps one SSH connection and one shell in enabled mode. Changes
+submitted within CONFIGURE_BATCH_WINDOW are sent in one configure terminal
+pass. When the connection is created, the backend probes if the switch
+accepts a second channel on it. If so, a broken shell is replaced with a new
+channel on the same connection, otherwise the connection is recreated.
 """
 
 import string
 import random
 
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import ssh, genericbackend
+from opennsa.backends.common import ssh, genericbackend, batcher
 
 LOG_SYSTEM = 'opennsa.brocade'
 
+CONFIGURE_BATCH_WINDOW = 0.25 # seconds
+CHANNEL_PROBE_TIMEOUT  = 10   # seconds
+WAIT_TIMEOUT           = 60   # seconds, for the prompt after a command
+
+# start of the output lines of rejected commands, matched at line start only, as
+# the echoed command (e.g., a VLAN name) can contain anything
+ERROR_MARKERS = ( b'Invalid input', b'Error:', b'Error -', b'Incomplete command' )
+
 
 COMMAND_PRIVILEGE   = 'enable %s'
 COMMAND_CONFIGURE   = 'configure terminal'
 COMMAND_END         = 'end'
+COMMAND_EXIT        = 'exit'
 
 COMMAND_VLAN        = 'vlan %(vlan)i name %(name)s'
 #COMMAND_TAGGED      = 'tagged %(port)s'
@@ -43,6 +58,11 @@ COMMAND_TAGGED      = 'tagged ethernet %(port)s'
 COMMAND_NO_VLAN     = 'no vlan %(vlan)i'
 
 
+class CommandError(Exception):
+    pass
+
+
+
 def _portToInterfaceVLAN(nrm_port):
 
     port, vlan = nrm_port.split('.')
@@ -67,7 +87,7 @@ def _createSetupCommands(source_nrm_port, dest_nrm_port):
     cmd_s_intf  = COMMAND_TAGGED    % { 'port' : s_port }
     cmd_d_intf  = COMMAND_TAGGED    % { 'port' : d_port }
 
-    commands = [ cmd_vlan, cmd_s_intf, cmd_d_intf ]
+    commands = [ cmd_vlan, cmd_s_intf, cmd_d_intf, COMMAND_EXIT ]
 
     log.msg('_createSetupCommands: commands %s' % (commands))
     return commands
@@ -86,6 +106,11 @@ def _createTeardownCommands(source_nrm_port, dest_nrm_port):
     return commands
 
 
+def _createRollbackCommands(source_nrm_port, dest_nrm_port):
+    # undoes a partially applied setup
+    return _createTeardownCommands(source_nrm_port, dest_nrm_port)
+
+
 
 class SSHChannel(ssh.SSHChannel):
 
@@ -98,50 +123,132 @@ class SSHChannel(ssh.SSHChannel):
 
         self.wait_defer = None
         self.wait_data  = None
+        self.is_closed  = False
 
 
     @defer.inlineCallbacks
-    def sendCommands(self, commands, enable_password):
-        LT = '\r' # line termination
+    def openShell(self, enable_password):
+        """
+        Request a shell and enter privileged mode. The channel is left at the
+        privileged prompt, ready for sendFragments.
+        """
+        log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
+        yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
 
-        try:
-            log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
-            yield self.conn.sendRequest(self, 'shell', b'', wantReply=1)
+        yield self.waitForData(b'>', clear=False) # the prompt may already be here
+        yield self.executeCommand(COMMAND_PRIVILEGE % enable_password)
+        log.msg('Entered privileged mode', debug=True, system=LOG_SYSTEM)
 
-            d = self.waitForData(b'>')
-            self.write(COMMAND_PRIVILEGE % enable_password + LT)
-            yield d
-            log.msg('Entered privileged mode', debug=True, system=LOG_SYSTEM)
 
-            d = self.waitForData(b'#')
-            self.write(COMMAND_CONFIGURE + LT)
-            yield d
+    @defer.inlineCallbacks
+    def sendFragments(self, fragments):
+        """
+        Send the fragments, (commands, rollback commands) pairs, in order in
+        one configure terminal pass. Starts and ends at the privileged prompt,
+        so the channel can be used again.
+
+        The switch applies each command at once, so a fragment which is
+        rejected is undone with its rollback commands, and the fragments
+        before it stay. Fails with batcher.PartialCommitError, telling how many
+        fragments were applied.
+        """
+        applied = 0
+        try:
+            yield self.executeCommand(COMMAND_CONFIGURE)
             log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
 
-            for cmd in commands:
-                log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
-                d = self.waitForData(b'#')
-                self.write(cmd + LT)
-                yield d
+            for commands, rollback_commands in fragments:
+                try:
+                    for cmd in commands:
+                        log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
+                        yield self.executeCommand(cmd)
+                except CommandError as e:
+                    log.msg('Error sending commands: %s' % str(e), system=LOG_SYSTEM)
+                    yield self.executeCommand(COMMAND_END)
+                    if rollback_commands:
+                        yield self.rollback(rollback_commands)
+                    raise batcher.PartialCommitError(applied, e)
+                applied += 1
 
-            # not quite sure how to handle failure here
             log.msg('Commands send, sending end command.', debug=True, system=LOG_SYSTEM)
-            d = self.waitForData(b'#')
-            self.write(COMMAND_END + LT)
-            yield d
+            yield self.executeCommand(COMMAND_END)
 
+        except batcher.PartialCommitError:
+            raise
         except Exception as e:
-            log.msg('Error sending commands: %s' % str(e))
-            raise e
+            # the session broke, what is applied so far stays in effect
+            log.msg('Error sending commands: %s' % str(e), system=LOG_SYSTEM)
+            raise batcher.PartialCommitError(applied, e)
 
         log.msg('Commands successfully send', debug=True, system=LOG_SYSTEM)
+
+
+    @defer.inlineCallbacks
+    def rollback(self, commands):
+        # best effort, the failed fragment may not have created what is removed
+        yield self.executeCommand(COMMAND_CONFIGURE)
+        for cmd in commands:
+            try:
+                yield self.executeCommand(cmd)
+            except CommandError as e:
+                log.msg('Rollback: %s' % str(e), debug=True, system=LOG_SYSTEM)
+        yield self.executeCommand(COMMAND_END)
+
+
+    @defer.inlineCallbacks
+    def executeCommand(self, cmd, prompt=b'#'):
+        """
+        Send a command and wait for the prompt. Fails with CommandError if a
+        line of the output before the prompt is an error.
+        """
+        LT = '\r' # line termination
+        d = self.waitForData(prompt)
+        self.write((cmd + LT).encode())
+        output = yield d
+        for line in output.split(b'\n'):
+            line = line.strip()
+            if line.startswith(ERROR_MARKERS):
+                raise CommandError('Command "%s" failed: %s' % (cmd, line.decode(errors='replace')))
+        defer.returnValue(output)
+
+
+    def exitShell(self):
+        LT = '\r' # line termination
+        self.write((COMMAND_EXIT + LT).encode())
         self.sendEOF()
         self.closeIt()
 
 
-    def waitForData(self, data):
+    def closed(self):
+        self.is_closed = True
+        if self.wait_defer is not None:
+            d = self.wait_defer
+            self.wait_data  = None
+            self.wait_defer = None
+            d.errback(ssh.ChannelClosedError('Channel closed while waiting for data'))
+
+
+    def waitForData(self, data, clear=True):
+        if clear:
+            # anything received so far belongs to earlier commands
+            self.data = b''
+        elif data in self.data:
+            output, self.data = self.data, b''
+            return defer.succeed(output)
+
+        def cancel(d):
+            if self.wait_defer is d:
+                self.wait_data  = None
+                self.wait_defer = None
+
+        def timedOut(result, timeout):
+            # the session is in an unknown state
+            self.closeIt()
+            raise ssh.ChannelClosedError('No prompt (%s) within %s seconds' % (data.decode(), timeout))
+
         self.wait_data  = data
-        self.wait_defer = defer.Deferred()
+        self.wait_defer = defer.Deferred(cancel)
+        self.wait_defer.addTimeout(WAIT_TIMEOUT, reactor, onTimeoutCancel=timedOut)
         return self.wait_defer
 
 
@@ -152,43 +259,152 @@ class SSHChannel(ssh.SSHChannel):
             self.data += data
             if self.wait_data and self.wait_data in self.data:
                 d = self.wait_defer
+                output = self.data
                 self.data       = b''
                 self.wait_data  = None
                 self.wait_defer = None
-                d.callback(self)
+                d.callback(output)
+
+
+
 
+class ProbeChannel(ssh.SSHChannel):
+
+    name = b'session'
+
+    def dataReceived(self, data):
+        pass
 
 
 
 class BrocadeCommandSender:
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, enable_password):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, enable_password,
+                 warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
 
         self.ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
+        self.ssh_connection_cache = ssh.SSHConnectionCache(self.ssh_connection_creator, LOG_SYSTEM, refresh_interval)
         self.enable_password = enable_password
+        self.warmup = warmup
+
+        self.channel = None
+        self.channel_connection = None # ssh connection of the channel
+        self.multi_channel = None      # unknown until probed
+        self.channel_waiters = None    # list of deferreds while the channel is opened
+        # the switch has no rollback, so a failed batch is not split and sent again
+        self.configure_batcher = batcher.CommitBatcher(self._sendBatch, CONFIGURE_BATCH_WINDOW, log_system=LOG_SYSTEM,
+                                                       on_timeout=self._closeChannel, split=False)
+
+
+    def warmUp(self):
+        if not self.warmup:
+            return defer.succeed(None)
+        d = self.ssh_connection_cache.warmUp()
+        d.addCallback(lambda _ : self._getChannel())
+        return d
+
+
+    def shutdown(self):
+        self._closeChannel()
+        self.ssh_connection_cache.close()
+
+
+    @defer.inlineCallbacks
+    def _openChannel(self, ssh_connection, channel):
+        ssh_connection.openChannel(channel)
+        d = channel.channel_open
+        d.addTimeout(CHANNEL_PROBE_TIMEOUT, reactor)
+        yield d
+
+
+    @defer.inlineCallbacks
+    def _probeMultiChannel(self, ssh_connection):
+        # a second channel while the shell channel is open
+        probe = ProbeChannel(conn=ssh_connection)
+        try:
+            yield self._openChannel(ssh_connection, probe)
+            probe.closeIt()
+            self.multi_channel = True
+        except Exception as e:
+            log.msg('Second channel not accepted (%s)' % e, debug=True, system=LOG_SYSTEM)
+            self.multi_channel = False
+        log.msg('Multiple channels per connection supported: %s' % self.multi_channel, system=LOG_SYSTEM)
 
 
     @defer.inlineCallbacks
-    def sendCommands(self, commands):
+    def _getChannel(self):
 
-        # Open a connection for each request
-        # This is done due to the code being based on the Force10 backend
-        # It is currently unknown if the Brocade SSH implementation
-        # supports multiple ssh channels.
+        if self.channel is not None and not self.channel.is_closed:
+            defer.returnValue(self.channel)
 
-        log.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
+        if self.channel_waiters is not None:
+            # being opened (e.g., by warm up), wait for it instead of opening a second one
+            d = defer.Deferred()
+            self.channel_waiters.append(d)
+            channel = yield d
+            defer.returnValue(channel)
 
+        self.channel_waiters = []
         try:
+            ssh_connection = yield self.ssh_connection_cache.getSSHConnection()
+            if ssh_connection is self.channel_connection and not self.multi_channel:
+                # the shell on this connection is gone, and we cannot open another, so start over
+                log.msg('Recreating SSH connection for new shell', debug=True, system=LOG_SYSTEM)
+                self.ssh_connection_cache.dropConnection()
+                ssh_connection = yield self.ssh_connection_cache.getSSHConnection()
+
             channel = SSHChannel(conn=ssh_connection)
-            ssh_connection.openChannel(channel)
+            yield self._openChannel(ssh_connection, channel)
+            yield channel.openShell(self.enable_password)
+            log.msg('Privileged session ready', debug=True, system=LOG_SYSTEM)
 
-            yield channel.channel_open
-            yield channel.sendCommands(commands, self.enable_password)
+            if self.multi_channel is None:
+                yield self._probeMultiChannel(ssh_connection)
+
+            self.channel = channel
+            self.channel_connection = ssh_connection
+        except Exception as e:
+            waiters, self.channel_waiters = self.channel_waiters, None
+            for d in waiters:
+                d.errback(e)
+            raise
+        else:
+            waiters, self.channel_waiters = self.channel_waiters, None
+            for d in waiters:
+                d.callback(channel)
+
+        defer.returnValue(channel)
+
+
+    def _closeChannel(self):
+        if self.channel is not None and not self.channel.is_closed:
+            self.channel.exitShell()
+        self.channel = None
+
+
+    @defer.inlineCallbacks
+    def _sendBatch(self, fragments):
+        # the batcher only has one batch in flight, so the channel is not shared
+        channel = yield self._getChannel()
+        try:
+            yield channel.sendFragments(fragments)
+        except batcher.PartialCommitError as e:
+            if not isinstance(e.reason, CommandError):
+                # the session is in an unknown state, start over with a new one
+                self._closeChannel()
+            raise
+        except Exception:
+            self._closeChannel()
+            raise
 
-        finally:
-            ssh_connection.transport.loseConnection()
+
+    def sendCommands(self, commands, rollback_commands=None):
+        """
+        Apply the commands. rollback_commands undo them if the switch rejects
+        one of them part way.
+        """
+        return self.configure_batcher.submit( (commands, rollback_commands) )
 
 
 
@@ -205,8 +421,18 @@ class BrocadeConnectionManager:
         ssh_public_key   = cfg[config.BROCADE_SSH_PUBLIC_KEY]
         ssh_private_key  = cfg[config.BROCADE_SSH_PRIVATE_KEY]
         enable_password  = cfg[config.BROCADE_ENABLE_PASSWORD]
+        warmup, refresh_interval = ssh.warmUpOptions(cfg)
+
+        self.command_sender = BrocadeCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, enable_password,
+                                                   warmup, refresh_interval)
 
-        self.command_sender = BrocadeCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, enable_password)
+
+    def warmUp(self):
+        return self.command_sender.warmUp()
+
+
+    def shutdown(self):
+        self.command_sender.shutdown()
 
 
     def getResource(self, port, label):
@@ -234,7 +460,8 @@ class BrocadeConnectionManager:
             return pt
 
         commands = _createSetupCommands(source_target, dest_target)
-        d = self.command_sender.sendCommands(commands)
+        rollback_commands = _createRollbackCommands(source_target, dest_target)
+        d = self.command_sender.sendCommands(commands, rollback_commands)
         d.addCallback(linkUp)
         return d
 
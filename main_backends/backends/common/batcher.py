@@ -0,0 +1,145 @@
+"""
+Batching of configuration commits.
+
+Devices where a commit is expensive (Junos) can commit the changes of several
+link operations at once. Fragments (the changes of one operation) submitted
+within a short window are committed together. If a batch fails, it is split in
+two and each half is committed on its own, until the failing fragments are
+found, so only the operations with a bad fragment fail.
+
+Devices without a candidate configuration (FTOS, Brocade) apply the fragments
+of a batch one after the other and cannot take them back, so a batch must not
+be committed twice. Their batchers are created with split=False, and the
+commit raises PartialCommitError when a fragment fails: the fragments before
+it succeed, the failing one fails, and the ones after it go into the next
+batch.
+
+Only one batch is committed at a time, so a commit which never completes would
+hold up all later operations. Commits therefore have a timeout, after which the
+batch fails (and is split as any other failure). The on_timeout callback lets
+the backend drop the session the commit was stuck on.
+"""
+
+from twisted.python import log, failure
+from twisted.internet import defer, reactor
+
+
+LOG_SYSTEM = 'opennsa.CommitBatcher'
+
+DEFAULT_WINDOW  = 0.25 # seconds
+DEFAULT_TIMEOUT = 300  # seconds, for a commit
+
+
+
+class PartialCommitError(Exception):
+    """
+    A commit applying the fragments in order stopped at a failing fragment.
+    The first applied fragments are in effect, the one after them failed
+    with reason, and the rest were not tried.
+    """
+
+    def __init__(self, applied, reason):
+        Exception.__init__(self, 'Fragment %i failed: %s' % (applied, reason))
+        self.applied = applied
+        self.reason  = reason
+
+
+
+class CommitBatcher:
+
+    def __init__(self, commit, window=DEFAULT_WINDOW, max_batch_size=None, log_system=LOG_SYSTEM, clock=reactor,
+                 timeout=DEFAULT_TIMEOUT, on_timeout=None, split=True):
+        """
+        commit is called with a list of fragments and must return a deferred,
+        which fails if the fragments could not be committed. If it has not
+        fired after timeout seconds, it is cancelled, and on_timeout (if given)
+        is called before the batch fails. If split is false, a failed batch
+        is not split and committed again, all its fragments fail (or, for
+        PartialCommitError, only the failing one).
+        """
+        self.commit         = commit
+        self.window         = window
+        self.max_batch_size = max_batch_size
+        self.log_system     = log_system
+        self.clock          = clock
+        self.timeout        = timeout
+        self.on_timeout     = on_timeout
+        self.split          = split
+
+        self.pending      = [] # (fragment, deferred)
+        self.delayed_call = None
+        self.committing   = False
+
+
+    def submit(self, fragment):
+        """
+        Add a fragment to the next batch. The returned deferred fires when the
+        fragment has been committed.
+        """
+        d = defer.Deferred()
+        self.pending.append( (fragment, d) )
+        self._schedule()
+        return d
+
+
+    def _schedule(self):
+        # only one batch is committed at a time, fragments arriving meanwhile go into the next one
+        if self.pending and self.delayed_call is None and not self.committing:
+            self.delayed_call = self.clock.callLater(self.window, self._commitPending)
+
+
+    @defer.inlineCallbacks
+    def _commitPending(self):
+        self.delayed_call = None
+        size = self.max_batch_size or len(self.pending)
+        batch, self.pending = self.pending[:size], self.pending[size:]
+
+        self.committing = True
+        try:
+            log.msg('Committing batch of %i fragment(s)' % len(batch), debug=True, system=self.log_system)
+            yield self._commitBatch(batch)
+        finally:
+            self.committing = False
+            self._schedule()
+
+
+    def _timedOut(self, result, timeout):
+        log.msg('Commit did not complete within %s seconds' % timeout, system=self.log_system)
+        if self.on_timeout is not None:
+            try:
+                self.on_timeout()
+            except Exception as e:
+                log.msg('Error in commit timeout handler: %s' % e, system=self.log_system)
+        raise defer.TimeoutError('Commit did not complete within %s seconds' % timeout)
+
+
+    @defer.inlineCallbacks
+    def _commitBatch(self, batch):
+        err = None
+        try:
+            d = defer.maybeDeferred(self.commit, [ fragment for fragment, _ in batch ])
+            d.addTimeout(self.timeout, self.clock, onTimeoutCancel=self._timedOut)
+            yield d
+        except Exception:
+            err = failure.Failure()
+
+        if err is None:
+            for _, d in batch:
+                d.callback(None)
+        elif err.check(PartialCommitError) and err.value.applied < len(batch):
+            applied = err.value.applied
+            log.msg('Commit stopped at fragment %i of %i: %s' % (applied + 1, len(batch), err.value.reason), system=self.log_system)
+            for _, d in batch[:applied]:
+                d.callback(None)
+            batch[applied][1].errback(failure.Failure(err.value.reason))
+            # not tried, so they go first in the next batch
+            self.pending[0:0] = batch[applied+1:]
+        elif len(batch) == 1 or not self.split:
+            for _, d in batch:
+                d.errback(err)
+        else:
+            log.msg('Commit of %i fragments failed, splitting batch: %s' % (len(batch), err.getErrorMessage()), system=self.log_system)
+            half = len(batch) // 2
+            yield self._commitBatch(batch[:half])
+            yield self._commitBatch(batch[half:])
+
@@ -0,0 +1,651 @@
+"""
+Fake network device, served over SSH.
+
+Emulates the command line of the devices the CLI backends talk to, so the
+backends can be benchmarked and exercised without hardware. Supported dialects
+are Junos (configure mode and commit), Force10 and Brocade (enable and
+configure) and Ciena TL1 (COMPLD / DENY responses).
+
+Each command can be given a latency, commits (and TL1 provisioning commands,
+which are applied immediately) a separate commit latency, and failures can be
+injected either at random or for commands matching a substring.
+
+Usage:
+
+    device = FakeDevice(JunosDialect, command_latency=0.01, commit_latency=0.5)
+    server = FakeDeviceServer(device)
+    listening_port = server.listen()
+    # connect to listening_port.getHost().port, accepting server.fingerprint
+"""
+
+import re
+import random
+import time
+
+from zope.interface import implementer
+
+from twisted.python import log, components
+from twisted.internet import defer, protocol, reactor
+from twisted.cred import portal, checkers, credentials, error as crederror
+from twisted.conch import avatar, interfaces, error as concherror
+from twisted.conch.ssh import factory, keys, session
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+LOG_SYSTEM = 'opennsa.FakeDevice'
+
+HOST_KEY_SIZE = 2048
+
+
+
+def generateKey():
+    """
+    Create a new RSA key, usable as host key or client key.
+    """
+    return keys.Key(rsa.generate_private_key(public_exponent=65537, key_size=HOST_KEY_SIZE, backend=default_backend()))
+
+
+
+class FakeDevice:
+    """
+    State and behaviour of an emulated device.
+
+    The device state is shared between all sessions to the device. What is kept
+    in configuration depends on the dialect. All received lines are kept in
+    history, in order.
+    """
+
+    def __init__(self, dialect, hostname='fake', password=None, enable_password=None,
+                 command_latency=0, commit_latency=0, failure_rate=0, commit_failure_rate=0,
+                 fail_commands=None, seed=None):
+
+        self.dialect             = dialect
+        self.hostname            = hostname
+        self.password            = password         # TL1 login password, None accepts any
+        self.enable_password     = enable_password  # None accepts any
+        self.command_latency     = command_latency  # seconds
+        self.commit_latency      = commit_latency   # seconds
+        self.failure_rate        = failure_rate
+        self.commit_failure_rate = commit_failure_rate
+        self.fail_commands       = fail_commands or [] # substrings of commands which always fail
+
+        self.random = random.Random(seed)
+
+        self.configuration = None # set by the dialect
+        self.saved_configuration = None
+        self.history = []
+
+        self.sessions = 0
+        self.commits  = 0
+
+
+    def createDialect(self):
+        return self.dialect(self)
+
+
+    def shouldFail(self, line, commit=False):
+        if any( fc in line for fc in self.fail_commands ):
+            return True
+        rate = self.commit_failure_rate if commit else self.failure_rate
+        return rate > 0 and self.random.random() < rate
+
+
+
+class DeviceDialect:
+    """
+    Base class for dialects.
+
+    handleLine gets one line (without terminator) and returns the output for
+    it and how long the device should take before sending the output.
+    """
+
+    echo = True
+    line_terminators = b'\r\n'
+
+    def __init__(self, device):
+        self.device = device
+        self.closed = False
+
+
+    def greeting(self):
+        return ''
+
+
+    def echoLine(self, line):
+        return self.echo
+
+
+    def handleLine(self, line):
+        raise NotImplementedError('handleLine must be implemented in subclass')
+
+
+
+class JunosDialect(DeviceDialect):
+    """
+    Junos operational and configuration mode.
+
+    The device configuration is the list of committed set statements. Each
+    session edits its own candidate, like configure private.
+    """
+
+    def __init__(self, device):
+        DeviceDialect.__init__(self, device)
+        if device.configuration is None:
+            device.configuration = []
+        self.candidate = None # None when in operational mode
+
+
+    def prompt(self):
+        if self.candidate is None:
+            return 'opennsa@%s> ' % self.device.hostname
+        else:
+            return '\r\n[edit]\r\nopennsa@%s# ' % self.device.hostname
+
+
+    def greeting(self):
+        return '--- JUNOS fake device\r\n' + self.prompt()
+
+
+    def handleLine(self, line):
+        device = self.device
+        words = line.split()
+
+        if not words:
+            return self.prompt(), 0
+
+        if self.candidate is None:
+            if words[0] in ('configure', 'edit'):
+                self.candidate = list(device.configuration)
+                return 'Entering configuration mode\r\n' + self.prompt(), device.command_latency
+            elif words[0] in ('exit', 'quit'):
+                self.closed = True
+                return '', 0
+            elif line == 'show configuration':
+                return '\r\n'.join(device.configuration) + '\r\n' + self.prompt(), device.command_latency
+            else:
+                return "error: unknown command: %s\r\n" % words[0] + self.prompt(), device.command_latency
+
+        if words[0] == 'commit':
+            if device.shouldFail(line, commit=True):
+                return 'error: configuration check-out failed\r\n' + self.prompt(), device.commit_latency
+            device.configuration = list(self.candidate)
+            device.commits += 1
+            if 'and-quit' in words:
+                self.candidate = None
+                return 'commit complete\r\nExiting configuration mode\r\n' + self.prompt(), device.commit_latency
+            return 'commit complete\r\n' + self.prompt(), device.commit_latency
+
+        if words[0] in ('exit', 'quit'):
+            self.candidate = None
+            return 'Exiting configuration mode\r\n' + self.prompt(), 0
+
+        if words[0] == 'rollback':
+            self.candidate = list(device.configuration)
+            return 'load complete\r\n' + self.prompt(), device.command_latency
+
+        if words[0] not in ('set', 'delete') or len(words) < 2 or device.shouldFail(line):
+            return 'syntax error.\r\n' + self.prompt(), device.command_latency
+
+        statement = ' '.join(words[1:])
+        if words[0] == 'set':
+            if statement not in self.candidate:
+                self.candidate.append(statement)
+            return self.prompt(), device.command_latency
+        else:
+            remaining = [ s for s in self.candidate if not (s == statement or s.startswith(statement + ' ')) ]
+            output = '' if len(remaining) < len(self.candidate) else 'warning: statement not found\r\n'
+            self.candidate = remaining
+            return output + self.prompt(), device.command_latency
+
+
+
+class EnableDialect(DeviceDialect):
+    """
+    Common part of Force10 and Brocade like command lines: user mode, enable,
+    configure mode with sub modes and writing the configuration.
+
+    The device configuration is a dict, with the command entering a sub mode
+    (or None for the top level) as key and the list of commands in that sub
+    mode as value. "no <command>" removes a command, or a sub mode.
+    """
+
+    configure_commands = ()
+    write_commands     = ()
+    submodes           = () # (regular expression, prompt name)
+    config_mode        = 'conf'
+    write_output       = ''
+
+    def __init__(self, device):
+        DeviceDialect.__init__(self, device)
+        if device.configuration is None:
+            device.configuration = { None: [] }
+        self.mode = 'user' # user, password, enable, config
+        self.section = None
+        self.section_name = None
+
+
+    def hostPrompt(self):
+        return self.device.hostname
+
+
+    def prompt(self):
+        host = self.hostPrompt()
+        if self.mode == 'user':
+            return host + '>'
+        elif self.mode == 'password':
+            return 'Password: '
+        elif self.mode == 'enable':
+            return host + '#'
+        elif self.section is None:
+            return '%s(%s)#' % (host, self.config_mode)
+        else:
+            return '%s(%s)#' % (host, self.section_name)
+
+
+    def greeting(self):
+        return '\r\n' + self.prompt()
+
+
+    def echoLine(self, line):
+        return self.mode != 'password' # passwords are not echoed
+
+
+    def errorOutput(self, line):
+        return '% Error: Invalid input\r\n'
+
+
+    def checkEnablePassword(self, password):
+        ep = self.device.enable_password
+        if ep is None or password == ep:
+            self.mode = 'enable'
+            return '\r\n' + self.prompt()
+        else:
+            self.mode = 'user'
+            return '% Error: Authentication failed\r\n' + self.prompt()
+
+
+    def handleLine(self, line):
+        device = self.device
+        line = line.strip()
+
+        if self.mode == 'password':
+            return self.checkEnablePassword(line), device.command_latency
+
+        if not line:
+            return '\r\n' + self.prompt(), 0
+
+        if self.mode == 'user':
+            if line == 'enable':
+                self.mode = 'password'
+                return self.prompt(), device.command_latency
+            elif line.startswith('enable '):
+                return self.checkEnablePassword(line[len('enable '):]), device.command_latency
+            elif line in ('exit', 'quit'):
+                self.closed = True
+                return '', 0
+            else:
+                return self.errorOutput(line) + self.prompt(), device.command_latency
+
+        if line in self.write_commands:
+            if device.shouldFail(line, commit=True):
+                return self.errorOutput(line) + self.prompt(), device.commit_latency
+            device.saved_configuration = dict( [ (k, list(v)) for k,v in device.configuration.items() ] )
+            device.commits += 1
+            return self.write_output + self.prompt(), device.commit_latency
+
+        if self.mode == 'enable':
+            if line in self.configure_commands:
+                self.mode = 'config'
+                return '\r\n' + self.prompt(), device.command_latency
+            elif line in ('exit', 'quit'):
+                self.closed = True
+                return '', 0
+            elif line == 'disable':
+                self.mode = 'user'
+                return '\r\n' + self.prompt(), 0
+            else:
+                return self.errorOutput(line) + self.prompt(), device.command_latency
+
+        # configure mode
+        if line == 'end':
+            self.mode = 'enable'
+            self.section = self.section_name = None
+            return '\r\n' + self.prompt(), device.command_latency
+
+        if line == 'exit':
+            if self.section is None:
+                self.mode = 'enable'
+            self.section = self.section_name = None
+            return '\r\n' + self.prompt(), device.command_latency
+
+        if device.shouldFail(line):
+            return self.errorOutput(line) + self.prompt(), device.command_latency
+
+        for pattern, name in self.submodes:
+            m = re.match(pattern, line)
+            if m:
+                self.section = line
+                self.section_name = name % m.groups()
+                device.configuration.setdefault(line, [])
+                return '\r\n' + self.prompt(), device.command_latency
+
+        if line.startswith('no '):
+            negated = line[3:]
+            if negated in device.configuration:
+                del device.configuration[negated]
+            else:
+                commands = device.configuration.setdefault(self.section, [])
+                if negated in commands:
+                    commands.remove(negated)
+            return '\r\n' + self.prompt(), device.command_latency
+
+        commands = device.configuration.setdefault(self.section, [])
+        if line not in commands:
+            commands.append(line)
+        return self.commandOutput(line) + '\r\n' + self.prompt(), device.command_latency
+
+
+    def commandOutput(self, line):
+        return ''
+
+
+
+class Force10Dialect(EnableDialect):
+
+    configure_commands = ('configure', 'configure terminal')
+    write_commands     = ('write', 'write memory', 'copy running-config startup-config')
+    submodes           = ( (r'interface vlan (\d+)$', 'conf-if-vl-%s'), )
+    config_mode        = 'conf'
+    write_output       = 'Copy completed successfully.\r\n'
+
+    def errorOutput(self, line):
+        return '% Error: Invalid input at "^" marker.\r\n'
+
+
+
+class BrocadeDialect(EnableDialect):
+
+    configure_commands = ('configure terminal', 'conf t')
+    write_commands     = ('write memory',)
+    submodes           = ( (r'vlan (\d+)(?: name .*)?$', 'config-vlan-%s'), )
+    config_mode        = 'config'
+    write_output       = 'Write startup-config done.\r\n'
+
+    def hostPrompt(self):
+        return 'SSH@' + self.device.hostname
+
+
+    def errorOutput(self, line):
+        return 'Invalid input -> %s\r\nType ? for a list\r\n' % line
+
+
+    def commandOutput(self, line):
+        if line.startswith('tagged ethernet ') and self.section_name is not None:
+            vlan = self.section_name.split('-')[-1]
+            return 'Added tagged port(s) ethe %s to port-vlan %s.' % (line[len('tagged ethernet '):], vlan)
+        return ''
+
+
+
+class CienaTL1Dialect(DeviceDialect):
+    """
+    Ciena TL1 over an SSH session.
+
+    Commands are terminated by ';' and are not echoed. Every command gets a
+    response with its CTAG, either COMPLD or DENY. Provisioning commands are
+    applied immediately and take the commit latency.
+
+    The device configuration is a dict from (verb modifier, AID) to the command
+    parameters for entities created with ENT- and not yet deleted with DLT-.
+    """
+
+    echo = False
+    line_terminators = b';'
+
+    PROVISIONING_VERBS = ('ENT', 'DLT', 'ED', 'RMV', 'RST')
+
+    def __init__(self, device):
+        DeviceDialect.__init__(self, device)
+        if device.configuration is None:
+            device.configuration = {}
+        self.logged_in = False
+
+
+    def greeting(self):
+        return '\r\n< '
+
+
+    def response(self, ctag, deny_code=None, message=None):
+        header = '\r\n\n   "%s" %s\r\n' % (self.device.hostname, time.strftime('%y-%m-%d %H:%M:%S'))
+        if deny_code is None:
+            return header + 'M  %s COMPLD\r\n;\r\n< ' % ctag
+        else:
+            body = 'M  %s DENY\r\n   %s\r\n' % (ctag, deny_code)
+            if message:
+                body += '   /* %s */\r\n' % message
+            return header + body + ';\r\n< '
+
+
+    def handleLine(self, line):
+        device = self.device
+        line = line.strip()
+        if not line:
+            return '', 0
+
+        fields = line.split(':')
+        command = fields[0].upper()
+        aid  = fields[2] if len(fields) > 2 else ''
+        ctag = fields[3] if len(fields) > 3 and fields[3] else '0'
+
+        if command == 'ACT-USER':
+            password = fields[5] if len(fields) > 5 else ''
+            if device.password is not None and password != device.password:
+                return self.response(ctag, 'PICC', 'Invalid user or password'), device.command_latency
+            self.logged_in = True
+            return self.response(ctag), device.command_latency
+
+        if command == 'CANC-USER':
+            self.logged_in = False
+            return self.response(ctag), device.command_latency
+
+        if not self.logged_in:
+            return self.response(ctag, 'PLNA', 'Login not active'), device.command_latency
+
+        verb = command.split('-', 1)[0]
+        latency = device.commit_latency if verb in self.PROVISIONING_VERBS else device.command_latency
+
+        if device.shouldFail(line, commit=verb in self.PROVISIONING_VERBS):
+            return self.response(ctag, 'SROF', 'Requested operation failed'), latency
+
+        if '-' not in command:
+            return self.response(ctag, 'ICNV', 'Command not valid'), latency
+
+        modifier = command.split('-', 1)[1]
+        if verb == 'ENT':
+            device.configuration[(modifier, aid)] = ':'.join(fields[4:])
+            device.commits += 1
+        elif verb == 'DLT':
+            device.configuration.pop((modifier, aid), None)
+            device.commits += 1
+
+        return self.response(ctag), latency
+
+
+
+class DeviceShell(protocol.Protocol):
+    """
+    Shell session on the fake device. Lines are handled one at a time, in
+    order, each output is sent after the latency given by the dialect.
+    """
+
+    def __init__(self, device, clock=reactor):
+        self.device  = device
+        self.dialect = device.createDialect()
+        self.clock   = clock
+
+        self.buffer  = b''
+        self.pending = []
+        self.delayed_call = None
+        self.last_terminator = None
+
+        terminators = self.dialect.line_terminators
+        self.line_pattern = re.compile(b'([^' + terminators + b']*)([' + terminators + b'])')
+
+
+    def connectionMade(self):
+        self.device.sessions += 1
+        self.transport.write(self.dialect.greeting().encode())
+
+
+    def dataReceived(self, data):
+        self.buffer += data
+        end = 0
+        for m in self.line_pattern.finditer(self.buffer):
+            line, terminator = m.groups()
+            # \r\n is two terminators, only the first one ends a line
+            if not (line == b'' and terminator == b'\n' and self.last_terminator == b'\r'):
+                self.pending.append(line.decode('utf-8', 'replace'))
+            self.last_terminator = terminator
+            end = m.end()
+        self.buffer = self.buffer[end:]
+        self.processLines()
+
+
+    def processLines(self):
+        while self.pending and self.delayed_call is None and not self.dialect.closed:
+            line = self.pending.pop(0)
+            self.device.history.append(line)
+            if self.dialect.echoLine(line):
+                self.transport.write(line.encode() + b'\r\n')
+            output, latency = self.dialect.handleLine(line)
+            if latency:
+                self.delayed_call = self.clock.callLater(latency, self.sendOutput, output)
+            else:
+                self.sendOutput(output, processing=False)
+
+
+    def sendOutput(self, output, processing=True):
+        self.delayed_call = None
+        if output:
+            self.transport.write(output.encode())
+        if self.dialect.closed:
+            self.transport.loseConnection()
+        elif processing:
+            self.processLines()
+
+
+    def connectionLost(self, reason):
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+
+
+
+class FakeDeviceAvatar(avatar.ConchUser):
+
+    def __init__(self, username, device):
+        avatar.ConchUser.__init__(self)
+        self.username = username
+        self.device   = device
+        self.channelLookup.update({ b'session': session.SSHSession })
+
+
+
+@implementer(session.ISession)
+class FakeDeviceSession:
+
+    def __init__(self, avatar):
+        self.avatar = avatar
+
+    def getPty(self, term, windowSize, modes):
+        pass
+
+    def windowChanged(self, windowSize):
+        pass
+
+    def openShell(self, transport):
+        shell = DeviceShell(self.avatar.device)
+        shell.makeConnection(transport)
+        transport.makeConnection(session.wrapProtocol(shell))
+
+    def execCommand(self, transport, command):
+        raise concherror.ConchError('Command execution not supported by fake device')
+
+    def eofReceived(self):
+        pass
+
+    def closed(self):
+        pass
+
+
+components.registerAdapter(FakeDeviceSession, FakeDeviceAvatar, session.ISession)
+
+
+
+@implementer(portal.IRealm)
+class FakeDeviceRealm:
+
+    def __init__(self, device):
+        self.device = device
+
+    def requestAvatar(self, avatar_id, mind, *requested_interfaces):
+        if interfaces.IConchUser in requested_interfaces:
+            return interfaces.IConchUser, FakeDeviceAvatar(avatar_id, self.device), lambda: None
+        raise NotImplementedError('No supported interfaces in avatar request')
+
+
+
+@implementer(checkers.ICredentialsChecker)
+class AnyCredentialsChecker:
+    """
+    Accepts any password and any public key (with a valid signature).
+    """
+
+    credentialInterfaces = (credentials.IUsernamePassword, credentials.ISSHPrivateKey)
+
+    def requestAvatarId(self, creds):
+        if credentials.ISSHPrivateKey.providedBy(creds):
+            if creds.signature is None:
+                return defer.fail(concherror.ValidPublicKey())
+            key = keys.Key.fromString(creds.blob)
+            if not key.verify(creds.signature, creds.sigData):
+                return defer.fail(crederror.UnauthorizedLogin('Invalid signature'))
+        return defer.succeed(creds.username)
+
+
+
+class FakeDeviceServer:
+
+    def __init__(self, device, host_key=None):
+        self.device   = device
+        self.host_key = host_key or generateKey()
+
+        self.factory = factory.SSHFactory()
+        self.factory.portal      = portal.Portal(FakeDeviceRealm(device), [ AnyCredentialsChecker() ])
+        self.factory.publicKeys  = { b'ssh-rsa': self.host_key.public() }
+        self.factory.privateKeys = { b'ssh-rsa': self.host_key }
+        self.factory.primes      = None # fixed group key exchange only
+
+        self.listening_port = None
+
+
+    @property
+    def fingerprint(self):
+        return self.host_key.fingerprint()
+
+
+    def listen(self, port=0, interface='127.0.0.1'):
+        self.listening_port = reactor.listenTCP(port, self.factory, interface=interface)
+        log.msg('Fake %s device listening on %s' % (self.device.dialect.__name__, self.listening_port.getHost()), system=LOG_SYSTEM)
+        return self.listening_port
+
+
+    def stopListening(self):
+        if self.listening_port is None:
+            return defer.succeed(None)
+        d = defer.maybeDeferred(self.listening_port.stopListening)
+        self.listening_port = None
+        return d
+
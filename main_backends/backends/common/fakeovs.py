@@ -0,0 +1,399 @@
+"""
+Fake Open vSwitch, served over OVSDB and OpenFlow.
+
+A stand-in for ovsdb-server and the OpenFlow side of ovs-vswitchd, so the OVS
+backend can be exercised and benchmarked without a switch. The OVSDB side
+supports the transact operations the backends use (select, update, mutate,
+comment) on the Open_vSwitch, Port and Interface tables, monitors with update
+notifications, and echo. cur_cfg follows next_cfg after a configurable
+latency, as when ovs-vswitchd has applied a change. The OpenFlow side speaks
+enough OpenFlow 1.4 for flow mods and bundles, and keeps a flow table keyed on
+(in_port, vlan, priority).
+
+Latencies can be set for OVSDB transactions, reconfiguration and bundle
+commits, and bundles containing a flow for one of fail_vlans are rejected.
+
+Usage:
+
+    switch = FakeSwitch( [ 'eth1', 'eth2' ], transact_latency=0.001 )
+    server = FakeOVSServer(switch)
+    ovsdb_port, openflow_port = server.listen()
+"""
+
+import json
+import uuid
+import struct
+
+from twisted.python import log
+from twisted.internet import defer, protocol, reactor, task
+
+from opennsa.backends.common import ovsdb, openflow
+
+
+LOG_SYSTEM = 'opennsa.FakeOVS'
+
+OFPET_BAD_REQUEST   = 1
+OFPET_BUNDLE_FAILED = 17
+OFPBFC_MSG_BAD_XID  = 9
+OFPBFC_MSG_FAILED   = 10
+
+
+
+class FakeSwitch:
+    """
+    State of the emulated switch, shared by all connections to it.
+    """
+
+    def __init__(self, ports, transact_latency=0, cfg_latency=0, commit_latency=0, fail_vlans=None, clock=reactor):
+        self.transact_latency = transact_latency
+        self.cfg_latency      = cfg_latency
+        self.commit_latency   = commit_latency
+        self.fail_vlans       = set(fail_vlans or [])
+        self.clock            = clock
+
+        self.tables = {
+            'Open_vSwitch'  : { str(uuid.uuid4()) : { 'next_cfg' : 0, 'cur_cfg' : 0 } },
+            'Port'          : {},
+            'Interface'     : {}
+        }
+        for ofport, name in enumerate(ports, 1):
+            self.tables['Port'][str(uuid.uuid4())]      = { 'name' : name, 'trunks' : ovsdb.fromSet([]) }
+            self.tables['Interface'][str(uuid.uuid4())] = { 'name' : name, 'ofport' : ofport }
+
+        self.flows = {}        # (in_port, vlan, priority) -> actions (raw instructions)
+        self.monitors = []     # (protocol, monitor id, table -> columns)
+
+        self.transactions = 0
+        self.bundles      = 0
+        self.flow_mods    = 0
+
+
+    def port(self, name):
+        for row in self.tables['Port'].values():
+            if row['name'] == name:
+                return row
+        return None
+
+    # -- OVSDB
+
+    def _matches(self, row, where):
+        for column, function, value in where:
+            if function != '==':
+                raise ValueError('Unsupported condition function %s' % function)
+            if row.get(column) != value:
+                return False
+        return True
+
+
+    def _mutate(self, row, column, mutator, value):
+        if mutator in ('insert', 'delete'):
+            current = ovsdb.toSet(row.get(column, ovsdb.fromSet([])))
+            values  = ovsdb.toSet(value)
+            row[column] = ovsdb.fromSet(current | values if mutator == 'insert' else current - values)
+        elif mutator == '+=':
+            row[column] += value
+        elif mutator == '-=':
+            row[column] -= value
+        else:
+            raise ValueError('Unsupported mutator %s' % mutator)
+
+
+    def transact(self, operations):
+        """
+        Run the operations, returning the results. Like ovsdb-server, the
+        transaction is aborted (and nothing changed) at the first error.
+        """
+        self.transactions += 1
+        changes = {} # table -> uuid -> old row
+        results = []
+
+        def changing(table, row_uuid, row):
+            changes.setdefault(table, {}).setdefault(row_uuid, dict(row))
+
+        try:
+            for op in operations:
+                kind = op['op']
+                if kind == 'comment':
+                    results.append( {} )
+                    continue
+
+                rows = self.tables.get(op['table'])
+                if rows is None:
+                    raise ValueError('No table %s' % op['table'])
+                selected = [ (u, r) for u, r in rows.items() if self._matches(r, op.get('where', [])) ]
+
+                if kind == 'select':
+                    columns = op.get('columns')
+                    results.append( { 'rows' : [ dict( (c, v) for c, v in r.items() if columns is None or c in columns ) for _, r in selected ] } )
+                elif kind == 'update':
+                    for u, r in selected:
+                        changing(op['table'], u, r)
+                        r.update(op['row'])
+                    results.append( { 'count' : len(selected) } )
+                elif kind == 'mutate':
+                    for u, r in selected:
+                        changing(op['table'], u, r)
+                        for column, mutator, value in op['mutations']:
+                            self._mutate(r, column, mutator, value)
+                    results.append( { 'count' : len(selected) } )
+                else:
+                    raise ValueError('Unsupported operation %s' % kind)
+
+        except (KeyError, ValueError) as e:
+            # roll back
+            for table, old_rows in changes.items():
+                for u, old_row in old_rows.items():
+                    self.tables[table][u] = old_row
+            results.append( { 'error' : 'syntax error', 'details' : str(e) } )
+            return results
+
+        self._notify(changes)
+        if 'Open_vSwitch' in changes:
+            # ovs-vswitchd applies the new configuration
+            self.clock.callLater(self.cfg_latency, self._reconfigured)
+        return results
+
+
+    def _reconfigured(self):
+        changes = {}
+        for u, row in self.tables['Open_vSwitch'].items():
+            if row['cur_cfg'] != row['next_cfg']:
+                changes.setdefault('Open_vSwitch', {})[u] = dict(row)
+                row['cur_cfg'] = row['next_cfg']
+        self._notify(changes)
+
+
+    def monitorContents(self, requests):
+        updates = {}
+        for table, request in requests.items():
+            columns = request.get('columns')
+            updates[table] = dict( (u, { 'new' : self._columns(r, columns) }) for u, r in self.tables.get(table, {}).items() )
+        return updates
+
+
+    def _columns(self, row, columns):
+        return dict( (c, v) for c, v in row.items() if columns is None or c in columns )
+
+
+    def _notify(self, changes):
+        for proto, monitor_id, requests in list(self.monitors):
+            updates = {}
+            for table, old_rows in changes.items():
+                if table not in requests:
+                    continue
+                columns = requests[table].get('columns')
+                for u, old_row in old_rows.items():
+                    old = self._columns(old_row, columns)
+                    new = self._columns(self.tables[table][u], columns)
+                    if old != new:
+                        updates.setdefault(table, {})[u] = { 'old' : old, 'new' : new }
+            if updates:
+                proto.sendMessage( { 'method' : 'update', 'params' : [ monitor_id, updates ], 'id' : None } )
+
+    # -- OpenFlow
+
+    def applyFlowMod(self, flow_mod):
+        command, priority, in_port, vlan, instructions = parseFlowMod(flow_mod)
+        key = (in_port, vlan, priority)
+        if command == openflow.FC_ADD:
+            self.flows[key] = instructions
+        elif command == openflow.FC_DELETE_STRICT:
+            self.flows.pop(key, None)
+        else:
+            raise ValueError('Unsupported flow mod command %i' % command)
+        self.flow_mods += 1
+
+
+
+def parseFlowMod(body):
+    """
+    Returns (command, priority, in_port, vlan, instructions) of a flow mod body.
+    """
+    fields = openflow.FLOW_MOD.unpack_from(body)
+    command, priority = fields[3], fields[6]
+
+    offset = openflow.FLOW_MOD.size
+    _, match_length = struct.unpack_from('!HH', body, offset)
+    in_port, vlan = None, None
+    position = offset + 4
+    while position < offset + match_length:
+        header, = struct.unpack_from('!I', body, position)
+        length = header & 0xff
+        if header == openflow.OXM_OF_IN_PORT:
+            in_port, = struct.unpack_from('!I', body, position + 4)
+        elif header == openflow.OXM_OF_VLAN_VID:
+            vlan = struct.unpack_from('!H', body, position + 4)[0] & ~openflow.OFPVID_PRESENT
+        position += 4 + length
+
+    instructions = body[offset + (match_length + 7) // 8 * 8:]
+    return command, priority, in_port, vlan, instructions
+
+
+
+class FakeOVSDBProtocol(protocol.Protocol):
+
+    def __init__(self, switch):
+        self.switch = switch
+        self.splitter = ovsdb.JSONStreamSplitter()
+
+
+    def dataReceived(self, data):
+        for message in self.splitter.feed(data):
+            self.requestReceived(message)
+
+
+    def sendMessage(self, message):
+        if self.transport is not None and self.transport.connected:
+            self.transport.write(json.dumps(message).encode('utf-8'))
+
+
+    def reply(self, request_id, result=None, error=None):
+        self.sendMessage( { 'result' : result, 'error' : error, 'id' : request_id } )
+
+
+    @defer.inlineCallbacks
+    def requestReceived(self, message):
+        method, params, request_id = message.get('method'), message.get('params', []), message.get('id')
+
+        if method is None:
+            return # reply to one of our echos
+
+        elif method == 'echo':
+            self.reply(request_id, params)
+
+        elif method == 'list_dbs':
+            self.reply(request_id, [ ovsdb.DEFAULT_DATABASE ])
+
+        elif method == 'transact':
+            if self.switch.transact_latency:
+                yield task.deferLater(self.switch.clock, self.switch.transact_latency, lambda : None)
+            self.reply(request_id, self.switch.transact(params[1:]))
+
+        elif method == 'monitor':
+            _, monitor_id, requests = params
+            self.switch.monitors.append( (self, monitor_id, requests) )
+            self.reply(request_id, self.switch.monitorContents(requests))
+
+        else:
+            self.reply(request_id, error='unknown method')
+
+
+    def connectionLost(self, reason):
+        self.switch.monitors[:] = [ m for m in self.switch.monitors if m[0] is not self ]
+
+
+
+class FakeOpenFlowProtocol(protocol.Protocol):
+
+    def __init__(self, switch):
+        self.switch = switch
+        self.buffer = b''
+        self.bundles = {} # bundle id -> [ flow mod body ]
+
+
+    def connectionMade(self):
+        self.transport.write(openflow.message(openflow.OFPT_HELLO, 0))
+
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while len(self.buffer) >= openflow.HEADER.size:
+            _, msg_type, length, xid = openflow.HEADER.unpack_from(self.buffer)
+            if len(self.buffer) < length:
+                break
+            body, self.buffer = self.buffer[openflow.HEADER.size:length], self.buffer[length:]
+            self.messageReceived(msg_type, xid, body)
+
+
+    def error(self, xid, error_type, error_code):
+        self.transport.write(openflow.message(openflow.OFPT_ERROR, xid, openflow.ERROR.pack(error_type, error_code)))
+
+
+    def messageReceived(self, msg_type, xid, body):
+
+        if msg_type == openflow.OFPT_ECHO_REQUEST:
+            self.transport.write(openflow.message(openflow.OFPT_ECHO_REPLY, xid, body))
+
+        elif msg_type == openflow.OFPT_BARRIER_REQUEST:
+            self.transport.write(openflow.message(openflow.OFPT_BARRIER_REPLY, xid))
+
+        elif msg_type == openflow.OFPT_FLOW_MOD:
+            self.switch.applyFlowMod(body)
+
+        elif msg_type == openflow.OFPT_BUNDLE_ADD_MESSAGE:
+            bundle_id, _, _ = openflow.BUNDLE_ADD.unpack_from(body)
+            inner = body[openflow.BUNDLE_ADD.size:]
+            _, inner_type, _, inner_xid = openflow.HEADER.unpack_from(inner)
+            if inner_xid != xid or inner_type != openflow.OFPT_FLOW_MOD:
+                self.bundles.pop(bundle_id, None)
+                self.error(xid, OFPET_BUNDLE_FAILED, OFPBFC_MSG_BAD_XID)
+                return
+            self.bundles.setdefault(bundle_id, []).append(inner[openflow.HEADER.size:])
+
+        elif msg_type == openflow.OFPT_BUNDLE_CONTROL:
+            bundle_id, control_type, flags = openflow.BUNDLE_CTRL.unpack(body)
+            if control_type == openflow.BCT_OPEN_REQUEST:
+                self.bundles[bundle_id] = []
+                self.transport.write(openflow.message(openflow.OFPT_BUNDLE_CONTROL, xid, openflow.BUNDLE_CTRL.pack(bundle_id, openflow.BCT_OPEN_REPLY, flags)))
+            elif control_type == openflow.BCT_COMMIT_REQUEST:
+                self.commitBundle(xid, bundle_id, flags)
+            else:
+                self.error(xid, OFPET_BUNDLE_FAILED, 0)
+
+        elif msg_type != openflow.OFPT_HELLO:
+            self.error(xid, OFPET_BAD_REQUEST, 1)
+
+
+    @defer.inlineCallbacks
+    def commitBundle(self, xid, bundle_id, flags):
+        flow_mods = self.bundles.pop(bundle_id, None)
+        if flow_mods is None:
+            self.error(xid, OFPET_BUNDLE_FAILED, 0)
+            return
+
+        if self.switch.commit_latency:
+            yield task.deferLater(self.switch.clock, self.switch.commit_latency, lambda : None)
+
+        if any( parseFlowMod(flow_mod)[3] in self.switch.fail_vlans for flow_mod in flow_mods ):
+            self.error(xid, OFPET_BUNDLE_FAILED, OFPBFC_MSG_FAILED)
+            return
+
+        for flow_mod in flow_mods:
+            self.switch.applyFlowMod(flow_mod)
+        self.switch.bundles += 1
+        self.transport.write(openflow.message(openflow.OFPT_BUNDLE_CONTROL, xid, openflow.BUNDLE_CTRL.pack(bundle_id, openflow.BCT_COMMIT_REPLY, flags)))
+
+
+
+class _SwitchFactory(protocol.Factory):
+
+    def __init__(self, protocol_class, switch):
+        self.protocol_class = protocol_class
+        self.switch = switch
+
+    def buildProtocol(self, addr):
+        return self.protocol_class(self.switch)
+
+
+
+class FakeOVSServer:
+
+    def __init__(self, switch):
+        self.switch = switch
+        self.listening_ports = []
+
+
+    def listen(self, ovsdb_port=0, openflow_port=0, interface='127.0.0.1'):
+        """
+        Start listening. Returns the OVSDB and OpenFlow port numbers.
+        """
+        self.listening_ports = [
+            reactor.listenTCP(ovsdb_port,    _SwitchFactory(FakeOVSDBProtocol, self.switch),    interface=interface),
+            reactor.listenTCP(openflow_port, _SwitchFactory(FakeOpenFlowProtocol, self.switch), interface=interface)
+        ]
+        log.msg('Fake OVS listening on %s' % ', '.join( str(p.getHost().port) for p in self.listening_ports ), system=LOG_SYSTEM)
+        return tuple( p.getHost().port for p in self.listening_ports )
+
+
+    def stopListening(self):
+        return defer.gatherResults( [ p.stopListening() for p in self.listening_ports ] )
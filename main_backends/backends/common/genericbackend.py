@@ -9,6 +9,15 @@ The use this module a connection manager has to be supplied. The methods
 setupLink(source_port, dest_port) and tearDown(source_port, dest_port) must be
 implemented in the manager. The methods should return a deferred.
 
+Optionally the manager can implement warmUp() and shutdown(), which are called
+when the backend service starts and stops. warmUp() can be used to establish
+connections to the device before the first activation. It should return a
+deferred, failures are logged but does not prevent the backend from starting.
+
+If the manager has the attribute wants_connection_record set to True,
+setupLink and teardownLink are also given the connection record (as the keyword
+argument connection), so the manager does not have to look it up.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
@@ -66,9 +75,15 @@ class GenericBackend(service.Service):
     def startService(self):
         service.Service.startService(self)
 
+        if hasattr(self.connection_manager, 'warmUp'):
+            d = self.connection_manager.warmUp()
+            d.addErrback(lambda err : log.msg('Connection warm-up failed: %s' % err.getErrorMessage(), system=self.log_system))
+
 
     def stopService(self):
         service.Service.stopService(self)
+        if hasattr(self.connection_manager, 'shutdown'):
+            self.connection_manager.shutdown()
         if self.restore_defer.called:
             self.scheduler.cancelAllCalls()
             return defer.succeed(None)
@@ -648,6 +663,12 @@ class GenericBackend(service.Service):
             log.err(e)
 
 
+    def _linkKeywords(self, conn):
+        if getattr(self.connection_manager, 'wants_connection_record', False):
+            return { 'connection': conn }
+        return {}
+
+
     @defer.inlineCallbacks
     def _doActivate(self, conn):
 
@@ -655,7 +676,7 @@ class GenericBackend(service.Service):
         dst_target = self.connection_manager.getTarget(conn.dest_port,   conn.dest_label)
         try:
             log.msg('Connection %s: Activating data plane...' % conn.connection_id, system=self.log_system)
-            yield self.connection_manager.setupLink(conn.connection_id, src_target, dst_target, conn.bandwidth)
+            yield self.connection_manager.setupLink(conn.connection_id, src_target, dst_target, conn.bandwidth, **self._linkKeywords(conn))
             log.msg('setupLink success: %s' % (conn.connection_id), system=self.log_system,
                     info={
                         'type':'backend',
@@ -741,7 +762,7 @@ class GenericBackend(service.Service):
         dst_target = self.connection_manager.getTarget(conn.dest_port,   conn.dest_label)
         try:
             log.msg('Connection %s: Deactivating data plane...' % conn.connection_id, system=self.log_system)
-            yield self.connection_manager.teardownLink(conn.connection_id, src_target, dst_target, conn.bandwidth)
+            yield self.connection_manager.teardownLink(conn.connection_id, src_target, dst_target, conn.bandwidth, **self._linkKeywords(conn))
             log.msg('teardownLink success: %s' % (conn.connection_id), system=self.log_system,
                     info={
                         'type':'backend',
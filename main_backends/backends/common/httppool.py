@@ -0,0 +1,168 @@
+"""
+Persistent HTTP client for backends talking to REST APIs.
+
+There is one client per endpoint (scheme, host and port), shared by all
+backends in the process. Connections are kept alive and reused between
+requests, so only the first request to an endpoint (or the first after an idle
+period) pays for the TCP and TLS handshakes. At most max_persistent_per_host
+requests are in flight per endpoint, further requests wait for one of them to
+finish, so every request can reuse a pooled connection.
+
+Backends take a client with acquireClient, and give it back with
+releaseClient when they shut down. The connections of an endpoint are closed
+when the last backend using it has released it.
+
+The interface is similar to opennsa.protocols.shared.httpclient.httpRequest:
+request returns a deferred with the response body, and fails with
+twisted.web.error.Error (with the body as response) for non-2xx responses.
+"""
+
+from io import BytesIO
+
+from urllib.parse import urlparse
+
+from twisted.python import log
+from twisted.internet import defer, reactor
+from twisted.internet.ssl import ClientContextFactory
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.error import Error as WebError
+
+
+LOG_SYSTEM = 'opennsa.HTTPPool'
+
+DEFAULT_MAX_PERSISTENT_PER_HOST = 4
+DEFAULT_IDLE_TIMEOUT            = 60  # seconds before an unused connection is closed
+DEFAULT_TIMEOUT                 = 60  # seconds, for a request
+
+
+
+class CachedContextFactory(ClientContextFactory):
+    """
+    Client TLS context without certificate verification, like the backends
+    used so far, but created once and shared by all connections of a client.
+    """
+
+    def __init__(self):
+        self.context = None
+
+    def getContext(self, hostname=None, port=None):
+        if self.context is None:
+            self.context = ClientContextFactory.getContext(self)
+        return self.context
+
+
+
+class HTTPClient:
+
+    def __init__(self, max_persistent_per_host=DEFAULT_MAX_PERSISTENT_PER_HOST, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 timeout=DEFAULT_TIMEOUT, ctx_factory=None, clock=reactor):
+
+        self.timeout = timeout
+        self.clock   = clock
+
+        self.pool = HTTPConnectionPool(clock, persistent=True)
+        self.pool.maxPersistentPerHost    = max_persistent_per_host
+        self.pool.cachedConnectionTimeout = idle_timeout
+
+        self.agent = Agent(clock, ctx_factory or CachedContextFactory(), pool=self.pool)
+        self.semaphore = defer.DeferredSemaphore(max_persistent_per_host)
+
+
+    def request(self, url, payload=None, headers=None, method=b'GET', timeout=None):
+        # requests beyond the pool size wait here, the timeout starts when the request is sent
+        return self.semaphore.run(self._request, url, payload, headers, method, timeout)
+
+
+    def _request(self, url, payload, headers, method, timeout):
+
+        if isinstance(url, str):
+            url = url.encode('utf-8')
+        if isinstance(method, str):
+            method = method.encode('ascii')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        http_headers = Headers()
+        for name, value in (headers or {}).items():
+            http_headers.addRawHeader(name.encode('latin-1') if isinstance(name, str) else name,
+                                      value.encode('latin-1') if isinstance(value, str) else value)
+
+        body_producer = FileBodyProducer(BytesIO(payload)) if payload else None
+
+        def gotResponse(response):
+            d = readBody(response)
+            if 200 <= response.code < 300:
+                return d
+            def httpError(body):
+                raise WebError(str(response.code).encode('ascii'), response.phrase, body)
+            d.addCallback(httpError)
+            return d
+
+        log.msg('%s %s' % (method.decode(), url.decode()), debug=True, system=LOG_SYSTEM)
+        d = self.agent.request(method, url, http_headers, body_producer)
+        d.addCallback(gotResponse)
+        d.addTimeout(timeout or self.timeout, self.clock)
+        return d
+
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+
+
+_clients = {} # endpoint -> client
+_users   = {} # endpoint -> number of backends which have acquired the client
+
+def endpoint(url):
+    if isinstance(url, bytes):
+        url = url.decode('utf-8')
+    u = urlparse(url)
+    port = u.port or (443 if u.scheme == 'https' else 80)
+    return u.scheme, u.hostname, port
+
+
+def getClient(url, **kwargs):
+    """
+    Return the shared client for the endpoint of url. The keyword arguments
+    are only used when the client is created.
+    """
+    key = endpoint(url)
+    if key not in _clients:
+        log.msg('Creating persistent HTTP client for %s://%s:%i' % key, debug=True, system=LOG_SYSTEM)
+        _clients[key] = HTTPClient(**kwargs)
+    return _clients[key]
+
+
+def acquireClient(url, **kwargs):
+    """
+    Return the shared client for the endpoint of url, and count the caller as
+    a user of it until it calls releaseClient.
+    """
+    client = getClient(url, **kwargs)
+    key = endpoint(url)
+    _users[key] = _users.get(key, 0) + 1
+    return client
+
+
+def releaseClient(url):
+    """
+    Give back a client taken with acquireClient. The connections are closed
+    when the last user of the endpoint has released it.
+    """
+    key = endpoint(url)
+    if _users.get(key, 0) > 1:
+        _users[key] -= 1
+        return defer.succeed(None)
+
+    _users.pop(key, None)
+    client = _clients.pop(key, None)
+    if client is None:
+        return defer.succeed(None)
+    log.msg('Closing persistent HTTP client for %s://%s:%i' % key, debug=True, system=LOG_SYSTEM)
+    return client.close()
+
+
+def httpRequest(url, payload=None, headers=None, method=b'GET', timeout=DEFAULT_TIMEOUT):
+    return getClient(url).request(url, payload, headers, method, timeout)
+
@@ -0,0 +1,306 @@
+"""
+Minimal OpenFlow 1.4 controller connection.
+
+Only what the backends need to program VLAN cross-connects: flow mods
+matching in_port and VLAN, with output and VLAN rewrite actions, applied
+atomically in a bundle. The switch is configured with this side as
+controller or, as with ovs-ofctl, accepts an active connection on its
+OpenFlow port (e.g., ovs-vsctl set-controller br0 ptcp:6653).
+
+A bundle is sent pipelined (open, the flow mods, commit) and completes in a
+single round-trip. If the switch rejects any of the messages, the bundle is
+discarded by the switch and the deferred fails with OpenFlowError.
+
+Usage:
+
+    client = OpenFlowClient(host)
+    yield client.bundle( [ flowMod(FC_ADD, 1, 100, [ outputAction(2) ]), ... ] )
+"""
+
+import struct
+
+from twisted.python import log
+from twisted.internet import defer, protocol, reactor, endpoints
+
+
+LOG_SYSTEM = 'opennsa.OpenFlow'
+
+DEFAULT_PORT    = 6653
+REQUEST_TIMEOUT = 30 # seconds
+
+OFP_VERSION = 0x05 # OpenFlow 1.4
+
+# message types
+OFPT_HELLO              = 0
+OFPT_ERROR              = 1
+OFPT_ECHO_REQUEST       = 2
+OFPT_ECHO_REPLY         = 3
+OFPT_FLOW_MOD           = 14
+OFPT_BARRIER_REQUEST    = 20
+OFPT_BARRIER_REPLY      = 21
+OFPT_BUNDLE_CONTROL     = 33
+OFPT_BUNDLE_ADD_MESSAGE = 34
+
+# flow mod commands
+FC_ADD           = 0
+FC_DELETE_STRICT = 4
+
+# bundle control types and flags
+BCT_OPEN_REQUEST    = 0
+BCT_OPEN_REPLY      = 1
+BCT_COMMIT_REQUEST  = 4
+BCT_COMMIT_REPLY    = 5
+BF_ATOMIC           = 1
+BF_ORDERED          = 2
+
+OFPP_ANY            = 0xffffffff
+OFPG_ANY            = 0xffffffff
+OFP_NO_BUFFER       = 0xffffffff
+OFPVID_PRESENT      = 0x1000
+
+OFPMT_OXM           = 1
+OFPIT_APPLY_ACTIONS = 4
+OFPAT_OUTPUT        = 0
+OFPAT_SET_FIELD     = 25
+
+OXM_OF_IN_PORT      = (0x8000 << 16) | (0 << 9) | 4
+OXM_OF_VLAN_VID     = (0x8000 << 16) | (6 << 9) | 2
+
+DEFAULT_PRIORITY    = 1000
+
+HEADER      = struct.Struct('!BBHI')            # version, type, length, xid
+FLOW_MOD    = struct.Struct('!QQBBHHHIIIHH')    # cookie ... importance
+BUNDLE_CTRL = struct.Struct('!IHH')             # bundle_id, type, flags
+BUNDLE_ADD  = struct.Struct('!IHH')             # bundle_id, pad, flags
+ERROR       = struct.Struct('!HH')              # type, code
+
+
+
+class OpenFlowError(Exception):
+    pass
+
+
+
+def _pad8(data):
+    return data + b'\0' * (-len(data) % 8)
+
+
+def _oxmVLAN(vlan):
+    return struct.pack('!IH', OXM_OF_VLAN_VID, OFPVID_PRESENT | vlan)
+
+
+def outputAction(port):
+    return struct.pack('!HHIH6x', OFPAT_OUTPUT, 16, port, 0)
+
+
+def setVLANAction(vlan):
+    oxm = _oxmVLAN(vlan)
+    length = (4 + len(oxm) + 7) // 8 * 8
+    return _pad8(struct.pack('!HH', OFPAT_SET_FIELD, length) + oxm)
+
+
+def flowMod(command, in_port, vlan, actions=(), priority=DEFAULT_PRIORITY, cookie=0):
+    """
+    Body of a flow mod matching in_port and VLAN. Actions are only used when
+    adding a flow; deletes are strict, on match and priority.
+    """
+    fields = struct.pack('!II', OXM_OF_IN_PORT, in_port) + _oxmVLAN(vlan)
+    match  = _pad8(struct.pack('!HH', OFPMT_OXM, 4 + len(fields)) + fields)
+
+    instructions = b''
+    if command == FC_ADD:
+        action_data  = b''.join(actions)
+        instructions = struct.pack('!HH4x', OFPIT_APPLY_ACTIONS, 8 + len(action_data)) + action_data
+
+    body = FLOW_MOD.pack(cookie, 0, 0, command, 0, 0, priority, OFP_NO_BUFFER, OFPP_ANY, OFPG_ANY, 0, 0)
+    return body + match + instructions
+
+
+def message(msg_type, xid, body=b''):
+    return HEADER.pack(OFP_VERSION, msg_type, HEADER.size + len(body), xid) + body
+
+
+
+class _Request:
+    # a request spanning one or more messages, completed by the reply to the last one
+
+    def __init__(self, xids, canceller=None):
+        self.xids = xids
+        self.deferred = defer.Deferred(canceller)
+
+
+
+class OpenFlowProtocol(protocol.Protocol):
+
+    def __init__(self):
+        self.buffer = b''
+        self.next_xid = 1
+        self.next_bundle_id = 1
+        self.pending = {} # xid -> _Request
+        self.connected = False
+        self.hello = defer.Deferred()
+
+
+    def connectionMade(self):
+        self.connected = True
+        self.transport.write(message(OFPT_HELLO, self._xid()))
+
+
+    def connectionLost(self, reason):
+        self.connected = False
+        if not self.hello.called:
+            self.hello.errback(OpenFlowError('Connection closed before hello: %s' % reason.getErrorMessage()))
+        requests = set(self.pending.values())
+        self.pending = {}
+        for request in requests:
+            request.deferred.errback(OpenFlowError('OpenFlow connection lost: %s' % reason.getErrorMessage()))
+
+
+    def _xid(self):
+        xid = self.next_xid
+        self.next_xid = (self.next_xid + 1) & 0xffffffff or 1
+        return xid
+
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while len(self.buffer) >= HEADER.size:
+            version, msg_type, length, xid = HEADER.unpack_from(self.buffer)
+            if len(self.buffer) < length:
+                break
+            body, self.buffer = self.buffer[HEADER.size:length], self.buffer[length:]
+            self.messageReceived(version, msg_type, xid, body)
+
+
+    def messageReceived(self, version, msg_type, xid, body):
+
+        if msg_type == OFPT_HELLO:
+            if self.hello.called:
+                return
+            if version < OFP_VERSION:
+                self.hello.errback(OpenFlowError('Switch does not support OpenFlow 1.4 (version %i)' % version))
+                self.transport.loseConnection()
+            else:
+                self.hello.callback(self)
+
+        elif msg_type == OFPT_ECHO_REQUEST:
+            self.transport.write(message(OFPT_ECHO_REPLY, xid, body))
+
+        elif msg_type == OFPT_ERROR:
+            request = self.pending.get(xid)
+            error_type, error_code = ERROR.unpack_from(body) if len(body) >= ERROR.size else (None, None)
+            if request is None:
+                log.msg('OpenFlow error (type %s, code %s) for unknown xid %i' % (error_type, error_code, xid), debug=True, system=LOG_SYSTEM)
+                return
+            for x in request.xids:
+                self.pending.pop(x, None)
+            request.deferred.errback(OpenFlowError('Switch rejected request (error type %s, code %s)' % (error_type, error_code)))
+
+        else:
+            request = self.pending.pop(xid, None)
+            if request is not None and xid == request.xids[-1]:
+                for x in request.xids:
+                    self.pending.pop(x, None)
+                request.deferred.callback(body)
+
+
+    def _send(self, messages):
+        # messages is a list of (xid, type, body), the request completes with the reply to the last
+        xids = [ xid for xid, _, _ in messages ]
+
+        def cancel(_):
+            for xid in xids:
+                self.pending.pop(xid, None)
+
+        request = _Request(xids, cancel)
+        for xid in xids:
+            self.pending[xid] = request
+        self.transport.write( b''.join( message(msg_type, xid, body) for xid, msg_type, body in messages ) )
+        request.deferred.addTimeout(REQUEST_TIMEOUT, reactor)
+        return request.deferred
+
+
+    def barrier(self):
+        return self._send( [ (self._xid(), OFPT_BARRIER_REQUEST, b'') ] )
+
+
+    def bundle(self, flow_mods, flags=BF_ATOMIC | BF_ORDERED):
+        bundle_id = self.next_bundle_id
+        self.next_bundle_id += 1
+
+        messages = [ (self._xid(), OFPT_BUNDLE_CONTROL, BUNDLE_CTRL.pack(bundle_id, BCT_OPEN_REQUEST, flags)) ]
+        for flow_mod in flow_mods:
+            # the inner message must have the xid of the add message
+            xid = self._xid()
+            messages.append( (xid, OFPT_BUNDLE_ADD_MESSAGE, BUNDLE_ADD.pack(bundle_id, 0, flags) + message(OFPT_FLOW_MOD, xid, flow_mod)) )
+        messages.append( (self._xid(), OFPT_BUNDLE_CONTROL, BUNDLE_CTRL.pack(bundle_id, BCT_COMMIT_REQUEST, flags)) )
+        return self._send(messages)
+
+
+
+class OpenFlowClientFactory(protocol.ClientFactory):
+
+    protocol = OpenFlowProtocol
+
+
+
+class OpenFlowClient:
+    """
+    Keeps one OpenFlow connection to a switch, and reconnects when it has been
+    lost.
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, log_system=LOG_SYSTEM):
+        self.host = host
+        self.port = port
+        self.log_system = log_system
+
+        self.proto = None
+        self.connect_waiters = None # list of deferreds while connecting
+
+
+    def getProtocol(self):
+        if self.proto is not None and self.proto.connected:
+            return defer.succeed(self.proto)
+
+        d = defer.Deferred()
+        if self.connect_waiters is None:
+            self.connect_waiters = [ d ]
+            self._connect()
+        else:
+            self.connect_waiters.append(d)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _connect(self):
+        try:
+            log.msg('Connecting to OpenFlow switch %s:%i' % (self.host, self.port), system=self.log_system)
+            point = endpoints.TCP4ClientEndpoint(reactor, self.host, self.port)
+            proto = yield point.connect(OpenFlowClientFactory())
+            yield proto.hello
+            self.proto = proto
+        except Exception as e:
+            log.msg('Error connecting to OpenFlow switch %s:%i: %s' % (self.host, self.port, e), system=self.log_system)
+            waiters, self.connect_waiters = self.connect_waiters, None
+            for d in waiters:
+                d.errback(e)
+        else:
+            waiters, self.connect_waiters = self.connect_waiters, None
+            for d in waiters:
+                d.callback(proto)
+
+
+    @defer.inlineCallbacks
+    def bundle(self, flow_mods):
+        """
+        Apply the flow mods atomically, in order.
+        """
+        proto = yield self.getProtocol()
+        yield proto.bundle(flow_mods)
+
+
+    def close(self):
+        if self.proto is not None and self.proto.connected:
+            self.proto.transport.loseConnection()
+        self.proto = None
@@ -0,0 +1,324 @@
+"""
+OVSDB management protocol client (RFC 7047).
+
+Speaks JSON-RPC directly to an ovsdb-server over TCP (usually port 6640),
+instead of running ovs-vsctl on the switch. One connection is kept per
+client. When it is created, a monitor is set up for the configured tables,
+and the monitored rows are kept up to date from the update notifications, so
+changes made with transact can be confirmed with waitFor.
+
+Usage:
+
+    client = OVSDBClient(host, monitor_tables={ 'Port' : ['name', 'trunks'] })
+    results = yield client.transact( [ operation, ... ] )
+    yield client.waitFor(lambda tables: ...)
+"""
+
+import re
+import json
+import codecs
+
+from twisted.python import log
+from twisted.internet import defer, protocol, reactor, endpoints
+
+
+LOG_SYSTEM = 'opennsa.OVSDB'
+
+DEFAULT_PORT     = 6640
+DEFAULT_DATABASE = 'Open_vSwitch'
+REQUEST_TIMEOUT  = 30 # seconds
+CONFIRM_TIMEOUT  = 10 # seconds, for a change to show up in the monitor
+
+MONITOR_ID       = 'opennsa'
+
+
+
+class OVSDBError(Exception):
+    pass
+
+
+
+def toSet(value):
+    # OVSDB encodes sets with a single element as the element itself
+    if isinstance(value, list) and len(value) == 2 and value[0] == 'set':
+        return set(value[1])
+    return set( [ value ] )
+
+
+def fromSet(values):
+    return [ 'set', sorted(values) ]
+
+
+
+class JSONStreamSplitter:
+    """
+    Splits a stream of JSON messages sent back to back, without delimiters.
+    The nesting depth and whether the stream is inside a string are kept
+    between chunks, so each character is looked at once, and a message is
+    only decoded when its closing bracket has arrived.
+    """
+
+    TOKENS = re.compile(r'[{}\[\]"\\]')
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.parts = []     # pieces of the current incomplete message
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False # the last chunk ended with a backslash in a string
+
+
+    def feed(self, data):
+        """
+        Returns the messages completed by data. Raises ValueError if a
+        message is not valid JSON.
+        """
+        text = self.decoder.decode(data)
+        messages = []
+        start = 0 # start of the current message in text
+        skip = 0 if self.escaped else -1 # position of an escaped character
+        self.escaped = False
+
+        for match in self.TOKENS.finditer(text):
+            pos = match.start()
+            if pos == skip:
+                continue
+            token = match.group()
+            if self.in_string:
+                if token == '\\':
+                    skip = pos + 1
+                elif token == '"':
+                    self.in_string = False
+            elif token == '"':
+                self.in_string = True
+            elif token in '{[':
+                self.depth += 1
+            elif token in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(text[start:pos+1])
+                    message, self.parts = ''.join(self.parts), []
+                    start = pos + 1
+                    messages.append(json.loads(message))
+
+        self.escaped = skip == len(text)
+        if self.depth or self.in_string:
+            self.parts.append(text[start:])
+        return messages
+
+
+
+
+class OVSDBProtocol(protocol.Protocol):
+
+    def __init__(self):
+        self.splitter = JSONStreamSplitter()
+        self.next_id = 0
+        self.pending = {}         # request id -> deferred
+        self.update_handlers = {} # monitor id -> callable(table_updates)
+        self.connected = False
+
+
+    def connectionMade(self):
+        self.connected = True
+
+
+    def connectionLost(self, reason):
+        self.connected = False
+        pending, self.pending = self.pending, {}
+        for d in pending.values():
+            d.errback(OVSDBError('Connection to OVSDB server lost: %s' % reason.getErrorMessage()))
+
+
+    def dataReceived(self, data):
+        try:
+            messages = self.splitter.feed(data)
+        except ValueError as e:
+            log.msg('Invalid message from OVSDB server: %s' % e, system=LOG_SYSTEM)
+            self.transport.loseConnection()
+            return
+        for message in messages:
+            self.messageReceived(message)
+
+
+    def sendMessage(self, message):
+        self.transport.write(json.dumps(message).encode('utf-8'))
+
+
+    def messageReceived(self, message):
+        method = message.get('method')
+
+        if method == 'echo':
+            # keepalive from the server
+            self.sendMessage( { 'result' : message.get('params', []), 'error' : None, 'id' : message.get('id') } )
+
+        elif method == 'update':
+            monitor_id, table_updates = message['params']
+            handler = self.update_handlers.get(monitor_id)
+            if handler is not None:
+                handler(table_updates)
+
+        elif method is not None:
+            log.msg('Ignoring OVSDB %s request' % method, debug=True, system=LOG_SYSTEM)
+
+        else:
+            d = self.pending.pop(message.get('id'), None)
+            if d is None:
+                log.msg('OVSDB reply for unknown request %s' % message.get('id'), system=LOG_SYSTEM)
+            elif message.get('error') is not None:
+                d.errback(OVSDBError(message['error']))
+            else:
+                d.callback(message.get('result'))
+
+
+    def request(self, method, params):
+        request_id = self.next_id
+        self.next_id += 1
+
+        def cancel(_):
+            self.pending.pop(request_id, None)
+
+        d = defer.Deferred(cancel)
+        self.pending[request_id] = d
+        self.sendMessage( { 'method' : method, 'params' : params, 'id' : request_id } )
+        d.addTimeout(REQUEST_TIMEOUT, reactor)
+        return d
+
+
+    @defer.inlineCallbacks
+    def transact(self, database, operations):
+        """
+        Run the operations in one transaction. Returns the operation results,
+        or fails with OVSDBError if the transaction (or any operation) failed.
+        """
+        results = yield self.request('transact', [ database ] + list(operations))
+        for result in results:
+            if result and 'error' in result:
+                raise OVSDBError('%s: %s' % (result['error'], result.get('details', '')))
+        defer.returnValue(results)
+
+
+    @defer.inlineCallbacks
+    def monitor(self, database, monitor_id, requests, handler):
+        """
+        Start a monitor. handler is called with the initial contents, and then
+        with the table updates of each change.
+        """
+        self.update_handlers[monitor_id] = handler
+        table_updates = yield self.request('monitor', [ database, monitor_id, requests ])
+        handler(table_updates)
+
+
+
+class OVSDBClientFactory(protocol.ClientFactory):
+
+    protocol = OVSDBProtocol
+
+
+
+class OVSDBClient:
+
+    def __init__(self, host, port=DEFAULT_PORT, database=DEFAULT_DATABASE, monitor_tables=None, log_system=LOG_SYSTEM):
+        """
+        monitor_tables is a dict with table name as key and the list of
+        columns to monitor as value.
+        """
+        self.host = host
+        self.port = port
+        self.database = database
+        self.monitor_tables = monitor_tables or {}
+        self.log_system = log_system
+
+        self.proto = None
+        self.connect_waiters = None # list of deferreds while connecting
+        self.tables = {}            # table -> uuid -> row (monitored columns)
+        self.waiters = []           # (predicate, deferred)
+
+
+    def getProtocol(self):
+        if self.proto is not None and self.proto.connected:
+            return defer.succeed(self.proto)
+
+        d = defer.Deferred()
+        if self.connect_waiters is None:
+            self.connect_waiters = [ d ]
+            self._connect()
+        else:
+            self.connect_waiters.append(d)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _connect(self):
+        try:
+            log.msg('Connecting to OVSDB server %s:%i' % (self.host, self.port), system=self.log_system)
+            point = endpoints.TCP4ClientEndpoint(reactor, self.host, self.port)
+            proto = yield point.connect(OVSDBClientFactory())
+            if self.monitor_tables:
+                self.tables = {}
+                requests = dict( [ (table, { 'columns' : columns }) for table, columns in self.monitor_tables.items() ] )
+                yield proto.monitor(self.database, MONITOR_ID, requests, self._tablesUpdated)
+            self.proto = proto
+        except Exception as e:
+            log.msg('Error connecting to OVSDB server %s:%i: %s' % (self.host, self.port, e), system=self.log_system)
+            waiters, self.connect_waiters = self.connect_waiters, None
+            for d in waiters:
+                d.errback(e)
+        else:
+            waiters, self.connect_waiters = self.connect_waiters, None
+            for d in waiters:
+                d.callback(proto)
+
+
+    def _tablesUpdated(self, table_updates):
+        for table, row_updates in table_updates.items():
+            rows = self.tables.setdefault(table, {})
+            for uuid, row_update in row_updates.items():
+                if row_update.get('new') is None:
+                    rows.pop(uuid, None)
+                else:
+                    rows[uuid] = row_update['new']
+
+        for waiter in list(self.waiters):
+            predicate, d = waiter
+            if predicate(self.tables):
+                self.waiters.remove(waiter)
+                d.callback(None)
+
+
+    @defer.inlineCallbacks
+    def transact(self, operations):
+        proto = yield self.getProtocol()
+        results = yield proto.transact(self.database, operations)
+        defer.returnValue(results)
+
+
+    def waitFor(self, predicate, timeout=CONFIRM_TIMEOUT):
+        """
+        Returns a deferred which fires when predicate, called with the
+        monitored tables, returns true.
+        """
+        if predicate(self.tables):
+            return defer.succeed(None)
+
+        def cancel(d):
+            self.waiters[:] = [ w for w in self.waiters if w[1] is not d ]
+
+        d = defer.Deferred(cancel)
+        self.waiters.append( (predicate, d) )
+        d.addTimeout(timeout, reactor)
+        return d
+
+
+    def findRow(self, table, column, value):
+        for row in self.tables.get(table, {}).values():
+            if row.get(column) == value:
+                return row
+        return None
+
+
+    def close(self):
+        if self.proto is not None and self.proto.connected:
+            self.proto.transport.loseConnection()
+        self.proto = None
+
@@ -2,14 +2,32 @@
 Basic SSH connectivity.
 """
 
+import os
+import time
+
 from twisted.python import log
-from twisted.internet import defer, protocol, reactor, endpoints
+from twisted.internet import defer, protocol, reactor, endpoints, task
 from twisted.conch import error as concherror
 from twisted.conch.ssh import transport, keys, userauth, connection, channel
 
 
 LOG_SYSTEM = 'opennsa.SSH'
 
+# optional backend configuration for connection warm-up, see SSHConnectionCache
+CONFIG_WARMUP            = 'ssh_warmup'             # 'true' to connect when the backend starts
+CONFIG_REFRESH_INTERVAL  = 'ssh_refresh_interval'   # seconds between idle checks, 0 disables
+
+DEFAULT_REFRESH_INTERVAL = 120 # seconds
+KEEPALIVE_TIMEOUT        = 10  # seconds
+KEEPALIVE_REQUEST        = b'keepalive@openssh.com'
+
+
+
+class ChannelClosedError(Exception):
+    """
+    Raised when a channel is closed while waiting for output from the device.
+    """
+
 
 
 class SSHClientTransport(transport.SSHClientTransport):
@@ -56,21 +74,46 @@ class SSHClientFactory(protocol.ClientFactory):
 
 
 
+class KeyFile:
+    """
+    SSH key loaded from a file.
+
+    The key is parsed once and kept, it is only parsed again if the file on
+    disk changes (modification time or size), so key rotation still works.
+    """
+
+    def __init__(self, path):
+        self.path  = path
+        self.key   = None
+        self.stamp = None
+
+
+    def getKey(self):
+        st = os.stat(self.path)
+        stamp = (st.st_mtime, st.st_size)
+        if self.key is None or stamp != self.stamp:
+            self.key   = keys.Key.fromFile(self.path)
+            self.stamp = stamp
+            log.msg('Loaded SSH key %s' % self.path, debug=True, system=LOG_SYSTEM)
+        return self.key
+
+
+
 class KeyUserAuthClient(userauth.SSHUserAuthClient):
 
-    def __init__(self, user, connection, public_key_path, private_key_path):
+    def __init__(self, user, connection, public_key_file, private_key_file):
         userauth.SSHUserAuthClient.__init__(self, user, connection)
-        self.public_key_path  = public_key_path
-        self.private_key_path = private_key_path
+        self.public_key_file  = public_key_file
+        self.private_key_file = private_key_file
 
     def getPassword(self, prompt=None):
         return # this says we won't do password authentication
 
     def getPublicKey(self):
-        return keys.Key.fromFile(self.public_key_path)
+        return self.public_key_file.getKey()
 
     def getPrivateKey(self):
-        return defer.succeed( keys.Key.fromFile(self.private_key_path) )
+        return defer.succeed( self.private_key_file.getKey() )
 
 
 
@@ -110,6 +153,11 @@ class SSHChannel(channel.SSHChannel):
         log.msg('SSH channel open.', debug=True, system=LOG_SYSTEM)
 
 
+    def openFailed(self, reason):
+        log.msg('SSH channel open failed: %s' % reason, debug=True, system=LOG_SYSTEM)
+        self.channel_open.errback(reason)
+
+
     def request_exit_status(self, data):
         if data and len(data) != 4:
             log.msg('Exit status data: %s' % data, system=LOG_SYSTEM)
@@ -141,6 +189,10 @@ class SSHConnectionCreator:
         self.private_key_path = private_key_path
         self.password         = password
 
+        # keys are parsed once per creator, and not for every connection
+        self.public_key_file  = KeyFile(public_key_path)  if public_key_path  else None
+        self.private_key_file = KeyFile(private_key_path) if private_key_path else None
+
 
     def createTCPConnection(self):
         # set up base connection and verify host
@@ -166,8 +218,8 @@ class SSHConnectionCreator:
 
         def gotTCPConnection(proto):
             ssh_connection = SSHConnection()
-            if self.public_key_path and self.private_key_path:
-                proto.requestService(KeyUserAuthClient(self.username, ssh_connection, self.public_key_path, self.private_key_path))
+            if self.public_key_file and self.private_key_file:
+                proto.requestService(KeyUserAuthClient(self.username, ssh_connection, self.public_key_file, self.private_key_file))
             elif self.password:
                 proto.requestService(PasswordUserAuthClient(self.username, ssh_connection, self.password))
             else:
@@ -179,3 +231,171 @@ class SSHConnectionCreator:
         d.addCallback(gotTCPConnection)
         return d
 
+
+
+
+
+def warmUpOptions(cfg):
+    """
+    Extract warm-up options from a backend configuration.
+    Returns (warmup, refresh_interval).
+    """
+    warmup = cfg.get(CONFIG_WARMUP, 'false').lower() == 'true'
+    refresh_interval = int(cfg.get(CONFIG_REFRESH_INTERVAL, DEFAULT_REFRESH_INTERVAL))
+    return warmup, refresh_interval
+
+
+
+class SSHConnectionCache:
+    """
+    Keeps one SSH connection to a device and hands it out for reuse.
+
+    A new connection is only created when there is no live one. With warmUp()
+    the connection is created when the backend starts instead of in the first
+    activation. While warm, connections which have been idle for a refresh
+    interval are verified with a keepalive request, and recreated in the
+    background if they have been dropped.
+    """
+
+    def __init__(self, connection_creator, log_system=LOG_SYSTEM, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.connection_creator = connection_creator
+        self.log_system         = log_system
+        self.refresh_interval   = refresh_interval
+
+        self.ssh_connection = None
+        self.waiters        = None # list of deferreds while a connection is being created
+        self.last_used      = None
+        self.handshake_time = None # seconds, for the last created connection
+        self.refresh_call   = None
+
+
+    def isConnected(self):
+        return self.ssh_connection is not None and not self.ssh_connection.transport.factory.stopped
+
+
+    def getSSHConnection(self):
+        self.last_used = time.time()
+
+        if self.isConnected():
+            log.msg('Reusing SSH connection', debug=True, system=self.log_system)
+            return defer.succeed(self.ssh_connection)
+
+        d = defer.Deferred()
+        if self.waiters is None:
+            self.waiters = [ d ]
+            self._connect()
+        else:
+            self.waiters.append(d)
+        return d
+
+
+    def _connect(self):
+
+        start_time = time.time()
+
+        def connected(ssh_connection):
+            self.handshake_time = time.time() - start_time
+            # since creating a new connection should be uncommon, we log it
+            # this makes it possible to see if something fucks up and creates connections continuously
+            log.msg('SSH connection to %s created and cached (handshake %.3f seconds)' % (self.connection_creator.host, self.handshake_time), system=self.log_system)
+            self.ssh_connection = ssh_connection
+            waiters, self.waiters = self.waiters, None
+            for d in waiters:
+                d.callback(ssh_connection)
+
+        def connectFailed(err):
+            log.msg('Error creating SSH connection to %s: %s' % (self.connection_creator.host, err.getErrorMessage()), system=self.log_system)
+            waiters, self.waiters = self.waiters, None
+            for d in waiters:
+                d.errback(err)
+
+        self.ssh_connection = None
+        d = self.connection_creator.getSSHConnection()
+        d.addCallbacks(connected, connectFailed)
+
+
+    def verifyConnection(self):
+        """
+        Send a keepalive request over the cached connection.
+        Returns a deferred which fires with True if the connection is alive.
+        """
+        if not self.isConnected():
+            return defer.succeed(False)
+
+        ssh_connection = self.ssh_connection
+
+        def replied(_):
+            return True
+
+        def noReply(err):
+            if err.check(defer.TimeoutError, defer.CancelledError) or ssh_connection.transport.factory.stopped:
+                log.msg('SSH connection to %s did not answer keepalive, dropping it' % self.connection_creator.host, system=self.log_system)
+                ssh_connection.transport.loseConnection()
+                if self.ssh_connection is ssh_connection:
+                    self.ssh_connection = None
+                return False
+            return True # request rejected, but the peer answered, so it is alive
+
+        d = ssh_connection.sendGlobalRequest(KEEPALIVE_REQUEST, b'', wantReply=1)
+        d.addTimeout(KEEPALIVE_TIMEOUT, reactor)
+        d.addCallbacks(replied, noReply)
+        return d
+
+
+    def warmUp(self):
+        """
+        Create and verify the connection, and start the background refresh.
+        """
+        def connected(_):
+            return self.verifyConnection()
+
+        def verified(alive):
+            log.msg('SSH connection to %s warmed up (alive: %s, handshake %.3f seconds)' % (self.connection_creator.host, alive, self.handshake_time or 0), system=self.log_system)
+
+        if self.refresh_interval and self.refresh_call is None:
+            self.refresh_call = task.LoopingCall(self._refresh)
+            self.refresh_call.start(self.refresh_interval, now=False)
+
+        d = self.getSSHConnection()
+        d.addCallback(connected)
+        d.addCallback(verified)
+        return d
+
+
+    def _refresh(self):
+
+        def reconnectIfDead(alive):
+            if not alive:
+                return self.getSSHConnection()
+
+        def refreshFailed(err):
+            log.msg('Error refreshing SSH connection to %s: %s' % (self.connection_creator.host, err.getErrorMessage()), system=self.log_system)
+
+        if self.waiters is not None:
+            return # connection in progress
+
+        if self.isConnected():
+            if self.last_used is not None and time.time() - self.last_used < self.refresh_interval:
+                return # recently used, no need to check
+            d = self.verifyConnection()
+        else:
+            d = defer.succeed(False)
+
+        d.addCallback(reconnectIfDead)
+        d.addErrback(refreshFailed)
+
+
+    def dropConnection(self):
+        """
+        Close the cached connection, the next getSSHConnection creates a new one.
+        """
+        if self.isConnected():
+            self.ssh_connection.transport.loseConnection()
+        self.ssh_connection = None
+
+
+    def close(self):
+        if self.refresh_call is not None and self.refresh_call.running:
+            self.refresh_call.stop()
+        self.refresh_call = None
+        self.dropConnection()
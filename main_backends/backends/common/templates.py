@@ -0,0 +1,65 @@
+"""
+Payload templates for backends sending XML to REST APIs.
+
+Templates use the %-format syntax the backends already use, restricted to
+named fields with s or i conversion, e.g., %(service_name)s and %(vlan)i.
+A template is parsed once, when it is created, into a positional format
+string, so rendering is a single %-format of the (escaped) values. String
+values are XML escaped, so descriptions and similar user supplied values
+cannot break the payload. The result is bytes, ready to be used as HTTP body.
+"""
+
+import re
+
+
+FIELD = re.compile(r'%\((\w+)\)([si])')
+
+XML_SPECIAL = re.compile('[&<>"\']')
+
+
+
+class TemplateError(Exception):
+    pass
+
+
+
+def escapeXML(value):
+    # quotes are escaped as well, so values can be used in attributes
+    if XML_SPECIAL.search(value) is None:
+        return value
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&apos;')
+
+
+
+class XMLTemplate:
+
+    def __init__(self, template, encoding='utf-8'):
+        self.encoding = encoding
+        self.fields   = []  # (name, conversion), in order of appearance
+
+        parts = []
+        position = 0
+        for match in FIELD.finditer(template):
+            parts.append( self._literal(template[position:match.start()]) )
+            parts.append( '%' + match.group(2) )
+            self.fields.append( (match.group(1), match.group(2)) )
+            position = match.end()
+        parts.append( self._literal(template[position:]) )
+
+        self.format = ''.join(parts)
+        self.names = frozenset( name for name, _ in self.fields )
+
+
+    def _literal(self, text):
+        if '%' in text.replace('%%', ''):
+            raise TemplateError('Unsupported format specifier in template: %s' % text.strip()[:40])
+        return text
+
+
+    def render(self, values):
+        try:
+            args = tuple( values[name] if conversion == 'i' else escapeXML(str(values[name])) for name, conversion in self.fields )
+        except KeyError as e:
+            raise TemplateError('No value for template field %s' % e.args[0])
+        return (self.format % args).encode(self.encoding)
+
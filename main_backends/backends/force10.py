@@ -52,14 +52,23 @@ import random
 import os
 
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.conch.ssh import session
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import ssh, genericbackend
+from opennsa.backends.common import ssh, genericbackend, batcher
 
 LOG_SYSTEM = 'Force10'
 
+# writing the configuration is slow, so changes arriving within the window are
+# applied in one configure session and written once
+WRITE_BATCH_WINDOW = 0.5 # seconds
+
+WAIT_TIMEOUT = 60 # seconds, for the prompt after a command
+
+# FTOS prefixes rejected commands with these
+ERROR_MARKERS = ( b'% Error', b'% Invalid', b'% Incomplete' )
+
 
 
 COMMAND_ENABLE          = 'enable'
@@ -77,6 +86,11 @@ COMMAND_NO_INTERFACE    = 'no interface vlan %(vlan)i'
 
 
 
+class CommandError(Exception):
+    pass
+
+
+
 def _portToInterfaceVLAN(nrm_port):
 
     interface, vlan = nrm_port.rsplit('.')
@@ -98,10 +112,15 @@ def _createSetupCommands(source_nrm_port, dest_nrm_port):
     cmd_s_intf  = COMMAND_TAGGED            % { 'interface' : s_interface }
     cmd_d_intf  = COMMAND_TAGGED            % { 'interface' : d_interface }
 
-    commands = [ cmd_vlan, cmd_name, cmd_s_intf, cmd_d_intf, COMMAND_NO_SHUTDOWN, COMMAND_END ]
+    commands = [ cmd_vlan, cmd_name, cmd_s_intf, cmd_d_intf, COMMAND_NO_SHUTDOWN, COMMAND_EXIT ]
     return commands
 
 
+def _createRollbackCommands(source_nrm_port, dest_nrm_port):
+    # undoes a partially applied setup
+    return _createTeardownCommands(source_nrm_port, dest_nrm_port)
+
+
 def _createTeardownCommands(source_nrm_port, dest_nrm_port):
 
     _, s_vlan = _portToInterfaceVLAN(source_nrm_port)
@@ -111,139 +130,285 @@ def _createTeardownCommands(source_nrm_port, dest_nrm_port):
 
     cmd_no_intf = COMMAND_NO_INTERFACE % { 'vlan' : s_vlan }
 
-    commands = [ cmd_no_intf, COMMAND_END ]
+    commands = [ cmd_no_intf ]
     return commands
 
 
 
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
 
-        self.data = ''
+        self.data = b''
 
         self.wait_defer = None
         self.wait_data  = None
+        self.is_closed  = False
 
 
     @defer.inlineCallbacks
-    def sendCommands(self, commands, enable_password):
+    def openShell(self, enable_password):
+        """
+        Request a shell and enter enabled mode. The channel is left at the
+        enabled prompt, ready for sendFragments.
+        """
         LT = '\r' # line termination
 
-        try:
-            log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
-            term = os.environ.get('TERM', 'xterm')
-            winSize = (25,80,0,0)
-            ptyReqData = session.packRequest_pty_req(term, winSize, '')
-            yield self.conn.sendRequest(self, 'pty-req', ptyReqData, wantReply=1)
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
-            log.msg('Got shell', system=LOG_SYSTEM, debug=True)
+        log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
+        term = os.environ.get('TERM', 'xterm')
+        winSize = (25,80,0,0)
+        ptyReqData = session.packRequest_pty_req(term.encode(), winSize, b'')
+        yield self.conn.sendRequest(self, b'pty-req', ptyReqData, wantReply=1)
+        yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
+        log.msg('Got shell', system=LOG_SYSTEM, debug=True)
 
-            d = self.waitForData('>')
-            yield d
-            log.msg('Got shell ready', system=LOG_SYSTEM, debug=True)
+        d = self.waitForData(b'>', clear=False) # the prompt may already be here
+        yield d
+        log.msg('Got shell ready', system=LOG_SYSTEM, debug=True)
 
-            # so far so good
+        # so far so good
 
-            d = self.waitForData(':')
-            self.write(COMMAND_ENABLE + LT) # This one fails for some reason
-            yield d
-            log.msg('Got enable password prompt', system=LOG_SYSTEM, debug=True)
+        d = self.waitForData(b':')
+        self.write((COMMAND_ENABLE + LT).encode()) # This one fails for some reason
+        yield d
+        log.msg('Got enable password prompt', system=LOG_SYSTEM, debug=True)
 
-            d = self.waitForData('#')
-            self.write(enable_password + LT)
-            yield d
+        yield self.executeCommand(enable_password, b'#')
 
-            log.msg('Entered enabled mode', debug=True, system=LOG_SYSTEM)
+        log.msg('Entered enabled mode', debug=True, system=LOG_SYSTEM)
 
-            d = self.waitForData('#')
-            self.write(COMMAND_CONFIGURE + LT) # This one fails for some reason
-            yield d
 
+    @defer.inlineCallbacks
+    def sendFragments(self, fragments):
+        """
+        Configure the fragments, (commands, rollback commands) pairs, in order
+        in one configure session, and write the configuration once. Starts and
+        ends at the enabled prompt, so the channel can be used for the next
+        batch.
+
+        FTOS applies each command at once, so a fragment which is rejected is
+        undone with its rollback commands, and the fragments before it stay.
+        Fails with batcher.PartialCommitError, telling how many fragments were
+        applied.
+        """
+        applied = 0
+        try:
+            yield self.executeCommand(COMMAND_CONFIGURE)
             log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
 
-            for cmd in commands:
-                log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
-                d = self.waitForData('#')
-                self.write(cmd + LT)
-                yield d
+            for commands, rollback_commands in fragments:
+                try:
+                    for cmd in commands:
+                        log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
+                        yield self.executeCommand(cmd)
+                except CommandError as e:
+                    log.msg('Error sending commands: %s' % str(e), system=LOG_SYSTEM)
+                    yield self.executeCommand(COMMAND_END)
+                    if rollback_commands:
+                        yield self.rollback(rollback_commands)
+                    if applied:
+                        yield self.executeCommand(COMMAND_WRITE)
+                    raise batcher.PartialCommitError(applied, e)
+                applied += 1
+
+            yield self.executeCommand(COMMAND_END)
+
+        except batcher.PartialCommitError:
+            raise
+        except Exception as e:
+            # the session broke, what is applied so far stays in the running configuration
+            log.msg('Error sending commands: %s' % str(e), system=LOG_SYSTEM)
+            raise batcher.PartialCommitError(applied, e)
 
-            # Superfluous COMMAND_END has been removed by hopet
+        log.msg('Configuration done, writing configuration.', debug=True, system=LOG_SYSTEM)
+        yield self.executeCommand(COMMAND_WRITE)
+        log.msg('Commands successfully send', system=LOG_SYSTEM)
 
-            log.msg('Configuration done, writing configuration.', debug=True, system=LOG_SYSTEM)
-            d = self.waitForData('#')
-            self.write(COMMAND_WRITE + LT)
-            yield d
 
-            log.msg('Configuration written. Exiting.', debug=True, system=LOG_SYSTEM)
-            self.write(COMMAND_EXIT + LT)
-            # Waiting for the prompt removed by hopet - we could wait forever here! :(
+    @defer.inlineCallbacks
+    def rollback(self, commands):
+        # best effort, the failed fragment may not have created what is removed
+        yield self.executeCommand(COMMAND_CONFIGURE)
+        for cmd in commands:
+            try:
+                yield self.executeCommand(cmd)
+            except CommandError as e:
+                log.msg('Rollback: %s' % str(e), debug=True, system=LOG_SYSTEM)
+        yield self.executeCommand(COMMAND_END)
 
-        except Exception as e:
-            log.msg('Error sending commands: %s' % str(e))
-            raise e
 
-        log.msg('Commands successfully send', system=LOG_SYSTEM)
+    @defer.inlineCallbacks
+    def executeCommand(self, cmd, prompt=b'#'):
+        """
+        Send a command and wait for the prompt. Fails with CommandError if the
+        output before the prompt contains an FTOS error.
+        """
+        LT = '\r' # line termination
+        d = self.waitForData(prompt)
+        self.write((cmd + LT).encode())
+        output = yield d
+        for marker in ERROR_MARKERS:
+            if marker in output:
+                error_line = output[output.index(marker):].split(b'\n')[0].strip()
+                raise CommandError('Command "%s" failed: %s' % (cmd, error_line.decode(errors='replace')))
+        defer.returnValue(output)
+
+
+    def exitShell(self):
+        LT = '\r' # line termination
+        self.write((COMMAND_EXIT + LT).encode())
         self.sendEOF()
         self.closeIt()
 
 
-    def waitForData(self, data):
+    def closed(self):
+        self.is_closed = True
+        if self.wait_defer is not None:
+            d = self.wait_defer
+            self.wait_data  = None
+            self.wait_defer = None
+            d.errback(ssh.ChannelClosedError('Channel closed while waiting for data'))
+
+
+    def waitForData(self, data, clear=True):
+        if clear:
+            # anything received so far belongs to earlier commands
+            self.data = b''
+        elif data in self.data:
+            output, self.data = self.data, b''
+            return defer.succeed(output)
+
+        def cancel(d):
+            if self.wait_defer is d:
+                self.wait_data  = None
+                self.wait_defer = None
+
+        def timedOut(result, timeout):
+            # the session is in an unknown state
+            self.closeIt()
+            raise ssh.ChannelClosedError('No prompt (%s) within %s seconds' % (data.decode(), timeout))
+
         self.wait_data  = data
-        self.wait_defer = defer.Deferred()
+        self.wait_defer = defer.Deferred(cancel)
+        self.wait_defer.addTimeout(WAIT_TIMEOUT, reactor, onTimeoutCancel=timedOut)
         return self.wait_defer
 
 
     def dataReceived(self, data):
-        log.msg("DATA:" + data, system=LOG_SYSTEM, debug=True)
+        log.msg("DATA:" + data.decode(errors='replace'), system=LOG_SYSTEM, debug=True)
         if len(data) == 0:
             pass
         else:
             self.data += data
             if self.wait_data and self.wait_data in self.data:
                 d = self.wait_defer
-                self.data       = ''
+                output = self.data
+                self.data       = b''
                 self.wait_data  = None
                 self.wait_defer = None
-                d.callback(self)
+                d.callback(output)
 
 
 
 
 class Force10CommandSender:
 
-    def __init__(self, ssh_connection_creator, enable_password):
+    def __init__(self, ssh_connection_creator, enable_password, warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
 
-        self.ssh_connection_creator = ssh_connection_creator
+        self.ssh_connection_cache = ssh.SSHConnectionCache(ssh_connection_creator, LOG_SYSTEM, refresh_interval)
         self.enable_password = enable_password
+        self.warmup = warmup
+
+        self.channel = None
+        self.channel_waiters = None # list of deferreds while the channel is opened
+        # FTOS has no rollback, so a failed batch is not split and sent again
+        self.write_batcher = batcher.CommitBatcher(self._sendBatch, WRITE_BATCH_WINDOW, log_system=LOG_SYSTEM,
+                                                   on_timeout=self._closeChannel, split=False)
+
+
+    def warmUp(self):
+        if not self.warmup:
+            return defer.succeed(None)
+        d = self.ssh_connection_cache.warmUp()
+        d.addCallback(lambda _ : self._getChannel())
+        return d
+
+
+    def shutdown(self):
+        self._closeChannel()
+        self.ssh_connection_cache.close()
 
 
     @defer.inlineCallbacks
-    def sendCommands(self, commands):
+    def _getChannel(self):
 
         # Note: FTOS does not allow multiple channels in an SSH connection,
-        # so we open a connection for each request. Party like it is 1988.
-
-        # The "correct" solution for this would be to create a connection pool,
-        # but that won't happen just now.
+        # so one channel is kept open in enabled mode, and used for all changes.
+
+        if self.channel is None or self.channel.is_closed:
+            if self.channel_waiters is not None:
+                # being opened (e.g., by warm up), wait for it instead of opening a second one
+                d = defer.Deferred()
+                self.channel_waiters.append(d)
+                channel = yield d
+                defer.returnValue(channel)
+
+            self.channel_waiters = []
+            try:
+                ssh_connection = yield self.ssh_connection_cache.getSSHConnection()
+
+                channel = SSHChannel(conn=ssh_connection)
+                ssh_connection.openChannel(channel)
+                log.msg("Opening channel", system=LOG_SYSTEM, debug=True)
+
+                yield channel.channel_open
+                yield channel.openShell(self.enable_password)
+                log.msg("Enabled session ready", system=LOG_SYSTEM, debug=True)
+                self.channel = channel
+            except Exception as e:
+                waiters, self.channel_waiters = self.channel_waiters, None
+                for d in waiters:
+                    d.errback(e)
+                raise
+            else:
+                waiters, self.channel_waiters = self.channel_waiters, None
+                for d in waiters:
+                    d.callback(channel)
+
+        defer.returnValue(self.channel)
+
+
+    def _closeChannel(self):
+        if self.channel is not None and not self.channel.is_closed:
+            self.channel.exitShell()
+        self.channel = None
 
-        log.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
 
+    @defer.inlineCallbacks
+    def _sendBatch(self, fragments):
+        # the batcher only has one batch in flight, so the channel is not shared
+        channel = yield self._getChannel()
         try:
-            channel = SSHChannel(conn=ssh_connection)
-            ssh_connection.openChannel(channel)
-            log.msg("Opening channel", system=LOG_SYSTEM, debug=True)
+            yield channel.sendFragments(fragments)
+        except batcher.PartialCommitError as e:
+            if not isinstance(e.reason, CommandError):
+                # the session is in an unknown state, start over with a new one
+                self._closeChannel()
+            raise
+        except Exception:
+            self._closeChannel()
+            raise
 
-            yield channel.channel_open
-            log.msg("Channel open, sending commands", system=LOG_SYSTEM, debug=True)
-            yield channel.sendCommands(commands, self.enable_password)
 
-        finally:
-            ssh_connection.transport.loseConnection()
+    def sendCommands(self, commands, rollback_commands=None):
+        """
+        Apply the commands. rollback_commands undo them if the switch rejects
+        one of them part way.
+        """
+        return self.write_batcher.submit( (commands, rollback_commands) )
 
 
 
@@ -257,7 +422,7 @@ class Force10ConnectionManager:
         port             = cfg.get(config.FORCE10_PORT, 22)
         host_fingerprint = cfg[config.FORCE10_HOST_FINGERPRINT]
         user             = cfg[config.FORCE10_USER]
-
+        warmup, refresh_interval = ssh.warmUpOptions(cfg)
 
         if config.FORCE10_PASSWORD in cfg:
             password = cfg[config.FORCE10_PASSWORD]
@@ -269,7 +434,15 @@ class Force10ConnectionManager:
             ssh_connection_creator = ssh.SSHConnectionCreator(host, port, [ host_fingerprint ], user, ssh_public_key, ssh_private_key)
 
         # this will blow up when used with ssh keys
-        self.command_sender = Force10CommandSender(ssh_connection_creator, enable_password=password)
+        self.command_sender = Force10CommandSender(ssh_connection_creator, enable_password=password, warmup=warmup, refresh_interval=refresh_interval)
+
+
+    def warmUp(self):
+        return self.command_sender.warmUp()
+
+
+    def shutdown(self):
+        self.command_sender.shutdown()
 
 
     def getResource(self, port, label):
@@ -297,7 +470,8 @@ class Force10ConnectionManager:
             return pt
 
         commands = _createSetupCommands(source_target, dest_target)
-        d = self.command_sender.sendCommands(commands)
+        rollback_commands = _createRollbackCommands(source_target, dest_target)
+        d = self.command_sender.sendCommands(commands, rollback_commands)
         d.addCallback(linkUp)
         return d
 
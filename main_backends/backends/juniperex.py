@@ -68,12 +68,12 @@ def createDeleteCommands(source_nrm_port, dest_nrm_port, vlan):
 
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
 
-        self.line = ''
+        self.line = b''
 
         self.wait_defer = None
         self.wait_line  = None
@@ -84,9 +84,9 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+            yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
             d = self.waitForLine('>')
-            self.write(COMMAND_CONFIGURE + LT)
+            self.write((COMMAND_CONFIGURE + LT).encode())
             yield d
 
             log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
@@ -94,7 +94,7 @@ class SSHChannel(ssh.SSHChannel):
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
                 d = self.waitForLine('[edit]')
-                self.write(cmd + LT)
+                self.write((cmd + LT).encode())
                 yield d
 
             # commit commands, check for 'commit complete' as success
@@ -105,7 +105,7 @@ class SSHChannel(ssh.SSHChannel):
             #self.write('commit check' + LT)
 
             d = self.waitForLine('commit complete')
-            self.write(COMMAND_COMMIT + LT)
+            self.write((COMMAND_COMMIT + LT).encode())
             yield d
 
         except Exception as e:
@@ -139,48 +139,51 @@ class SSHChannel(ssh.SSHChannel):
             pass
         else:
             self.line += data
-            if '\n' in data:
-                lines = [ line.strip() for line in self.line.split('\n') if line.strip() ]
-                self.line = ''
+            if b'\n' in data:
+                # channel data is bytes, lines are matched as text. The last line
+                # is kept until it is complete, it is the prompt the next echo goes on
+                lines = self.line.split(b'\n')
+                self.line = lines.pop()
                 for l in lines:
-                    self.matchLine(l)
+                    l = l.decode('utf-8', 'replace').strip()
+                    if l:
+                        self.matchLine(l)
 
 
 
 class JuniperEXCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path,
+                 warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
 
         self.ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
+        self.ssh_connection_cache = ssh.SSHConnectionCache(self.ssh_connection_creator, LOG_SYSTEM, refresh_interval)
+        self.warmup = warmup
 
 
-    def _getSSHChannel(self):
+    def warmUp(self):
+        if not self.warmup:
+            return defer.succeed(None)
+        return self.ssh_connection_cache.warmUp()
+
+
+    def shutdown(self):
+        self.ssh_connection_cache.close()
 
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
+
+    def _getSSHChannel(self):
 
         def gotSSHConnection(ssh_connection):
             channel = SSHChannel(conn = ssh_connection)
             ssh_connection.openChannel(channel)
             return channel.channel_open
 
-        if self.ssh_connection and not self.ssh_connection.transport.factory.stopped:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
+        d = self.ssh_connection_cache.getSSHConnection()
+        d.addCallback(gotSSHConnection)
+        return d
 
 
     def _sendCommands(self, commands):
@@ -225,10 +228,19 @@ class JunosEXTarget(object):
 
 class JuniperEXConnectionManager:
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
+                 warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
 
         self.port_map = port_map
-        self.command_sender = JuniperEXCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
+        self.command_sender = JuniperEXCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, warmup, refresh_interval)
+
+
+    def warmUp(self):
+        return self.command_sender.warmUp()
+
+
+    def shutdown(self):
+        self.command_sender.shutdown()
 
 
     def getResource(self, port, label):
@@ -291,6 +303,7 @@ def JuniperEXBackend(network_name, nrm_ports, parent_requester, cfg):
     user             = cfg[config.JUNIPER_USER]
     ssh_public_key   = cfg[config.JUNIPER_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNIPER_SSH_PRIVATE_KEY]
+    warmup, refresh_interval = ssh.warmUpOptions(cfg)
 
-    cm = JuniperEXConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
+    cm = JuniperEXConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, warmup, refresh_interval)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
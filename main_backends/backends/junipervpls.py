@@ -252,37 +252,36 @@ class SSHChannel(ssh.SSHChannel):
 class JuniperVPLSCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path,
+                 warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
 
         self.ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
+        self.ssh_connection_cache = ssh.SSHConnectionCache(self.ssh_connection_creator, LOG_SYSTEM, refresh_interval)
+        self.warmup = warmup
 
 
-    def _getSSHChannel(self):
+    def warmUp(self):
+        if not self.warmup:
+            return defer.succeed(None)
+        return self.ssh_connection_cache.warmUp()
+
+
+    def shutdown(self):
+        self.ssh_connection_cache.close()
 
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
+
+    def _getSSHChannel(self):
 
         def gotSSHConnection(ssh_connection):
             channel = SSHChannel(conn = ssh_connection)
             ssh_connection.openChannel(channel)
             return channel.channel_open
 
-        if self.ssh_connection and not self.ssh_connection.transport.factory.stopped:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
+        d = self.ssh_connection_cache.getSSHConnection()
+        d.addCallback(gotSSHConnection)
+        return d
 
 
     def _sendCommands(self, commands):
@@ -336,13 +335,22 @@ class JunosUnitTarget(object):
 class JuniperVPLSConnectionManager:
 
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number,
+                 warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
 
         self.port_map = port_map
-        self.command_sender = JuniperVPLSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
+        self.command_sender = JuniperVPLSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, warmup, refresh_interval)
         self.as_number = as_number
 
 
+    def warmUp(self):
+        return self.command_sender.warmUp()
+
+
+    def shutdown(self):
+        self.command_sender.shutdown()
+
+
     def getResource(self, port, label):
         assert label is not None and label.type_ == cnt.ETHERNET_VLAN, 'Label must be vlan'
         device_port = self.port_map[port]
@@ -411,6 +419,7 @@ def JuniperVPLSBackend(network_name, nrm_ports, parent_requester, cfg):
     ssh_public_key   = cfg[config.JUNIPER_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNIPER_SSH_PRIVATE_KEY]
     as_number        = cfg[config.AS_NUMBER]
+    warmup, refresh_interval = ssh.warmUpOptions(cfg)
 
-    cm = JuniperVPLSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number)
+    cm = JuniperVPLSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number, warmup, refresh_interval)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
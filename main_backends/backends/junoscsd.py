@@ -18,15 +18,15 @@ routers=ROUTER1_NAME@ROUTER1_ID
 import base64
 import random
 import time
+from io import BytesIO
 
 from twisted.python import log
+from twisted.internet import defer
 from twisted.web.error import Error as WebError
-from twisted.internet.ssl import ClientContextFactory
 
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend
-from opennsa.protocols.shared import httpclient
+from opennsa.backends.common import genericbackend, httppool, templates
 
 from lxml import etree
 
@@ -38,7 +38,10 @@ URI_CREATE_ORDER="api/space/nsas/eline-ptp/service-management/service-orders/"
 URI_GET_SERVICES="api/space/nsas/eline-ptp/service-management/services"
 URI_DELETE_SERVICE="api/space/nsas/eline-ptp/service-management/services/%(service_id)s"
 
-ORDER_PAYLOAD = """
+CSD_NAMESPACE = 'services.schema.networkapi.jmp.juniper.net'
+NSMAP = {'a': CSD_NAMESPACE}
+
+ORDER_PAYLOAD_BASE = """
 <Data xmlns="services.schema.networkapi.jmp.juniper.net">
 <ServiceResource>
 	<ServiceOrder>
@@ -98,6 +101,8 @@ ORDER_PAYLOAD = """
 </Data>
 """
 
+ORDER_PAYLOAD = templates.XMLTemplate(ORDER_PAYLOAD_BASE)
+
 
 LOG_SYSTEM = 'JUNOS.CSD'
 
@@ -146,13 +151,27 @@ def createCSDPayload(connection_id, source_target, dest_target, service_def_id,
     intps['description'] = csd_descriptions + " " + source_target.router + "." + dest_target.router + "." + timestamp + " OpenNSA build"
     intps['vlan_a'] = source_target.vlan
     intps['vlan_b'] = dest_target.vlan
-    payload = ORDER_PAYLOAD % intps
-    log.msg("Payload created: \n {}".format(payload),debug=True,system=LOG_SYSTEM)
+    payload = ORDER_PAYLOAD.render(intps)
+    log.msg("Payload created: \n {}".format(payload.decode('utf-8')),debug=True,system=LOG_SYSTEM)
 
     return payload
 
 
 
+def _iterServices(data):
+    # streams through the services, so a lookup can stop at the first match
+    # instead of parsing the whole (possibly very long) service list
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    for _, service in etree.iterparse(BytesIO(data), events=('end',), tag='{%s}Service' % CSD_NAMESPACE):
+        name     = service.findtext('a:Common/a:Name', namespaces=NSMAP)
+        identity = service.findtext('a:Common/a:Identity', namespaces=NSMAP)
+        service.clear()
+        if name is not None and identity is not None:
+            yield name, identity
+
+
+
 def _extractErrorMessage(failure):
     # used to extract error messages from http requests
     if isinstance(failure.value, WebError):
@@ -161,11 +180,6 @@ def _extractErrorMessage(failure):
         return failure.getErrorMessage()
 
 
-class WebClientContextFactory(ClientContextFactory):
-    def getContext(self):
-        return ClientContextFactory.getContext(self)
-
-
 class CSDConnectionManager:
 
     def __init__(self, port_map, space_user, space_password, space_api_url, space_routers, csd_service_def, csd_customer_id, network_name, csd_descriptions):
@@ -178,6 +192,8 @@ class CSDConnectionManager:
         self.csd_service_def = csd_service_def
         self.csd_customer_id = csd_customer_id
         self.csd_descriptions = csd_descriptions
+        self.service_ids = {} # connection id -> service id
+        httppool.acquireClient(space_api_url)
     
 
     def getResource(self, port, label):
@@ -199,6 +215,15 @@ class CSDConnectionManager:
         return CSDTarget(router, interface, vlan)
 
 
+    def _lookupServiceId(self, data, connection_id):
+        # services passed on the way are indexed as well
+        for name, identity in _iterServices(data):
+            self.service_ids[name] = identity
+            if name == connection_id:
+                return identity
+        return None
+
+
     def createConnectionId(self, source_target, dest_target):
         return 'ON-' + str(random.randint(100000,999999))
 
@@ -224,11 +249,16 @@ class CSDConnectionManager:
     def setupLink(self, connection_id, source_target, dest_target, bandwidth):
         payload = createCSDPayload(connection_id, source_target, dest_target, self.csd_service_def, self.csd_customer_id, self.space_routers, self.csd_descriptions)
         headers = self._createHeaders()
-        contextFactory = WebClientContextFactory()
 
         def linkUp(data):
             log.msg('Link %s -> %s up' % (source_target, dest_target), system=LOG_SYSTEM)
             log.msg('Response: \n %s ' % (data),debug=True, system=LOG_SYSTEM)
+            try:
+                # record the service identity if the order response contains the service
+                if self._lookupServiceId(data, connection_id) is not None:
+                    log.msg('Service ID for %s: %s' % (connection_id, self.service_ids[connection_id]), debug=True, system=LOG_SYSTEM)
+            except etree.XMLSyntaxError:
+                pass
 
         def error(failure):
             log.msg('Error bringing up link %s -> %s' % (source_target, dest_target), system=LOG_SYSTEM)
@@ -236,7 +266,7 @@ class CSDConnectionManager:
             return failure
         
         spaceurl=self.space_api_url + URI_CREATE_ORDER  
-        d = httpclient.httpRequest(spaceurl, payload.encode(), headers, method=b'POST', timeout=CSD_TIMEOUT, ctx_factory=contextFactory)
+        d = httppool.httpRequest(spaceurl, payload, headers, method=b'POST', timeout=CSD_TIMEOUT)
         d.addCallbacks(linkUp, error)
         return d
 
@@ -245,8 +275,6 @@ class CSDConnectionManager:
         headers = {}
         headers["Accept"] = "*/*"
         headers["Authorization"] = self._createAuthzHeader()
-        serviceID = None
-        contextFactory = WebClientContextFactory()
 
         def linkDown(data):
             log.msg('Link %s -> %s down' % (source_target, dest_target), system=LOG_SYSTEM)
@@ -257,34 +285,37 @@ class CSDConnectionManager:
             log.msg('Message from Get Service ID: %s' % _extractErrorMessage(failure), system=LOG_SYSTEM)
             return failure
 
-        def doServiceDelete(data):
+        def doServiceDelete(serviceID):
             headers = {}
             #headers["Content-Type"] = "application/vnd.net.juniper.space.service-management.service-order+xml;version=2;charset=UTF-8"
             headers["Authorization"] = self._createAuthzHeader()
-            contextFactory = WebClientContextFactory()
-            serviceID = 0
-            nsmap={'a': 'services.schema.networkapi.jmp.juniper.net'}
-            services = etree.fromstring(data).xpath("/a:Data/a:ServiceResource/a:Service", namespaces=nsmap)
-            for service in services :
-                if service.xpath("a:Common/a:Name", namespaces=nsmap)[0].text == connection_id:
-                    serviceID = service.xpath("a:Common/a:Identity", namespaces=nsmap)[0].text
-            if serviceID is 0 :
+            if serviceID is None:
                 raise Exception("Can't find service ID for connection %s " % connection_id) 
             log.msg('Link %s -> %s Call for DELETE. Service ID: %s' % (source_target, dest_target, serviceID), system=LOG_SYSTEM)
             
             spaceurl=self.space_api_url + URI_DELETE_SERVICE % {'service_id': serviceID}
-            d = httpclient.httpRequest(spaceurl, b'', headers, method=b'DELETE', timeout=CSD_TIMEOUT, ctx_factory=contextFactory)
+            d = httppool.httpRequest(spaceurl, b'', headers, method=b'DELETE', timeout=CSD_TIMEOUT)
             return d
 
         def errorSerDel(failure):
             log.msg('Error bringing down link %s -> %s' % (source_target, dest_target), system=LOG_SYSTEM)
             log.msg('Message from Service delete: %s' % _extractErrorMessage(failure), system=LOG_SYSTEM)
+            # the index entry may be stale, look the service up again on retry
+            self.service_ids.pop(connection_id, None)
             return failure
 
-        spaceurl=self.space_api_url + URI_GET_SERVICES
-        # spaceurl = self.space_api_url + "api/space/nsas/eline-ptp/service-management/services/32440380"
-        res = httpclient.httpRequest(spaceurl, b'', headers, method=b'GET', timeout=CSD_TIMEOUT, ctx_factory=contextFactory)
+        def serviceDeleted(data):
+            self.service_ids.pop(connection_id, None)
+            return data
+
+        if connection_id in self.service_ids:
+            res = defer.succeed(self.service_ids[connection_id])
+        else:
+            spaceurl=self.space_api_url + URI_GET_SERVICES
+            res = httppool.httpRequest(spaceurl, b'', headers, method=b'GET', timeout=CSD_TIMEOUT)
+            res.addCallback(self._lookupServiceId, connection_id)
         res.addCallbacks(doServiceDelete, error)
+        res.addCallback(serviceDeleted)
         res.addCallbacks(linkDown, errorSerDel)
 
         
@@ -295,6 +326,10 @@ class CSDConnectionManager:
         return res
 
 
+    def shutdown(self):
+        return httppool.releaseClient(self.space_api_url)
+
+
 def JunosCSDBackend(network_name, nrm_ports, parent_requester, cfg): 
 
     name = 'CSD %s' % network_name
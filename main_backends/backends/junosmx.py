@@ -13,7 +13,7 @@ from twisted.python import log
 from twisted.internet import defer
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend, ssh
+from opennsa.backends.common import genericbackend, ssh, batcher
 
 
 
@@ -48,21 +48,31 @@ COMMAND_REMOTE_CONNECTIONS_INT = 'set protocols connections remote-interface-swi
 COMMAND_REMOTE_CONNECTIONS_TRANSMIT_LSP = 'set protocols connections remote-interface-switch %(connectionid)s transmit-lsp %(unique-id)s'
 COMMAND_REMOTE_CONNECTIONS_RECEIVE_LSP  = 'set protocols connections remote-interface-switch %(connectionid)s receive-lsp %(unique-id)s'
 
+COMMIT_ERROR_PREFIX         = 'error:'     # junos prefixes commit errors with this
+
+COMMIT_BATCH_WINDOW         = 0.5 # seconds, operations within the window are committed together
+
 LOG_SYSTEM = 'JUNOS'
 
 
 
+class CommitError(Exception):
+    pass
+
+
+
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
 
-        self.line = ''
+        self.line = b''
 
         self.wait_defer = None
         self.wait_line  = None
+        self.wait_error = None
 
 
     @defer.inlineCallbacks
@@ -70,10 +80,10 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+            yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
 
             d = self.waitForLine('[edit]')
-            self.write(COMMAND_CONFIGURE + LT)
+            self.write((COMMAND_CONFIGURE + LT).encode())
             yield d
 
             log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
@@ -81,31 +91,35 @@ class SSHChannel(ssh.SSHChannel):
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
                 d = self.waitForLine('[edit]')
-                self.write(cmd + LT)
+                self.write((cmd + LT).encode())
                 yield d
 
             # commit commands, check for 'commit complete' as success
-            # not quite sure how to handle failure here
+            # and a line starting with 'error:' as failure
 
             ## test stuff
             #d = self.waitForLine('[edit]')
             #self.write('commit check' + LT)
 
-            d = self.waitForLine('commit complete')
-            self.write(COMMAND_COMMIT + LT)
+            d = self.waitForLine('commit complete', COMMIT_ERROR_PREFIX)
+            self.write((COMMAND_COMMIT + LT).encode())
             yield d
 
         except Exception as e:
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
+        finally:
+            # closing the session discards any uncommitted changes in the private candidate
+            self.sendEOF()
+            self.closeIt()
+
         log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
-        self.sendEOF()
-        self.closeIt()
 
 
-    def waitForLine(self, line):
-        self.wait_line = line
+    def waitForLine(self, line, error_prefix=None):
+        self.wait_line  = line
+        self.wait_error = error_prefix
         self.wait_defer = defer.Deferred()
         return self.wait_defer
 
@@ -115,10 +129,15 @@ class SSHChannel(ssh.SSHChannel):
             if self.wait_line == line.strip():
                 d = self.wait_defer
                 self.wait_line  = None
+                self.wait_error = None
                 self.wait_defer = None
                 d.callback(self)
-            else:
-                pass
+            elif self.wait_error and line.strip().startswith(self.wait_error):
+                d = self.wait_defer
+                self.wait_line  = None
+                self.wait_error = None
+                self.wait_defer = None
+                d.errback(CommitError(line.strip()))
 
 
     def dataReceived(self, data):
@@ -126,11 +145,15 @@ class SSHChannel(ssh.SSHChannel):
             pass
         else:
             self.line += data
-            if '\n' in data:
-                lines = [ line.strip() for line in self.line.split('\n') if line.strip() ]
-                self.line = ''
+            if b'\n' in data:
+                # channel data is bytes, lines are matched as text. The last line
+                # is kept until it is complete, it is the prompt the next echo goes on
+                lines = self.line.split(b'\n')
+                self.line = lines.pop()
                 for l in lines:
-                    self.matchLine(l)
+                    l = l.decode('utf-8', 'replace').strip()
+                    if l:
+                        self.matchLine(l)
 
 
 
@@ -138,38 +161,38 @@ class SSHChannel(ssh.SSHChannel):
 class JUNOSCommandSender:
 
     def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path,
-            junos_routers,network_name):
+            junos_routers,network_name, warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
         self.ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
+        self.ssh_connection_cache = ssh.SSHConnectionCache(self.ssh_connection_creator, LOG_SYSTEM, refresh_interval)
+        self.warmup = warmup
         self.connection_lock = defer.DeferredLock()
+        self.commit_batcher = batcher.CommitBatcher(self._commitFragments, COMMIT_BATCH_WINDOW, log_system=LOG_SYSTEM)
         self.junos_routers = junos_routers
         self.network_name = network_name
 
-    def _getSSHChannel(self):
 
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
+    def warmUp(self):
+        if not self.warmup:
+            return defer.succeed(None)
+        return self.ssh_connection_cache.warmUp()
+
+
+    def shutdown(self):
+        self.ssh_connection_cache.close()
+
+
+    def _getSSHChannel(self):
 
         def gotSSHConnection(ssh_connection):
             channel = SSHChannel(conn = ssh_connection)
             ssh_connection.openChannel(channel)
             return channel.channel_open
 
-        if self.ssh_connection:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
+        d = self.ssh_connection_cache.getSSHConnection()
+        d.addCallback(gotSSHConnection)
+        return d
 
 
     @defer.inlineCallbacks
@@ -188,18 +211,24 @@ class JUNOSCommandSender:
             log.msg('Released ssh session lock', debug=True, system=LOG_SYSTEM)
 
 
+    def _commitFragments(self, fragments):
+        # one edit private / commit cycle for the commands of several operations
+        commands = [ cmd for fragment in fragments for cmd in fragment ]
+        return self._sendCommands(commands)
+
+
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
 
         cg = JUNOSCommandGenerator(connection_id,source_port,dest_port,self.junos_routers,self.network_name,bandwidth)
         commands = cg.generateActivateCommand() 
-        return self._sendCommands(commands)
+        return self.commit_batcher.submit(commands)
 
 
     def teardownLink(self, connection_id, source_port, dest_port, bandwidth):
 
         cg = JUNOSCommandGenerator(connection_id,source_port,dest_port,self.junos_routers,self.network_name,bandwidth)
         commands = cg.generateDeactivateCommand() 
-        return self._sendCommands(commands)
+        return self.commit_batcher.submit(commands)
 
 
 class JUNOSTarget(object):
@@ -226,11 +255,11 @@ class JUNOSTarget(object):
 class JUNOSConnectionManager:
 
     def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            junos_routers,network_name):
+            junos_routers,network_name, warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
         self.network_name = network_name
         self.port_map = port_map
         self.command_sender = JUNOSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-                junos_routers,network_name)
+                junos_routers,network_name, warmup, refresh_interval)
         self.junos_routers = junos_routers
         self.supportedLabelPairs = {
                 "mpls" : ['vlan','port'],
@@ -239,6 +268,14 @@ class JUNOSConnectionManager:
         }
 
 
+    def warmUp(self):
+        return self.command_sender.warmUp()
+
+
+    def shutdown(self):
+        self.command_sender.shutdown()
+
+
     def getResource(self, port, label):
         assert label is None or label.type_ in (cnt.MPLS, cnt.ETHERNET_VLAN), 'Label must be None or VLAN or MPLS'
         val = "" if label is None else str(label.labelValue())
@@ -300,6 +337,7 @@ def JUNOSMXBackend(network_name, nrm_ports , parent_requester, cfg):
     ssh_public_key   = cfg[config.JUNOS_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNOS_SSH_PRIVATE_KEY]
     junos_routers_c    =  cfg[config.JUNOS_ROUTERS].split()
+    warmup, refresh_interval = ssh.warmUpOptions(cfg)
     junos_routers = dict()
     log.msg("Loaded JUNOS backend with routers:")
     for g in junos_routers_c:
@@ -307,7 +345,7 @@ def JUNOSMXBackend(network_name, nrm_ports , parent_requester, cfg):
         log.msg("Network: %s loopback: %s" % (r,l))
         junos_routers[r] = l
     cm = JUNOSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            junos_routers,network_name)
+            junos_routers,network_name, warmup, refresh_interval)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
 
 
@@ -15,173 +15,263 @@ TODO: describe the expected configuration
 """
 
 import random
+import time
 
-from twisted.python import log
-from twisted.internet import defer
+from twisted.python import log, threadpool
+from twisted.internet import defer, reactor, threads
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend, ssh
+from opennsa.backends.common import genericbackend, ssh, batcher
 
 from jnpr.junos import Device
 from jnpr.junos.utils.config import Config
 from jnpr.junos.exception import *
 from lxml import etree
+from lxml.builder import E
+
+# Configuration for Junos, as lxml element factories. The elements of one
+# operation are merged into a single configuration tree with mergeConfiguration.
+
+def interfacePort(port, description):
+    return E.interfaces(
+        E.interface(
+            E.name(port),
+            E.encapsulation('ethernet-ccc'),
+            E.mtu('9000'),
+            E.unit(
+                E.name('0'),
+                E.description(description),
+                E.family(E.ccc()))))
+
+def interfaceVlan(port, vlan, description):
+    return E.interfaces(
+        E.interface(
+            E.name(port),
+            E.unit(
+                E.name(str(vlan)),
+                E.description(description),
+                E.encapsulation('vlan-ccc'),
+                E('vlan-id', str(vlan)),
+                E('input-vlan-map', E.pop()),
+                E('output-vlan-map', E.push()))))
+
+def interfaceSwitch(switch, interface, subinterface):
+    return E.protocols(
+        E.connections(
+            E('interface-switch',
+                E.name(switch),
+                E.interface(E.name('%s.%s' % (interface, subinterface))))))
+
+def l2Circuit(vc_id_prefix, remote_ip, port, unique_id, description):
+    return E.protocols(
+        E.l2circuit(
+            E.neighbor(
+                E.name(remote_ip),
+                E.interface(
+                    E.name(port),
+                    E('virtual-circuit-id', '%s%s' % (vc_id_prefix, unique_id)),
+                    E.description(description),
+                    E('no-control-word'),
+                    E('ignore-mtu-mismatch')))))
+
+def deleteInterfacePort(port):
+    return E.interfaces(
+        E.interface({'operation': 'delete'},
+            E.name(port)))
+
+def deleteInterfaceVlan(port, vlan):
+    return E.interfaces(
+        E.interface(
+            E.name(port),
+            E.unit({'operation': 'delete'},
+                E.name(str(vlan)))))
+
+def deleteInterfaceSwitch(switch):
+    return E.protocols(
+        E.connections(
+            E('interface-switch', {'operation': 'delete'},
+                E.name(switch))))
+
+def deleteL2Circuit(remote_ip, port):
+    return E.protocols(
+        E.l2circuit(
+            E.neighbor(
+                E.name(remote_ip),
+                E.interface({'operation': 'delete'},
+                    E.name(port)))))
+
+
+def _elementKey(element):
+    return element.tag, element.findtext('name'), element.get('operation')
+
+def _mergeElement(parent, element):
+    if len(element) == 0:
+        # leaf, only add it if it is not there already
+        if not any( _elementKey(e) == _elementKey(element) and e.text == element.text and len(e) == 0 for e in parent ):
+            parent.append(element)
+        return
+    for existing in parent:
+        if len(existing) > 0 and _elementKey(existing) == _elementKey(element):
+            for child in list(element):
+                if child.tag != 'name':
+                    _mergeElement(existing, child)
+            return
+    parent.append(element)
+
+def mergeConfiguration(elements):
+    """
+    Merge configuration elements into one configuration tree. Elements with the
+    same tag, name and operation are merged, so each interface, unit, etc. only
+    occurs once and the whole change can be loaded at once.
+    """
+    configuration = E.configuration()
+    for element in elements:
+        _mergeElement(configuration, element)
+    return configuration
+
+
+def interfaceFilter(units):
+    """
+    Subtree filter for checking a list of (interface, unit) with a single
+    get_config, the units are grouped by interface.
+    """
+    interfaces = {}
+    for interface, unit in units:
+        if interface not in interfaces:
+            interfaces[interface] = E.interface(E.name(interface))
+        if not any( u.findtext('name') == str(unit) for u in interfaces[interface].findall('unit') ):
+            interfaces[interface].append( E.unit(E.name(str(unit))) )
+    return E.interfaces(*interfaces.values())
 
-# Common commands for Junos
-
-INTERFACE_PORT = '''
-<interfaces>
-    <interface>
-        <name>%(port)s</name>
-            <encapsulation>ethernet-ccc</encapsulation>
-            <mtu>9000</mtu>
-            <unit>
-                <name>0</name>
-                <description>%(description)s</description>
-                <family>
-                    <ccc>
-                    </ccc>
-                </family>
-            </unit>
-    </interface>
-</interfaces>
-'''
-
-INTERFACE_PORT_PTRN = '<interfaces><interface><name>%(port)s</name><unit><name>0</name></unit></interface></interfaces>'
-
-INTERFACE_VLAN = '''
-<interfaces>
-    <interface>
-        <name>%(port)s</name>
-        <unit>
-            <name>%(vlan)s</name>
-            <description>%(description)s</description>
-            <encapsulation>vlan-ccc</encapsulation>
-            <vlan-id>%(vlan)s</vlan-id>
-            <input-vlan-map>
-                <pop/>
-            </input-vlan-map>
-            <output-vlan-map>
-                <push/>
-            </output-vlan-map>
-        </unit>
-    </interface>
-</interfaces>
-'''
-
-INTERFACE_VLAN_PTRN = '<interfaces><interface><name>%(port)s</name><unit><name>%(vlan)s</name></unit></interface></interfaces>'
-
-INT_SWITCH = '''
-<protocols>
-    <connections>
-        <interface-switch>
-            <name>%(switch)s</name>
-            <interface>
-                <name>%(interface)s.%(subinterface)s</name>
-            </interface>
-        </interface-switch>
-    </connections>
-</protocols>
-'''
-
-L2_CIRCUIT = lambda id : f'''
-<protocols>
-    <l2circuit>
-        <neighbor>
-            <name>%(remote_ip)s</name>
-            <interface>
-                <name>%(port)s</name>
-                <virtual-circuit-id>{id}%(unique-id)s</virtual-circuit-id>
-                <description>%(description)s</description>
-                <no-control-word/>
-                <ignore-mtu-mismatch/>
-            </interface>
-        </neighbor>
-    </l2circuit>
-</protocols>
-'''
-
-DEL_INTERFACE_PORT = '''
-<interfaces>
-    <interface operation="delete">
-        <name>%(port)s</name>
-    </interface>
-</interfaces>
-'''
-
-DEL_INTERFACE_VLAN = '''
-<interfaces>
-    <interface>
-        <name>%(port)s</name>
-        <unit operation="delete">
-            <name>%(vlan)s</name>
-        </unit>
-    </interface>
-</interfaces>
-'''
-
-
-DEL_INT_SWITCH = '''
-<protocols>
-    <connections>
-        <interface-switch operation="delete">
-            <name>%(switch)s</name>
-        </interface-switch>
-    </connections>
-</protocols>
-'''
-
-DEL_L2_CIRCUIT = '''
-<protocols>
-    <l2circuit>
-        <neighbor>
-            <name>%(remote_ip)s</name>
-            <interface operation="delete">
-                <name>%(port)s</name>
-            </interface>
-        </neighbor>
-    </l2circuit>
-</protocols>
-'''
 
 LOG_SYSTEM = 'Backend: JUNOS MX NETCONF: '
 
+NETCONF_LIVENESS_INTERVAL = 60 # seconds, a session idle for longer is checked before use
+
+COMMIT_BATCH_WINDOW = 0.5 # seconds, operations within the window are committed together
+
+# PyEZ calls are blocking, so they are run in a thread pool shared by all
+# JUNOS MX NETCONF backends. Each device only has one call running at a time.
+CONFIG_THREADPOOL_SIZE  = 'netconf_threadpool_size'
+DEFAULT_THREADPOOL_SIZE = 4
+
+_threadpool = None
+
+def getThreadPool(size=DEFAULT_THREADPOOL_SIZE):
+    global _threadpool
+    if _threadpool is None:
+        _threadpool = threadpool.ThreadPool(minthreads=1, maxthreads=size, name='junosmxnetconf')
+        reactor.callWhenRunning(_threadpool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', _threadpool.stop)
+    elif size > _threadpool.max:
+        _threadpool.adjustPoolsize(maxthreads=size)
+    return _threadpool
+
+
 class JUNOSCommandSender:
 
     def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path,
-            junos_routers,network_name, enableqos, descriptions, vc_id_prefix):
+            junos_routers,network_name, enableqos, descriptions, vc_id_prefix, threadpool_size=DEFAULT_THREADPOOL_SIZE):
         self.netconf_device = Device(host=host, port=port, user=user, ssh_private_key_file=ssh_private_key_path)
         self.junos_routers = junos_routers
         self.network_name = network_name
         self.enableqos = enableqos
         self.descriptions = descriptions
         self.logsys = LOG_SYSTEM + network_name
-        self.sem = defer.DeferredSemaphore(1)
+        self.sem = defer.DeferredSemaphore(1) # one netconf call per device at a time
+        self.threadpool = getThreadPool(threadpool_size)
+        self.commit_batcher = batcher.CommitBatcher(self._commitFragments, COMMIT_BATCH_WINDOW, log_system=self.logsys,
+                                                    on_timeout=self._abortSession)
         self.vc_id_prefix = vc_id_prefix
+        self.last_used = None # time of last rpc on the netconf session
+
+    def _deferToThread(self, f, *args):
+        return threads.deferToThreadPool(reactor, self.threadpool, f, *args)
+
+    def shutdown(self):
+        return self.sem.run(self._deferToThread, self._closeSession)
+
+    def _openSession(self):
+        # the netconf session is kept open between operations, it is only
+        # (re)opened if it is not open or does not respond
+        if self.netconf_device.connected and time.time() - self.last_used > NETCONF_LIVENESS_INTERVAL:
+            try:
+                self.netconf_device.rpc.get_system_uptime_information()
+            except Exception as err:
+                log.msg('NETCONF session not alive, reopening :: {0}'.format(err), system=self.logsys)
+                self._closeSession()
+
+        if not self.netconf_device.connected:
+            log.msg('Opening NETCONF session...', system=self.logsys)
+            start_time = time.time()
+            self.netconf_device.open()
+            log.msg('NETCONF session opened in %.2f seconds' % (time.time() - start_time), system=self.logsys)
+
+        self.last_used = time.time()
+
+    def _closeSession(self):
+        try:
+            if self.netconf_device.connected:
+                self.netconf_device.close()
+        except Exception as err:
+            log.msg('Error closing NETCONF session :: {0}'.format(err), debug=True, system=self.logsys)
+
+    def _abortSession(self):
+        # called when a commit times out. The PyEZ call cannot be cancelled and
+        # still holds the semaphore, closing the session under it makes it fail.
+        # This runs in another pool thread, as the stuck one is still busy.
+        log.msg('Closing NETCONF session of timed out commit', system=self.logsys)
+        self._deferToThread(self._closeSession)
 
-    @defer.inlineCallbacks
     def _sendCommands(self, commands, patterns=[]):
-        yield self.sendCom(commands, patterns)
+        return self._deferToThread(self.sendCom, commands, patterns)
 
     @defer.inlineCallbacks
-    def setupLink(self, connection_id, source_port, dest_port, bandwidth):
-        conn = yield genericbackend.GenericBackendConnections.find(where=['connection_id = ?', connection_id], limit=1)
+    def _commitFragments(self, fragments):
+        # fragments are (commands, patterns) of several operations, committed at once
+        commands = [ command for fragment_commands, _ in fragments for command in fragment_commands ]
+        patterns = [ pattern for _, fragment_patterns in fragments for pattern in set(fragment_patterns) ]
+
+        # the semaphore is released when the thread returns, not when the batcher
+        # gives up on the commit, so a timed out call and the next batch never
+        # use the device at the same time. Cancelling d does not touch the thread.
+        yield self.sem.acquire()
+        td = self._sendCommands(commands, patterns)
+        td.addBoth(self._release)
+        d = defer.Deferred()
+        td.chainDeferred(d)
+        result = yield d
+        defer.returnValue(result)
+
+    def _release(self, result):
+        self.sem.release()
+        return result
+
+    def _getConnection(self, connection_id, connection):
+        # the generic backend passes the connection record, only look it up if it did not
+        if connection is not None:
+            return defer.succeed(connection)
+        return genericbackend.GenericBackendConnections.find(where=['connection_id = ?', connection_id], limit=1)
+
+    @defer.inlineCallbacks
+    def setupLink(self, connection_id, source_port, dest_port, bandwidth, connection=None):
+        conn = yield self._getConnection(connection_id, connection)
         args = vars(conn)
         descriptions = self.descriptions.format(**args)
         descriptions = self.cleanup_string(descriptions)
         cg = JUNOSCommandGenerator(connection_id,source_port,dest_port,self.junos_routers,self.network_name,bandwidth,self.enableqos,descriptions, vc_id_prefix=self.vc_id_prefix)
         commands, patterns = cg.generateActivateCommand() 
-        result = yield self.sem.run(self._sendCommands, commands, patterns)
+        result = yield self.commit_batcher.submit( (commands, patterns) )
         defer.returnValue(result)
 
     @defer.inlineCallbacks
-    def teardownLink(self, connection_id, source_port, dest_port, bandwidth):
-        conn = yield genericbackend.GenericBackendConnections.find(where=['connection_id = ?', connection_id], limit=1)
+    def teardownLink(self, connection_id, source_port, dest_port, bandwidth, connection=None):
+        conn = yield self._getConnection(connection_id, connection)
         args = vars(conn)
         descriptions = self.descriptions.format(**args)
         cg = JUNOSCommandGenerator(connection_id,source_port,dest_port,self.junos_routers,self.network_name,bandwidth,self.enableqos,descriptions, vc_id_prefix=self.vc_id_prefix)
         commands = cg.generateDeactivateCommand() 
-        result = yield self.sem.run(self._sendCommands, commands)
+        result = yield self.commit_batcher.submit( (commands, []) )
         defer.returnValue(result)
 
     def cleanup_string(self, str):
@@ -192,23 +282,26 @@ class JUNOSCommandSender:
     
     def sendCom(self, commands, patterns):
         try:
-            log.msg('Opening connection...', debug=True, system=self.logsys)
-            self.netconf_device.open()
+            self._openSession()
 
             if (len(patterns) > 0):
                 log.msg('Checking interfaces before config...', debug=True, system=self.logsys)
-                for pattern in patterns:
-                    int_config = self.netconf_device.rpc.get_config(filter_xml=pattern, options={'inherit':'inherit'})
-                    if (len(int_config) > 0):
-                        log.msg('--- ERROR: Something found on the given interface! Configuration canceled. :: %s' % (etree.tostring(int_config, encoding='unicode', pretty_print=True)), debug=True, system=self.logsys)
-                        raise Exception("Something found on the given interface! Configuration canceled.") 
-                        
+                if len(set(patterns)) < len(patterns):
+                    # two operations in a batch want the same unit, the batch is split and they are checked one at a time
+                    raise Exception("Same interface used by more than one operation. Configuration canceled.")
+                int_filter = interfaceFilter(patterns)
+                int_config = self.netconf_device.rpc.get_config(filter_xml=int_filter, options={'inherit':'inherit'})
+                if (len(int_config) > 0):
+                    units = [ '%s.%s' % (i.findtext('name'), u.findtext('name')) for i in int_config.iter('interface') for u in i.findall('unit') ]
+                    log.msg('--- ERROR: Something found on the given interface(s) %s! Configuration canceled. :: %s' % (', '.join(units), etree.tostring(int_config, encoding='unicode', pretty_print=True)), debug=True, system=self.logsys)
+                    raise Exception("Something found on the given interface! Configuration canceled.")
+
 
             with Config(self.netconf_device, mode='private') as dev_private:  # Lets go to edit private mode
-                
-                for command in commands:
-                    log.msg('--- Loading in configuration: %s' % (command), debug=True, system=self.logsys)
-                    res = dev_private.load(command)
+
+                configuration = mergeConfiguration(commands)
+                log.msg('--- Loading in configuration: %s' % (etree.tostring(configuration, encoding='unicode', pretty_print=True)), debug=True, system=self.logsys)
+                res = dev_private.load(configuration, format='xml')
                 
                 log.msg('--- Changes applied: \n %s' % (dev_private.diff()), debug=True, system=self.logsys)
                                 
@@ -219,7 +312,15 @@ class JUNOSCommandSender:
                 if coomit_check_result:
                     log.msg('Commiting config...', debug=True, system=self.logsys)
                     res = dev_private.commit(comment='OpenNSA_link_setup', timeout=90)
-
+                else:
+                    # fail so a batch is split and the bad operation found
+                    raise Exception("Commit check failed: {0}".format(coomit_check_result))
+
+        except (ConnectClosedError, RpcTimeoutError) as err:
+            # session state is unknown, start with a new one next time
+            log.msg("NETCONF session failed: {0}".format(err), system=self.logsys)
+            self._closeSession()
+            raise err
         except ConnectError as err:
             log.msg("Cannot connect to device: {0}".format(err), system=self.logsys)
             raise err
@@ -230,7 +331,7 @@ class JUNOSCommandSender:
             log.msg("Failed to send commands :: {0}".format(err), system=self.logsys)
             raise err
         finally:
-            self.netconf_device.close()
+            self.last_used = time.time()
 
 class JUNOSTarget(object):
 
@@ -254,12 +355,14 @@ class JUNOSTarget(object):
 
 class JUNOSConnectionManager:
 
+    wants_connection_record = True # descriptions are made from the connection record
+
     def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            junos_routers,network_name, enableqos, descriptions, vc_id_prefix):
+            junos_routers,network_name, enableqos, descriptions, vc_id_prefix, threadpool_size=DEFAULT_THREADPOOL_SIZE):
         self.network_name = network_name
         self.port_map = port_map
         self.command_sender = JUNOSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-                junos_routers,network_name, enableqos, descriptions, vc_id_prefix)
+                junos_routers,network_name, enableqos, descriptions, vc_id_prefix, threadpool_size)
         self.junos_routers = junos_routers
         self.logsys = LOG_SYSTEM + network_name
         self.supportedLabelPairs = {
@@ -268,6 +371,9 @@ class JUNOSConnectionManager:
                 "port" : ['vlan','mpls']
         }
 
+    def shutdown(self):
+        return self.command_sender.shutdown()
+
     def getResource(self, port, label):
         assert label is None or label.type_ in (cnt.MPLS, cnt.ETHERNET_VLAN), 'Label must be None or VLAN or MPLS'
         val = "" if label is None else str(label.labelValue())
@@ -286,17 +392,17 @@ class JUNOSConnectionManager:
     def canSwapLabel(self, label_type):
         return True
 
-    def setupLink(self, connection_id, source_target, dest_target, bandwidth):
+    def setupLink(self, connection_id, source_target, dest_target, bandwidth, connection=None):
         def linkUp(_):
             log.msg('Link %s -> %s up' % (source_target, dest_target), system=self.logsys)
-        d = self.command_sender.setupLink(connection_id,source_target, dest_target,bandwidth)
+        d = self.command_sender.setupLink(connection_id,source_target, dest_target,bandwidth, connection)
         d.addCallback(linkUp)
         return d
 
-    def teardownLink(self, connection_id, source_target, dest_target, bandwidth):
+    def teardownLink(self, connection_id, source_target, dest_target, bandwidth, connection=None):
         def linkDown(_):
             log.msg('Link %s -> %s down' % (source_target, dest_target), system=self.logsys)
-        d = self.command_sender.teardownLink(connection_id,source_target, dest_target, bandwidth)
+        d = self.command_sender.teardownLink(connection_id,source_target, dest_target, bandwidth, connection)
         d.addCallback(linkDown)
         return d
 
@@ -328,6 +434,7 @@ def JUNOSMXBackend(network_name, nrm_ports , parent_requester, cfg):
     descriptions = cfg.get(config.JUNOS_DESCRIPTIONS, "OpenNSA_Link")
     logsys = LOG_SYSTEM + network_name
     vc_id_prefix = cfg[config.JUNOS_VC_ID_BASE]
+    threadpool_size = int(cfg.get(CONFIG_THREADPOOL_SIZE, DEFAULT_THREADPOOL_SIZE))
 
 
     if enableqos == 'true':
@@ -354,7 +461,7 @@ def JUNOSMXBackend(network_name, nrm_ports , parent_requester, cfg):
         junos_routers = dict()
     log.msg('Loaded JUNOS MX netconf backend with enableqos=%s and descriptions=%s'% (enableqos,descriptions), debug=True, system=logsys)
     cm = JUNOSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            junos_routers,network_name, enableqos, descriptions, vc_id_prefix)
+            junos_routers,network_name, enableqos, descriptions, vc_id_prefix, threadpool_size)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
 
 class JUNOSCommandGenerator(object):
@@ -423,17 +530,15 @@ class JUNOSCommandGenerator(object):
         # For configuration reason, we're going to generate port things first, then the interface-switch commands
         for junos_port in self.src_port,self.dest_port:
             if junos_port.port.label is None:
-                commands.append( INTERFACE_PORT % { 'port':junos_port.port.interface, 'description':self.descriptions} )
-                patterns.append( INTERFACE_PORT_PTRN % { 'port':junos_port.port.interface} )
+                commands.append( interfacePort(junos_port.port.interface, self.descriptions) )
+                patterns.append( (junos_port.port.interface, 0) )
             elif junos_port.port.label.type_ == "vlan":
-                commands.append( INTERFACE_VLAN % {'port':junos_port.port.interface, 'vlan':junos_port.value, 'description':self.descriptions} )
-                patterns.append( INTERFACE_VLAN_PTRN % {'port':junos_port.port.interface, 'vlan':junos_port.value} )
+                commands.append( interfaceVlan(junos_port.port.interface, junos_port.value, self.descriptions) )
+                patterns.append( (junos_port.port.interface, junos_port.value) )
 
         for junos_port in self.src_port,self.dest_port:
-            commands.append( INT_SWITCH % { 'switch':switch_name, 
-                                                       'interface':"%s" % junos_port.port.interface,
-                                                       'subinterface': "%s" % junos_port.value if
-                                                       junos_port.port.label is not None else '0' } )
+            commands.append( interfaceSwitch(switch_name, junos_port.port.interface,
+                                                junos_port.value if junos_port.port.label is not None else '0') )
         return commands, patterns
 
     def _generateLocalConnectionDeActivate(self):
@@ -442,11 +547,10 @@ class JUNOSCommandGenerator(object):
 
         for junos_port in self.src_port,self.dest_port:
             if junos_port.port.label is None:
-                commands.append( DEL_INTERFACE_PORT % { 'port':junos_port.port.interface } )
+                commands.append( deleteInterfacePort(junos_port.port.interface) )
             elif junos_port.port.label.type_ == "vlan":
-                commands.append( DEL_INTERFACE_VLAN % { 'port':junos_port.port.interface, 'vlan' : "%s"
-                    % junos_port.value})
-        commands.append( DEL_INT_SWITCH % { 'switch':switch_name } )
+                commands.append( deleteInterfaceVlan(junos_port.port.interface, junos_port.value))
+        commands.append( deleteInterfaceSwitch(switch_name) )
 
         return commands
 
@@ -463,34 +567,28 @@ class JUNOSCommandGenerator(object):
         log.msg("Remote port is: %s | at %s " % (remote_port.original_port, remote_port.port.interface), debug=True, system=self.logsys )
 
         if local_port.port.label is None:
-            commands.append( INTERFACE_PORT % { 'port':local_port.port.interface, 'description':self.descriptions} )
-            patterns.append( INTERFACE_PORT_PTRN % { 'port':local_port.port.interface} )
+            commands.append( interfacePort(local_port.port.interface, self.descriptions) )
+            patterns.append( (local_port.port.interface, 0) )
         elif local_port.port.label.type_ == "vlan":
-            commands.append( INTERFACE_VLAN % {'port':local_port.port.interface, 'vlan':local_port.value, 'description':self.descriptions} )
-            patterns.append( INTERFACE_VLAN_PTRN % {'port':local_port.port.interface, 'vlan':local_port.value} )
+            commands.append( interfaceVlan(local_port.port.interface, local_port.value, self.descriptions) )
+            patterns.append( (local_port.port.interface, local_port.value) )
 
         if remote_port.port.label is not None and remote_port.port.label.type_ == "mpls":
             remote_sw_ip = self._getRouterLoopback(remote_port.port.remote_network)
             local_sw_ip = self._getRouterLoopback(self.network_name) 
             if local_port.port.label is None:
-                commands.append(L2_CIRCUIT(self.vc_id_prefix) % { 'remote_ip':remote_sw_ip,
-                                                        'port' : local_port.port.interface+".0", 'unique-id' : unq_id, 'description':self.descriptions
-                                                        } )
+                commands.append(l2Circuit(self.vc_id_prefix, remote_sw_ip, local_port.port.interface+".0", unq_id, self.descriptions) )
             elif local_port.port.label.type_ == "vlan":
-                 commands.append(L2_CIRCUIT(self.vc_id_prefix) % { 'remote_ip':remote_sw_ip,
-                                                        'port' : local_port.port.interface + "." + str(local_port.value), 'unique-id' : unq_id, 'description':self.descriptions
-                                                        } )
+                 commands.append(l2Circuit(self.vc_id_prefix, remote_sw_ip, local_port.port.interface + "." + str(local_port.value), unq_id, self.descriptions) )
 
         if remote_port.port.label is not None and remote_port.port.label.type_ == "vlan":
             switch_name = self._createSwitchName( self.connection_id )
 
-            commands.append( INTERFACE_VLAN % {'port':remote_port.port.interface, 'vlan':remote_port.value, 'description':self.descriptions} )
-            patterns.append( INTERFACE_VLAN_PTRN % {'port':local_port.port.interface, 'vlan':local_port.value} )
+            commands.append( interfaceVlan(remote_port.port.interface, remote_port.value, self.descriptions) )
+            patterns.append( (remote_port.port.interface, remote_port.value) )
             for junos_port in local_port,remote_port:
-                commands.append( INT_SWITCH % { 'switch':switch_name, 
-                                                       'interface':"%s" % junos_port.port.interface,
-                                                       'subinterface': "%s" % junos_port.value if
-                                                       junos_port.port.label.type_ == "vlan" else '0' } )
+                commands.append( interfaceSwitch(switch_name, junos_port.port.interface,
+                                                junos_port.value if junos_port.port.label.type_ == "vlan" else '0') )
         return commands, patterns
 
     def _generateRemoteConnectionDeactivate(self):
@@ -499,24 +597,22 @@ class JUNOSCommandGenerator(object):
         remote_port = self.src_port if self.src_port.port.remote_network is not None else self.dest_port
 
         if local_port.port.label is None:
-            commands.append( DEL_INTERFACE_PORT % { 'port':local_port.port.interface } )
+            commands.append( deleteInterfacePort(local_port.port.interface) )
         elif local_port.port.label.type_ == "vlan":
-            commands.append( DEL_INTERFACE_VLAN % { 'port':local_port.port.interface, 'vlan' : "%s"
-                % local_port.value})
+            commands.append( deleteInterfaceVlan(local_port.port.interface, local_port.value))
 
         if remote_port.port.label is not None and remote_port.port.label.type_ == "mpls":
             remote_sw_ip = self._getRouterLoopback(remote_port.port.remote_network)
             local_sw_ip = self._getRouterLoopback(self.network_name)
             if local_port.port.label is None:
-                commands.append( DEL_L2_CIRCUIT % { 'remote_ip' : remote_sw_ip, 'port' : local_port.port.interface+".0"} )
+                commands.append( deleteL2Circuit(remote_sw_ip, local_port.port.interface+".0") )
             elif local_port.port.label.type_ == "vlan":
-                commands.append( DEL_L2_CIRCUIT % { 'remote_ip' : remote_sw_ip, 'port' : local_port.port.interface + "." + str(local_port.value) } )
+                commands.append( deleteL2Circuit(remote_sw_ip, local_port.port.interface + "." + str(local_port.value)) )
 
         elif remote_port.port.label.type_ == "vlan":
             switch_name = self._createSwitchName( self.connection_id )
-            commands.append( DEL_INTERFACE_VLAN % { 'port':remote_port.port.interface, 'vlan' : "%s"
-                % remote_port.value})
-            commands.append( DEL_INT_SWITCH % { 'switch':switch_name } )
+            commands.append( deleteInterfaceVlan(remote_port.port.interface, remote_port.value))
+            commands.append( deleteInterfaceSwitch(switch_name) )
 
         return commands
 
@@ -531,34 +627,28 @@ class JUNOSCommandGenerator(object):
         bwidth = self.bandwidth * 1000000
 
         if local_port.port.label is not None and local_port.port.label.type_ == "vlan":
-            commands.append( INTERFACE_VLAN % {'port':local_port.port.interface, 'vlan':local_port.value, 'description':self.descriptions} )
-            patterns.append( INTERFACE_VLAN_PTRN % {'port':local_port.port.interface, 'vlan':local_port.value} )
+            commands.append( interfaceVlan(local_port.port.interface, local_port.value, self.descriptions) )
+            patterns.append( (local_port.port.interface, local_port.value) )
         if remote_port.port.label is not None and remote_port.port.label.type_ == "vlan":
-            commands.append( INTERFACE_VLAN % {'port':remote_port.port.interface, 'vlan':remote_port.value, 'description':self.descriptions} )
-            patterns.append( INTERFACE_VLAN_PTRN % {'port':local_port.port.interface, 'vlan':local_port.value} )
+            commands.append( interfaceVlan(remote_port.port.interface, remote_port.value, self.descriptions) )
+            patterns.append( (remote_port.port.interface, remote_port.value) )
         if local_port.port.label is not None and local_port.port.label.type_ == "mpls":
             remote_sw_ip = self._getRouterLoopback(local_port.port.remote_network)
             local_sw_ip = self._getRouterLoopback(self.network_name)
             unq_id = int(local_port.value) + 10000 
             if remote_port.port.label is not None and remote_port.port.label.type_ == "vlan":
-                commands.append(L2_CIRCUIT(self.vc_id_prefix) % { 'remote_ip':remote_sw_ip,
-                                                        'port' : remote_port.port.interface + "." + str(remote_port.value), 'unique-id' : unq_id, 'description':self.descriptions
-                                                        } )
+                commands.append(l2Circuit(self.vc_id_prefix, remote_sw_ip, remote_port.port.interface + "." + str(remote_port.value), unq_id, self.descriptions) )
         if remote_port.port.label is not None and remote_port.port.label.type_ == "mpls":
             remote_sw_ip = self._getRouterLoopback(remote_port.port.remote_network)
             local_sw_ip = self._getRouterLoopback(self.network_name)
             unq_id = int(remote_port.value) + 10000 
             if local_port.port.label is not None and local_port.port.label.type_ == "vlan":
-                commands.append(L2_CIRCUIT(self.vc_id_prefix) % { 'remote_ip':remote_sw_ip,
-                                                        'port' : local_port.port.interface + "." + str(local_port.value), 'unique-id' : unq_id, 'description':self.descriptions
-                                                        } )
+                commands.append(l2Circuit(self.vc_id_prefix, remote_sw_ip, local_port.port.interface + "." + str(local_port.value), unq_id, self.descriptions) )
         if remote_port.port.label is not None and remote_port.port.label.type_ == "vlan" and local_port.port.label is not None and local_port.port.label.type_ == "vlan":
             switch_name = self._createSwitchName( self.connection_id )
             for junos_port in local_port,remote_port:
-                commands.append( INT_SWITCH % { 'switch':switch_name, 
-                                                       'interface':"%s" % junos_port.port.interface,
-                                                       'subinterface': "%s" % junos_port.value if
-                                                       junos_port.port.label.type_ == "vlan" else '0' } )
+                commands.append( interfaceSwitch(switch_name, junos_port.port.interface,
+                                                junos_port.value if junos_port.port.label.type_ == "vlan" else '0') )
         #TODO
         # we're missing 2 things here
         # mpls->mpls lsp stiching
@@ -573,26 +663,24 @@ class JUNOSCommandGenerator(object):
         if local_port.port.label is not None and local_port.port.label.type_ == "mpls":
             remote_sw_ip = self._getRouterLoopback(local_port.port.remote_network)
             local_sw_ip = self._getRouterLoopback(self.network_name)
-            commands.append( DEL_L2_CIRCUIT % { 'remote_ip' : remote_sw_ip, 'port' : remote_port.port.interface + "." + str(remote_port.value) } )
+            commands.append( deleteL2Circuit(remote_sw_ip, remote_port.port.interface + "." + str(remote_port.value)) )
 
         if local_port.port.label is not None and local_port.port.label.type_ == "vlan":
             switch_name = self._createSwitchName( self.connection_id )
-            commands.append( DEL_INTERFACE_VLAN % { 'port':local_port.port.interface, 'vlan' : "%s"
-                % local_port.value})
+            commands.append( deleteInterfaceVlan(local_port.port.interface, local_port.value))
 
         if remote_port.port.label is not None and remote_port.port.label.type_ == "mpls":
             remote_sw_ip = self._getRouterLoopback(remote_port.port.remote_network)
             local_sw_ip = self._getRouterLoopback(self.network_name)
-            commands.append( DEL_L2_CIRCUIT % { 'remote_ip' : remote_sw_ip, 'port' : local_port.port.interface + "." + str(local_port.value) } )
+            commands.append( deleteL2Circuit(remote_sw_ip, local_port.port.interface + "." + str(local_port.value)) )
 
         if remote_port.port.label is not None and remote_port.port.label.type_ == "vlan":
             switch_name = self._createSwitchName( self.connection_id )
-            commands.append( DEL_INTERFACE_VLAN % { 'port':remote_port.port.interface, 'vlan' : "%s"
-                % remote_port.value})
+            commands.append( deleteInterfaceVlan(remote_port.port.interface, remote_port.value))
 
         if local_port.port.label is not None and remote_port.port.label is not None:
             if remote_port.port.label.type_ == "vlan" and local_port.port.label.type_ == "vlan":
-                commands.append( DEL_INT_SWITCH % { 'switch':switch_name } )
+                commands.append( deleteInterfaceSwitch(switch_name) )
         
         return commands
 
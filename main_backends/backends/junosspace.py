@@ -13,9 +13,10 @@ The backend will shoot API calls over http to junosspace, using the predefined c
 with the given data. The calls are carrying JSON as a payload. The format of the payload and available variables are
 described in a different documentation alongside with the configlets.
 
-The backend will not validate if the commands/request was successfully carried out by Junosspace. It'll post the the
-given data, and if Junosspace returns with a success, it assumes, that junosspace will handle the rest, and the
-command(s) is successfully delivered to the router.
+Applying a configlet creates a job in Junosspace. The backend parses the job id from the response and only reports
+the link as up (or down) when the job has finished successfully. All outstanding jobs are checked together by one
+poller, with a single job query per poll (for up to JOB_QUERY_BATCH_SIZE jobs). The poll interval starts at
+JOB_POLL_MIN_INTERVAL, and is doubled (up to JOB_POLL_MAX_INTERVAL) while no jobs finish.
 
 Configuration:
 [junosspace]
@@ -25,8 +26,6 @@ space_api_url=http://1.1.1.1/myjunosspace # url for junosspace api
 space_router=
 
 TODO
-- parse incoming job id and api link
-- query for results
 - implement remote part
 - clean up the mess
 
@@ -35,22 +34,15 @@ TODO
 import json
 import random
 from base64 import b64encode
-from pprint import pprint, pformat
-
-from zope.interface import implements
+from pprint import pprint
+from urllib.parse import quote
 
 from twisted.python import log
-from twisted.internet import defer
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.internet.defer import setDebugging
-from twisted.web.client import Agent,readBody
-from twisted.web.http_headers import Headers
-from twisted.internet.defer import succeed
-from twisted.web.iweb import IBodyProducer
-from twisted.internet.ssl import ClientContextFactory
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend
+from opennsa.backends.common import genericbackend, httppool
 
 
 
@@ -60,6 +52,13 @@ LOG_SYSTEM = 'JUNOSSPACE'
 
 API_CALL_CONTENT_TYPE="application/vnd.net.juniper.space.configuration-management.apply-configlet+json;version=2;charset=UTF-8"
 API_CALL_ACCEPT="application/vnd.net.juniper.space.job-management.task+json;version=1;q=.01"
+SPACE_TIMEOUT = 60 # seconds
+JOB_CALL_ACCEPT="application/vnd.net.juniper.space.job-management.jobs+json;version=3"
+JOB_POLL_MIN_INTERVAL = 1   # seconds
+JOB_POLL_MAX_INTERVAL = 30  # seconds
+JOB_QUERY_BATCH_SIZE  = 50  # jobs per status query
+JOB_TIMEOUT           = 600 # seconds before giving up on a job
+JOB_FINISHED_STATES   = ('DONE', 'FAILURE', 'CANCELLED')
 LOCAL_ACTIVATE_CONFIGLET_ID     = "1578282"
 REMOTE_ACTIVATE_CONFIGLET_ID    = "1578271"
 LOCAL_DEACTIVATE_CONFIGLET_ID   = "1578251"
@@ -79,27 +78,120 @@ class JUNOSSPACERouter(object):
         return "Router name {} deviceId {} loopback ip {}".format(self.router_name,self.router_id,self.router_ip)
 
 
-class JUNOSSPACEPayloadProducer(object):
-    implements(IBodyProducer)
+class JobError(Exception):
+    pass
+
+
+
+class SpaceJobPoller:
+    """
+    Tracks Junosspace jobs until they finish. All tracked jobs are queried
+    together, so the number of polls does not grow with the number of jobs.
+    """
+
+    def __init__(self, space_api_url, headers, clock=reactor):
+        self.jobs_url = space_api_url + '/job-management/jobs'
+        self.headers = dict(headers, Accept=JOB_CALL_ACCEPT)
+        self.clock = clock
+
+        self.jobs = {} # job id -> (deferred, deadline)
+        self.interval = JOB_POLL_MIN_INTERVAL
+        self.delayed_call = None
+        self.polling = False
+
+
+    def track(self, job_id):
+        """
+        Returns a deferred which fires when the job has finished successfully,
+        or fails with JobError if the job fails or does not finish in time.
+        """
+        d = defer.Deferred()
+        self.jobs[job_id] = (d, self.clock.seconds() + JOB_TIMEOUT)
+        # new jobs are usually short, so check early
+        self.interval = JOB_POLL_MIN_INTERVAL
+        if self.delayed_call is not None and self.delayed_call.getTime() > self.clock.seconds() + self.interval:
+            self.delayed_call.cancel()
+            self.delayed_call = None
+        self._schedule()
+        return d
+
+
+    def _schedule(self):
+        if self.jobs and self.delayed_call is None and not self.polling:
+            self.delayed_call = self.clock.callLater(self.interval, self._poll)
+
+
+    def _queryJobs(self, job_ids):
+        job_filter = ' or '.join( 'id eq {}'.format(job_id) for job_id in job_ids )
+        url = '{}?filter={}'.format(self.jobs_url, quote('({})'.format(job_filter)))
+        d = httppool.httpRequest(url, None, self.headers, method=b'GET', timeout=SPACE_TIMEOUT)
+        d.addCallback(parseJobStates)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _poll(self):
+        self.delayed_call = None
+        self.polling = True
+        finished = 0
+        try:
+            job_ids = sorted(self.jobs)
+            for i in range(0, len(job_ids), JOB_QUERY_BATCH_SIZE):
+                try:
+                    states = yield self._queryJobs(job_ids[i:i+JOB_QUERY_BATCH_SIZE])
+                except Exception as e:
+                    log.msg('Error querying job status: {}'.format(e), system=LOG_SYSTEM)
+                    continue
+                for job_id, (state, status, summary) in states.items():
+                    if job_id in self.jobs and state in JOB_FINISHED_STATES:
+                        finished += 1
+                        d, _ = self.jobs.pop(job_id)
+                        if state == 'DONE' and status == 'SUCCESS':
+                            log.msg('Job {} done'.format(job_id), debug=True, system=LOG_SYSTEM)
+                            d.callback(job_id)
+                        else:
+                            d.errback(JobError('Job {} {} ({}): {}'.format(job_id, state, status, summary)))
+
+            now = self.clock.seconds()
+            for job_id, (d, deadline) in list(self.jobs.items()):
+                if now > deadline:
+                    del self.jobs[job_id]
+                    d.errback(JobError('Job {} did not finish within {} seconds'.format(job_id, JOB_TIMEOUT)))
+
+            if finished:
+                self.interval = JOB_POLL_MIN_INTERVAL
+            else:
+                self.interval = min(self.interval * 2, JOB_POLL_MAX_INTERVAL)
+        finally:
+            self.polling = False
+            self._schedule()
 
-    def __init__(self, json_payload):
-        self.json_payload = json.dumps(json_payload['payload'])
-        self.length = len(self.json_payload)
 
-    def startProducing(self, consumer):
-        consumer.write(self.json_payload)
-        return succeed(None)
+    def stop(self):
+        if self.delayed_call is not None:
+            self.delayed_call.cancel()
+            self.delayed_call = None
+        # no one would be told when the remaining jobs finish
+        jobs, self.jobs = self.jobs, {}
+        for d, _ in jobs.values():
+            d.errback(JobError('poller stopped'))
 
-    def pauseProducing(self):
-        pass
 
-    def stopProducing(self):
-        pass
 
+def parseJobId(body):
+    # response to apply-configlet: {"task": {"href": "/api/space/job-management/jobs/<id>", "id": <id>}}
+    try:
+        return int(json.loads(body)['task']['id'])
+    except (ValueError, KeyError, TypeError):
+        raise JobError('No job id in Junosspace response: {}'.format(body))
 
-class WebClientContextFactory(ClientContextFactory):
-    def getContext(self, hostname, port):
-        return ClientContextFactory.getContext(self)
+
+def parseJobStates(body):
+    # response to job query: {"jobs": {"job": [ {"id": .., "job-state": .., "job-status": .., "summary": ..}, .. ]}}
+    jobs = json.loads(body)['jobs'].get('job', [])
+    if isinstance(jobs, dict): # single job
+        jobs = [ jobs ]
+    return { int(job['id']) : (job.get('job-state'), job.get('job-status'), job.get('summary')) for job in jobs }
 
 
 
@@ -113,44 +205,38 @@ class JUNOSSPACECommandSender:
         self.space_password = space_password
         self.space_api_url = space_api_url
         log.msg("Space api url {} {}:{}".format(self.space_api_url,self.space_user,self.space_password))
+        self.job_poller = SpaceJobPoller(self.space_api_url, self._createHeaders())
+        httppool.acquireClient(self.space_api_url)
+
+
+    def _createHeaders(self):
+        authorization_string = b64encode("{}:{}".format(self.space_user,self.space_password).encode('utf-8')).decode('ascii')
+        return {'authorization': 'Basic ' + authorization_string}
 
 
     @defer.inlineCallbacks
     def _sendCommands(self, configlet_payload):
 
         log.msg('Sending junosspace command', debug=True, system=LOG_SYSTEM)
-        authorization_string = b64encode(b"{}:{}".format(self.space_user,self.space_password))
-        payload = JUNOSSPACEPayloadProducer(configlet_payload)
+        payload = json.dumps(configlet_payload['payload'])
         api_configlet_url = "{}/configuration-management/cli-configlets/{}/apply-configlet".format(self.space_api_url,configlet_payload['configlet_id'])
-        contextFactory = WebClientContextFactory()
-        agent = Agent(reactor,contextFactory)
-        req = agent.request(
-            'POST',
-            api_configlet_url,
-            Headers({b"authorization": [b"Basic " + authorization_string],
-                     b"Content-Type": [API_CALL_CONTENT_TYPE],
-                     b"Accept": [API_CALL_ACCEPT]}),
-                    payload)
-        req.addCallbacks(self._cbRequest,self._cbError) 
-        yield req
-
-
-    def _cbRequest(self,response):
-        print('Response version:', response.version)
-        print('Response code:', response.code)
-        print('Response phrase:', response.phrase)
-        print('Response headers:')
-        print(pformat(list(response.headers.getAllRawHeaders())))
-        d = readBody(response)
-        d.addCallback(self.printBody)
-        return d
+        headers = self._createHeaders()
+        headers['Content-Type'] = API_CALL_CONTENT_TYPE
+        headers['Accept'] = API_CALL_ACCEPT
+        try:
+            body = yield httppool.httpRequest(api_configlet_url, payload, headers, method=b'POST', timeout=SPACE_TIMEOUT)
+            log.msg('Received body from junosspace {}'.format(body), debug=True, system=LOG_SYSTEM)
+            job_id = parseJobId(body)
+            log.msg('Waiting for junosspace job {}'.format(job_id), debug=True, system=LOG_SYSTEM)
+            yield self.job_poller.track(job_id)
+        except Exception as e:
+            log.msg('Error applying configlet: {}'.format(e), system=LOG_SYSTEM)
+            raise
 
-    def _cbError(self,failure):
-        log.msg("{}".format(failure.value.reasons[0].printTraceback()),debug=True, system=LOG_SYSTEM)
-        print(type(failure.value), failure) # catch error here
 
-    def printBody(self,body):
-        log.msg('Received body from junosspace {}'.format(body), debug=True, system=LOG_SYSTEM)
+    def shutdown(self):
+        self.job_poller.stop()
+        return httppool.releaseClient(self.space_api_url)
 
 
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
@@ -236,6 +322,10 @@ class JUNOSSPACEConnectionManager:
         return d
 
 
+    def shutdown(self):
+        return self.command_sender.shutdown()
+
+
     def canConnect(self, source_port, dest_port, source_label, dest_label):
         src_label_type = 'port' if source_label is None else source_label.type_
         dst_label_type = 'port' if dest_label is None else dest_label.type_
@@ -12,8 +12,7 @@ from twisted.python import log
 from twisted.web.error import Error as WebError
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend
-from opennsa.protocols.shared import httpclient
+from opennsa.backends.common import genericbackend, httppool, batcher, templates
 
 
 # basic payload
@@ -50,9 +49,16 @@ NCS_TIMEOUT = 60 # ncs typically spends 25-32 seconds creating/deleting a vpn, s
 
 NO_OUT_OF_SYNC_CHECK = 'no-out-of-sync-check' # put this as a query parameter to get ncs to bypass the check
 
+# With a batch window, creates and deletes submitted within the window are sent
+# to NCS as one PATCH of the services container, i.e., one NCS transaction.
+# If the transaction fails, the batch is split to find the failing services.
+CONFIG_BATCH_WINDOW = 'ncs_batch_window' # seconds, 0 (default) sends each service on its own
+BATCH_MAX_SIZE      = 20
+NCS_BATCH_TIMEOUT   = 180
 
 
-ETHERNET_VPN_PAYLOAD_BASE = """
+
+BOD_PAYLOAD_START = """
 <bod xmlns="http://nordu.net/ns/ncs/vpn">
     <service-name>%(service_name)s</service-name>
     <side-a>
@@ -63,44 +69,35 @@ ETHERNET_VPN_PAYLOAD_BASE = """
         <router>%(router_b)s</router>
         <interface>%(interface_b)s</interface>
     </side-b>
-    <vlan>%(vlan)i</vlan>
-    <service-id>%(service_id)s</service-id>
-</bod>
 """
 
-
-ETHERNET_VLAN_VPN_PAYLOAD_BASE = """
-<bod xmlns="http://nordu.net/ns/ncs/vpn">
-    <service-name>%(service_name)s</service-name>
-    <side-a>
-        <router>%(router_a)s</router>
-        <interface>%(interface_a)s</interface>
-    </side-a>
-    <side-b>
-        <router>%(router_b)s</router>
-        <interface>%(interface_b)s</interface>
-    </side-b>
-    <vlan>%(vlan)i</vlan>
-    <service-id>%(service_id)s</service-id>
+BOD_PAYLOAD_END = """    <service-id>%(service_id)s</service-id>
 </bod>
 """
 
+ETHERNET_VPN_PAYLOAD = templates.XMLTemplate(BOD_PAYLOAD_START + BOD_PAYLOAD_END)
 
-ETHERNET_VLAN_REWRITE_VPN_PAYLOAD_BASE = """
-<bod xmlns="http://nordu.net/ns/ncs/vpn">
-    <service-name>%(service_name)s</service-name>
-    <side-a>
-        <router>%(router_a)s</router>
-        <interface>%(interface_a)s</interface>
-    </side-a>
-    <side-b>
-        <router>%(router_b)s</router>
-        <interface>%(interface_b)s</interface>
-    </side-b>
-    <vlan-side-a>%(vlan_a)i</vlan-side-a>
+ETHERNET_VLAN_VPN_PAYLOAD = templates.XMLTemplate(BOD_PAYLOAD_START + """    <vlan>%(vlan)i</vlan>
+""" + BOD_PAYLOAD_END)
+
+ETHERNET_VLAN_REWRITE_VPN_PAYLOAD = templates.XMLTemplate(BOD_PAYLOAD_START + """    <vlan-side-a>%(vlan_a)i</vlan-side-a>
     <vlan-side-b>%(vlan_b)i</vlan-side-b>
-    <service-id>%(service_id)s</service-id>
+""" + BOD_PAYLOAD_END)
+
+
+ETHERNET_VPN_DELETE_PAYLOAD = templates.XMLTemplate("""
+<bod xmlns="http://nordu.net/ns/ncs/vpn" xmlns:nc="urn:ietf:params:xml:ns:netconf:base:1.0" nc:operation="delete">
+    <service-name>%(service_name)s</service-name>
 </bod>
+""")
+
+
+BATCH_PAYLOAD_START = b"""
+<services xmlns="http://tail-f.com/ns/ncs">
+"""
+
+BATCH_PAYLOAD_END = b"""
+</services>
 """
 
 
@@ -139,13 +136,13 @@ def createVPNPayload(service_name, source_target, dest_target):
         #assert source_target.vlan == dest_target.vlan, 'VLANs must match (until we get rewrite in place)'
         if source_target.vlan == dest_target.vlan:
             intps['vlan'] = source_target.vlan
-            payload = ETHERNET_VLAN_VPN_PAYLOAD_BASE % intps
+            payload = ETHERNET_VLAN_VPN_PAYLOAD.render(intps)
         else:
             intps['vlan_a'] = source_target.vlan
             intps['vlan_b'] = dest_target.vlan
-            payload = ETHERNET_VLAN_REWRITE_VPN_PAYLOAD_BASE % intps
+            payload = ETHERNET_VLAN_REWRITE_VPN_PAYLOAD.render(intps)
     else:
-        payload = ETHERNET_VPN_PAYLOAD_BASE % intps
+        payload = ETHERNET_VPN_PAYLOAD.render(intps)
 
     return payload
 
@@ -162,12 +159,17 @@ def _extractErrorMessage(failure):
 
 class NCSVPNConnectionManager:
 
-    def __init__(self, ncs_services_url, user, password, port_map, log_system):
+    def __init__(self, ncs_services_url, user, password, port_map, log_system, batch_window=0):
         self.ncs_services_url = ncs_services_url
         self.user             = user
         self.password         = password
         self.port_map         = port_map
         self.log_system       = log_system
+        httppool.acquireClient(ncs_services_url)
+
+        self.batcher = None
+        if batch_window:
+            self.batcher = batcher.CommitBatcher(self._commitServices, window=batch_window, max_batch_size=BATCH_MAX_SIZE, log_system=log_system)
 
 
     def getResource(self, port, label):
@@ -197,7 +199,7 @@ class NCSVPNConnectionManager:
 
 
     def _createAuthzHeader(self):
-        return 'Basic ' + base64.b64encode( self.user + ':' + self.password)
+        return 'Basic ' + base64.b64encode( (self.user + ':' + self.password).encode('utf-8') ).decode('ascii')
 
 
     def _createHeaders(self):
@@ -206,6 +208,12 @@ class NCSVPNConnectionManager:
         headers['Authorization'] = self._createAuthzHeader()
         return headers
 
+    def _commitServices(self, services):
+        service_url = self.ncs_services_url + '?' + NO_OUT_OF_SYNC_CHECK
+        payload = BATCH_PAYLOAD_START + b''.join(services) + BATCH_PAYLOAD_END
+        return httppool.httpRequest(service_url, payload, self._createHeaders(), method='PATCH', timeout=NCS_BATCH_TIMEOUT)
+
+
     def setupLink(self, connection_id, source_target, dest_target, bandwidth):
         service_url = self.ncs_services_url + '?' + NO_OUT_OF_SYNC_CHECK
         payload = createVPNPayload(connection_id, source_target, dest_target)
@@ -219,7 +227,10 @@ class NCSVPNConnectionManager:
             log.msg('Message: %s' % _extractErrorMessage(failure), system=self.log_system)
             return failure
 
-        d = httpclient.httpRequest(service_url, payload, headers, method='POST', timeout=NCS_TIMEOUT)
+        if self.batcher:
+            d = self.batcher.submit(payload)
+        else:
+            d = httppool.httpRequest(service_url, payload, headers, method='POST', timeout=NCS_TIMEOUT)
         d.addCallbacks(linkUp, error)
         return d
 
@@ -236,11 +247,18 @@ class NCSVPNConnectionManager:
             log.msg('Message: %s' % _extractErrorMessage(failure), system=self.log_system)
             return failure
 
-        d = httpclient.httpRequest(service_url, None, headers, method='DELETE', timeout=NCS_TIMEOUT)
+        if self.batcher:
+            d = self.batcher.submit(ETHERNET_VPN_DELETE_PAYLOAD.render({ 'service_name' : connection_id }))
+        else:
+            d = httppool.httpRequest(service_url, None, headers, method='DELETE', timeout=NCS_TIMEOUT)
         d.addCallbacks(linkDown, error)
         return d
 
 
+    def shutdown(self):
+        return httppool.releaseClient(self.ncs_services_url)
+
+
 
 def NCSVPNBackend(network_name, nrm_ports, parent_requester, cfg): 
 
@@ -252,7 +270,8 @@ def NCSVPNBackend(network_name, nrm_ports, parent_requester, cfg):
     ncs_services_url = str(cfg[config.NCS_SERVICES_URL]) # convert from unicode
     user             = cfg[config.NCS_USER]
     password         = cfg[config.NCS_PASSWORD]
+    batch_window     = float(cfg.get(CONFIG_BATCH_WINDOW, 0))
 
-    cm = NCSVPNConnectionManager(ncs_services_url, user, password, port_map, name)
+    cm = NCSVPNConnectionManager(ncs_services_url, user, password, port_map, name, batch_window)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
 
@@ -16,45 +16,33 @@ from base64 import b64encode
 
 from twisted.python import log
 from twisted.internet import reactor, defer
-from twisted.internet.ssl import ClientContextFactory
-from twisted.web.client import Agent, readBody
-from twisted.web.http_headers import Headers
 
-from opennsa.backends.common import genericbackend
+from opennsa.backends.common import genericbackend, httppool
 from opennsa import constants as cnt, config
 
 
 LOG_SYSTEM = 'opennsa.OESS'
 
+OESS_TIMEOUT = 60 # seconds
+CACHE_TTL    = 300 # seconds, for workgroup and node interface lookups
+MAX_CONCURRENT_OPERATIONS = 8 # circuits being provisioned or removed at the same time
+
 
 # ********************************************************************************
 # ************************* Twisted Mini Web Client ******************************
 # ********************************************************************************
 
 
-class WebClientContextFactory(ClientContextFactory):
-    def getContext(self, hostname, port):
-        return ClientContextFactory.getContext(self)
-
-
 def http_query(conn, sub_path):
     """
     Mini Twisted Web Client
     """
     full_url = conn.url + sub_path
-    full_url = full_url.encode('latin-1')
     log.msg("http_query: %r" % full_url, debug=True, system=LOG_SYSTEM)
 
-    context_factory = WebClientContextFactory()
-    agent = Agent(reactor, context_factory)
-    d = agent.request('GET', full_url,
-                      headers=Headers(
-                       {'Content-Type': ['application/x-www-form-urlencoded'],
-                        'Authorization': ['Basic ' + conn.auth]
-                        }),
-                      bodyProducer=None)
-    d.addCallbacks(readBody, log.err)
-    return d
+    headers = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Authorization': 'Basic ' + conn.auth}
+    return httppool.httpRequest(full_url, None, headers, method=b'GET', timeout=OESS_TIMEOUT)
 
 
 # ********************************************************************************
@@ -62,26 +50,19 @@ def http_query(conn, sub_path):
 # ********************************************************************************
 
 
-def oess_get_circuit_id(circuits, src_interface, dst_interface):
-    s_sw, s_int, s_vlan = oess_get_port_vlan(src_interface)
-    d_sw, d_int, d_vlan = oess_get_port_vlan(dst_interface)
-    circuits = json.loads(circuits)
-    for circuit in circuits["results"]:
-        if circuit["endpoints"][0]["node"] == s_sw:
-            if circuit["endpoints"][1]["node"] == d_sw:
-                if circuit["endpoints"][0]["interface"] == s_int:
-                    if circuit["endpoints"][1]["interface"] == d_int:
-                        return circuit["circuit_id"]
+def oess_circuit_key(*interfaces):
+    # the endpoints of a circuit, independent of direction
+    return frozenset( oess_get_port_vlan(interface) for interface in interfaces )
 
-        elif circuit["endpoints"][0]["node"] == d_sw:
-            if circuit["endpoints"][1]["node"] == s_sw:
-                if circuit["endpoints"][0]["interface"] == d_int:
-                    if circuit["endpoints"][1]["interface"] == s_int:
-                        return circuit["circuit_id"]
 
-    error_msg = "Circuit not found for %s - %s" % (src_interface, dst_interface)
-    log.msg(error_msg, system=LOG_SYSTEM)
-    return 0
+def oess_index_circuits(circuits):
+    circuits = json.loads(circuits)
+    index = {}
+    for circuit in circuits["results"]:
+        endpoints = frozenset( (endpoint["node"], endpoint["interface"], str(endpoint["tag"]))
+                               for endpoint in circuit["endpoints"] )
+        index[endpoints] = circuit["circuit_id"]
+    return index
 
 
 def oess_process_result(result):
@@ -90,7 +71,8 @@ def oess_process_result(result):
         if result["results"]["success"] == 1:
             return result["results"]["circuit_id"]
     except:
-            raise Exception("Unable to provision circuit. Check OESS logs")
+        pass
+    raise Exception("Unable to provision circuit. Check OESS logs")
 
 
 def oess_process_path(result):
@@ -114,15 +96,12 @@ def oess_confirm_vlan_availability(result, vlan):
     raise Exception("Vlan %s not available" % vlan)
 
 
-def oess_validate_ports(switch_interfaces, intf):
+def oess_get_interface_names(switch_interfaces):
     try:
         switch_interfaces = json.loads(switch_interfaces)
     except Exception as err:
         raise Exception(err)
-    for switch_interface in switch_interfaces["results"]:
-        if switch_interface["name"] == intf:
-            return True
-    raise Exception("Incorrect Interface - interface %s" % intf)
+    return set( switch_interface["name"] for switch_interface in switch_interfaces["results"] )
 
 
 def oess_get_workgroup_id(wg_ids, group):
@@ -218,6 +197,62 @@ def oess_cancel_circuit(conn, circuit_id, wg_id):
 # ********************************************************************************
 
 
+class TTLCache(object):
+    """
+    Cache for lookups which rarely change. Values expire after ttl seconds,
+    and can be invalidated earlier if they turn out to be stale.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, clock=reactor):
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}  # key -> (expires, value)
+        self.fetching = {} # key -> list of deferreds waiting for the fetch in flight
+
+    def get(self, key, fetch):
+        """
+        Return a deferred with the value for key, calling fetch (which must
+        return a deferred) if there is no value or it has expired. Concurrent
+        misses for a key share one fetch.
+        """
+        if key in self.entries:
+            expires, value = self.entries[key]
+            if self.clock.seconds() < expires:
+                return defer.succeed(value)
+            del self.entries[key]
+
+        if key in self.fetching:
+            d = defer.Deferred()
+            self.fetching[key].append(d)
+            return d
+
+        waiters = self.fetching[key] = []
+
+        def fetched(value):
+            # not stored if the key was invalidated while fetching
+            if self.fetching.get(key) is waiters:
+                del self.fetching[key]
+                self.entries[key] = (self.clock.seconds() + self.ttl, value)
+            for d in waiters:
+                d.callback(value)
+            return value
+
+        def fetchFailed(err):
+            if self.fetching.get(key) is waiters:
+                del self.fetching[key]
+            for d in waiters:
+                d.errback(err)
+            return err
+
+        d = fetch()
+        d.addCallbacks(fetched, fetchFailed)
+        return d
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        self.fetching.pop(key, None)
+
+
 class UrlConnection(object):
 
     def __init__(self, url, auth):
@@ -232,120 +267,126 @@ class OessSetup(object):
         self.username = user
         self.password = password
         self.workgroup = workgroup
-        self.workgroup_id = None
-        self.circuit_id = None
-        self.auth = b64encode(b"%s:%s" % (self.username, self.password))
+        self.auth = b64encode(("%s:%s" % (self.username, self.password)).encode('utf-8')).decode('ascii')
         self.conn = UrlConnection(self.url, self.auth)
+        self.cache = TTLCache()
+        self.circuit_ids = {}  # connection id -> circuit id
+        self.semaphore = defer.DeferredSemaphore(MAX_CONCURRENT_OPERATIONS)
+
+    def get_workgroup_id(self):
+        def fetch():
+            d = oess_get_workgroups(self.conn)
+            d.addCallback(oess_get_workgroup_id, self.workgroup)
+            return d
+        return self.cache.get('workgroup_id', fetch)
+
+    @defer.inlineCallbacks
+    def validate_port(self, sw, intf):
+        def fetch():
+            d = oess_get_switch_ports(self.conn, sw)
+            d.addCallback(oess_get_interface_names)
+            return d
+        interfaces = yield self.cache.get(('interfaces', sw), fetch)
+        if intf not in interfaces:
+            # the interface may have been added since the lookup was cached
+            self.cache.invalidate(('interfaces', sw))
+            raise Exception("Incorrect Interface - interface %s" % intf)
 
     @defer.inlineCallbacks
-    def oess_provisioning(self, src_interface, dst_interface):
+    def oess_provisioning(self, connection_id, src_interface, dst_interface):
         log.msg("Provisioning OESS circuit... ", system=LOG_SYSTEM)
         try:
-            log.msg("01 - Getting All OESS Workgroup' Workgroup_IDs",
-                    debug=True, system=LOG_SYSTEM)
-            wg_ids = yield oess_get_workgroups(self.conn)
-
-            log.msg("02 - Getting our Group's ID",
-                    debug = True, system=LOG_SYSTEM)
-            self.workgroup_id = oess_get_workgroup_id(wg_ids, self.workgroup)
-
-            log.msg("03 - Getting source switch, interface and VLAN from src_interface",
-                    debug=True, system=LOG_SYSTEM)
             s_sw, s_int, s_vlan = oess_get_port_vlan(src_interface)
-
-            log.msg("04 - Querying for all interfaces of the source switch",
-                    debug=True, system=LOG_SYSTEM)
-            s_switch_interfaces = yield oess_get_switch_ports(self.conn, s_sw)
-
-            log.msg("05 - Validating switch_interfaces with interface provided",
-                    debug=True, system=LOG_SYSTEM)
-            oess_validate_ports(s_switch_interfaces, s_int)
-
-            log.msg("06 - Verifying if source VLAN is available",
-                    debug=True, system=LOG_SYSTEM)
-            is_available = yield oess_query_vlan_availability(self.conn, s_sw, s_int, s_vlan)
-            oess_confirm_vlan_availability(is_available, s_vlan)
-
-            log.msg("07 - Get destination switch, interface and VLAN from dst_interface",
-                    debug=True, system=LOG_SYSTEM)
             d_sw, d_int, d_vlan = oess_get_port_vlan(dst_interface)
 
-            log.msg("08 - Querying for all interfaces of the destination switch",
-                    debug=True, system=LOG_SYSTEM)
-            d_switch_interfaces = yield oess_get_switch_ports(self.conn, d_sw)
-
-            log.msg("09 - Validating switch_interfaces with interface provided",
-                    debug=True, system=LOG_SYSTEM)
-            oess_validate_ports(d_switch_interfaces, d_int)
-
-            log.msg("10 - Verifying if destination VLAN is available",
-                    debug=True, system=LOG_SYSTEM)
-            is_available = yield oess_query_vlan_availability(self.conn, d_sw, d_int, d_vlan)
-            oess_confirm_vlan_availability(is_available, d_vlan)
-
-            log.msg("11 - Querying for primary path",
+            # everything but the backup path and the provisioning itself is independent
+            log.msg("01 - Getting workgroup ID, validating interfaces, verifying VLANs and querying for primary path",
                     debug=True, system=LOG_SYSTEM)
-            p_path = yield oess_get_path(self.conn, s_sw, d_sw)
+            results = yield defer.gatherResults([
+                self.get_workgroup_id(),
+                self.validate_port(s_sw, s_int),
+                self.validate_port(d_sw, d_int),
+                oess_query_vlan_availability(self.conn, s_sw, s_int, s_vlan),
+                oess_query_vlan_availability(self.conn, d_sw, d_int, d_vlan),
+                oess_get_path(self.conn, s_sw, d_sw)
+            ], consumeErrors=True)
+            workgroup_id, _, _, s_available, d_available, p_path = results
+            oess_confirm_vlan_availability(s_available, s_vlan)
+            oess_confirm_vlan_availability(d_available, d_vlan)
             primary = oess_process_path(p_path)
 
-            log.msg("12 - Querying for backup path",
+            log.msg("02 - Querying for backup path",
                     debug=True, system=LOG_SYSTEM)
             b_path = yield oess_get_path(self.conn, s_sw, d_sw, primary)
             backup = oess_process_path(b_path)
 
-            log.msg("13 - Provisioning circuit...",
+            log.msg("03 - Provisioning circuit...",
                     debug=True, system=LOG_SYSTEM)
-            result = yield oess_provision_circuit(self.conn, self.workgroup_id,
+            result = yield oess_provision_circuit(self.conn, workgroup_id,
                                                   s_sw, s_int, s_vlan,
                                                   d_sw, d_int, d_vlan,
                                                   primary, backup)
-            self.circuit_id = oess_process_result(result)
+            circuit_id = oess_process_result(result)
+            self.circuit_ids[connection_id] = circuit_id
 
-            log.msg("Success!! OESS circuit %s created" % self.circuit_id,
+            log.msg("Success!! OESS circuit %s created" % circuit_id,
                     system=LOG_SYSTEM)
 
+        except defer.FirstError as err:
+            log.msg("Error creating circuit: %s" % err.subFailure.getErrorMessage(), system=LOG_SYSTEM)
+            err.subFailure.raiseException()
+
         except Exception as err:
             log.msg("Error creating circuit: %s" % err, system=LOG_SYSTEM)
             raise err
 
 
     @defer.inlineCallbacks
-    def oess_circuit_removal(self, src_interface, dst_interface):
+    def oess_circuit_removal(self, connection_id, src_interface, dst_interface):
         log.msg("Removing OESS circuit", system=LOG_SYSTEM)
         try:
-            log.msg("01 - Getting list of circuits", debug=True, system=LOG_SYSTEM)
-            circuits = yield oess_get_circuits(self.conn, self.workgroup_id)
+            workgroup_id = yield self.get_workgroup_id()
+
+            circuit_id = self.circuit_ids.get(connection_id)
+            if circuit_id is None:
+                # not provisioned by this instance, e.g., before a restart
+                log.msg("01 - Getting list of circuits", debug=True, system=LOG_SYSTEM)
+                circuits = yield oess_get_circuits(self.conn, workgroup_id)
 
-            log.msg("02 - Getting Circuit ID", debug=True, system=LOG_SYSTEM)
-            circuit_id = oess_get_circuit_id(circuits, src_interface, dst_interface)
+                log.msg("02 - Getting Circuit ID", debug=True, system=LOG_SYSTEM)
+                circuit_index = oess_index_circuits(circuits)
+                circuit_id = circuit_index.get(oess_circuit_key(src_interface, dst_interface))
 
             if not circuit_id:
-                log.msg("OESS circuit not found!", debug=True, system=LOG_SYSTEM)
+                log.msg("Circuit not found for %s - %s" % (src_interface, dst_interface), system=LOG_SYSTEM)
             else:
                 log.msg("03 - Cancelling Circuit ID", debug=True, system=LOG_SYSTEM)
                 result = yield oess_cancel_circuit(self.conn, str(circuit_id),
-                                                   self.workgroup_id)
+                                                   workgroup_id)
                 try:
                     try:
                         result = json.loads(result)
                     except Exception as err:
                         raise err
 
-                    if result["results"][0]["success"] == 1:
-                        log.msg("OESS circuit %s removed'" % circuit_id, system=LOG_SYSTEM)
+                    removed = result["results"][0]["success"] == 1
                 except:
+                    removed = False
+                if not removed:
                     raise Exception("Problem removing circuit %s. Check OESS's logs"
                                     % circuit_id)
+                self.circuit_ids.pop(connection_id, None)
+                log.msg("OESS circuit %s removed'" % circuit_id, system=LOG_SYSTEM)
 
         except Exception as err:
-            log.msg("Error creating circuit: %s" % err, system=LOG_SYSTEM)
+            log.msg("Error removing circuit: %s" % err, system=LOG_SYSTEM)
             raise err
 
-    def setupLink(self, source_target, dest_target):
-        return self.oess_provisioning(source_target, dest_target)
+    def setupLink(self, connection_id, source_target, dest_target):
+        return self.semaphore.run(self.oess_provisioning, connection_id, source_target, dest_target)
 
-    def tearDownLink(self, source_target, dest_target):
-        return self.oess_circuit_removal(source_target, dest_target)
+    def tearDownLink(self, connection_id, source_target, dest_target):
+        return self.semaphore.run(self.oess_circuit_removal, connection_id, source_target, dest_target)
 
 
 # ******************************************************************************
@@ -359,7 +400,7 @@ class OESSConnectionManager:
         self.log_system = log_system
         self.port_map = port_map
         self.oess_conn = OessSetup(url, user, password, workgroup)
-        self.circuit_id = None
+        httppool.acquireClient(url)
 
     def getResource(self, port, label):
         log.msg('OESS: getResource, port = %s and label = %s and Vlan = %s' %
@@ -387,18 +428,29 @@ class OESSConnectionManager:
 
     def setupLink(self, connection_id, source_target, dest_target, bandwidth):
         log.msg('OESS: setupLink', debug=True, system=self.log_system)
-        self.oess_conn.setupLink(source_target, dest_target)
-        log.msg('Link %s -> %s up' % (source_target, dest_target),
-                system=self.log_system)
-        return defer.succeed(None)
+
+        def linkUp(_):
+            log.msg('Link %s -> %s up' % (source_target, dest_target),
+                    system=self.log_system)
+
+        d = self.oess_conn.setupLink(connection_id, source_target, dest_target)
+        d.addCallback(linkUp)
+        return d
 
     def teardownLink(self, connection_id, source_target, dest_target, bandwidth):
         # Debug
         log.msg('OESS: teardownLink', system=self.log_system)
-        self.oess_conn.tearDownLink(source_target, dest_target)
-        log.msg('Link %s -> %s down' % (source_target, dest_target),
-                system=self.log_system)
-        return defer.succeed(None)
+
+        def linkDown(_):
+            log.msg('Link %s -> %s down' % (source_target, dest_target),
+                    system=self.log_system)
+
+        d = self.oess_conn.tearDownLink(connection_id, source_target, dest_target)
+        d.addCallback(linkDown)
+        return d
+
+    def shutdown(self):
+        return httppool.releaseClient(self.oess_conn.url)
 
 
 # ********************************************************************************
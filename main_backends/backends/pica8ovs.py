@@ -3,179 +3,214 @@ OpenNSA Pica8 OVS backend.
 
 Authors:  iCAIR. Contributions by SURFnet, NORDUnet
 
+VLAN trunks are changed through OVSDB (JSON-RPC to db_ip:6640) over one
+persistent connection, with the changes for both ports of a link in one
+transaction, confirmed through a monitor on the Port table.
+
+Flows are programmed over a persistent SSH connection. The flow changes
+(adds and deletes) of the links submitted within FLOW_BATCH_WINDOW are
+streamed as one flow file to a single ovs-ofctl --bundle add-flows, so they
+are applied atomically, in one round-trip.
 """
 
 import random
+import struct
 
 from twisted.python import log
 from twisted.internet import defer
+from twisted.conch.ssh import common
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import ssh, genericbackend
+from opennsa.backends.common import ssh, genericbackend, ovsdb, batcher
 
 LOG_SYSTEM = 'opennsa.pica8ovs'
 
-# parameterized commands
-COMMAND_ECHO            = 'echo'
+FLOW_BATCH_WINDOW = 0.25 # seconds
 
-# Substitute switch IP and TCP port
-COMMAND_SET_INTERFACE_VLAN      = '/ovs/bin/ovs-vsctl --db=tcp:%s:6640 add port %s trunk %i'
-COMMAND_DELETE_INTERFACE_VLAN   = '/ovs/bin/ovs-vsctl --db=tcp:%s:6640 remove port %s trunk %i'
+# reads the flow file from stdin, and applies all of it in one OpenFlow bundle
+COMMAND_BUNDLE_FLOWS    = '/ovs/bin/ovs-ofctl --bundle add-flows br0 -'
 
-COMMAND_ADD_FLOW                = '/ovs/bin/ovs-ofctl add-flow br0 in_port=%s,dl_vlan=%i,actions=output:%s'
-COMMAND_ADD_FLOW_SWAP           = '/ovs/bin/ovs-ofctl add-flow br0 in_port=%s,dl_vlan=%i,action=set_field=%i-\\>vlan_vid,output:%s'
-COMMAND_DELETE_FLOW             = '/ovs/bin/ovs-ofctl del-flows br0 in_port=%s,dl_vlan=%i'
+# lines of the flow file
+FLOW_ADD                = 'add in_port=%s,dl_vlan=%i,actions=output:%s'
+FLOW_ADD_SWAP           = 'add in_port=%s,dl_vlan=%i,actions=mod_vlan_vid:%i,output:%s'
+FLOW_DELETE             = 'delete in_port=%s,dl_vlan=%i'
 
 
-def createConfigureCommands(db_ip, source_nrm_port, dest_nrm_port, source_vlan, dest_vlan):
 
-    cmd_s_intf  = COMMAND_SET_INTERFACE_VLAN % (db_ip, source_nrm_port, source_vlan)
-    cmd_d_intf  = COMMAND_SET_INTERFACE_VLAN % (db_ip, dest_nrm_port, dest_vlan)
+class FlowError(Exception):
+    pass
+
+
+def createTrunkOperations(source_nrm_port, dest_nrm_port, source_vlan, dest_vlan, mutator):
+    # mutator is insert or delete, same as ovs-vsctl add / remove port <port> trunk <vlan>
+    operations = []
+    for port, vlan in ( (source_nrm_port, source_vlan), (dest_nrm_port, dest_vlan) ):
+        operations.append( { 'op'        : 'mutate',
+                             'table'     : 'Port',
+                             'where'     : [ [ 'name', '==', port ] ],
+                             'mutations' : [ [ 'trunks', mutator, ovsdb.fromSet( [ vlan ] ) ] ] } )
+    return operations
+
+
+def createFlows(source_nrm_port, dest_nrm_port, source_vlan, dest_vlan):
+
     s_flow = str(int(source_nrm_port.split('/')[2]) + 128)
     d_flow = str(int(dest_nrm_port.split('/')[2]) + 128)
     if source_vlan == dest_vlan:
-        cmd_s_flow  = COMMAND_ADD_FLOW              % ( s_flow, source_vlan, d_flow )
-        cmd_d_flow  = COMMAND_ADD_FLOW              % ( d_flow, source_vlan, s_flow )
+        s_flow_line = FLOW_ADD              % ( s_flow, source_vlan, d_flow )
+        d_flow_line = FLOW_ADD              % ( d_flow, source_vlan, s_flow )
     else:
-        cmd_s_flow  = COMMAND_ADD_FLOW_SWAP         % ( s_flow, source_vlan, dest_vlan, d_flow )
-        cmd_d_flow  = COMMAND_ADD_FLOW_SWAP         % ( d_flow, dest_vlan, source_vlan, s_flow )
+        s_flow_line = FLOW_ADD_SWAP         % ( s_flow, source_vlan, dest_vlan, d_flow )
+        d_flow_line = FLOW_ADD_SWAP         % ( d_flow, dest_vlan, source_vlan, s_flow )
 
-    commands = [ cmd_s_intf, cmd_d_intf, cmd_s_flow, cmd_d_flow ]
-    return commands
+    flows = [ s_flow_line, d_flow_line ]
+    return flows
 
 
-def createDeleteCommands(db_ip, source_nrm_port, dest_nrm_port, source_vlan, dest_vlan):
+def createDeleteFlows(source_nrm_port, dest_nrm_port, source_vlan, dest_vlan):
 
-    cmd_no_s_intf = COMMAND_DELETE_INTERFACE_VLAN % (db_ip, source_nrm_port, source_vlan )
-    cmd_no_d_intf = COMMAND_DELETE_INTERFACE_VLAN % (db_ip, dest_nrm_port, dest_vlan )
     s_flow = str(int(source_nrm_port.split('/')[2]) + 128)
     d_flow = str(int(dest_nrm_port.split('/')[2]) + 128)
-    cmd_no_s_flow = COMMAND_DELETE_FLOW         % ( s_flow, source_vlan )
-    cmd_no_d_flow = COMMAND_DELETE_FLOW         % ( d_flow, dest_vlan )
+    no_s_flow_line = FLOW_DELETE        % ( s_flow, source_vlan )
+    no_d_flow_line = FLOW_DELETE        % ( d_flow, dest_vlan )
 
-    commands = [ cmd_no_s_flow, cmd_no_d_flow, cmd_no_s_intf, cmd_no_d_intf ]
-    return commands
+    flows = [ no_s_flow_line, no_d_flow_line ]
+    return flows
 
 
-class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+class FlowBundleChannel(ssh.SSHChannel):
+    """
+    Runs ovs-ofctl with the flow file on stdin, and fires done with the exit
+    status when the command has finished.
+    """
+
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
-
-        self.data = ''
-
-        self.wait_defer = None
-        self.wait_data  = None
+        self.output = b''
+        self.exit_status = None
+        self.done = defer.Deferred()
 
 
     @defer.inlineCallbacks
-    def sendCommands(self, commands):
-        LT = '\n' # line termination
-
-        try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
-
-#            time.sleep(1) # FIXME
-            d = self.waitForData('\n')
-            self.write(COMMAND_ECHO + LT)
-            yield d
-
-            log.msg('Ready', debug=True, system=LOG_SYSTEM)
-
-            for cmd in commands:
-                log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
-                d = self.waitForData('\n')
-                self.write(cmd + LT)
-                self.write(COMMAND_ECHO + LT)
-#                time.sleep(1) # FIXME
-                yield d
-
-            # commit commands, check for 'commit complete' as success
-            # not quite sure how to handle failure here
-
-            ## test stuff
-            #d = self.waitForData('[edit]')
-            #self.write('commit check' + LT)
-
-            #d = self.waitForData('commit complete')
-            #self.write(COMMAND_COMMIT + LT)
-            #yield d
-
-        except Exception as e:
-            log.msg('Error sending commands: %s' % str(e))
-            raise e
-
-        d = self.waitForData('\n')
-        self.write(COMMAND_ECHO + LT)
-        yield d
-        log.msg('Commands successfully sent', system=LOG_SYSTEM)
+    def sendFlows(self, flows):
+        yield self.conn.sendRequest(self, b'exec', common.NS(COMMAND_BUNDLE_FLOWS.encode()), wantReply=1)
+        self.write( ''.join( flow + '\n' for flow in flows ).encode() )
         self.sendEOF()
-        self.closeIt()
+
+        exit_status = yield self.done
+        if exit_status != 0:
+            raise FlowError('Flow bundle failed (exit status %s): %s' % (exit_status, self.output.decode(errors='replace').strip()))
 
 
-    def waitForData(self, data):
-        self.wait_data  = data
-        self.wait_defer = defer.Deferred()
-        return self.wait_defer
+    def request_exit_status(self, data):
+        self.exit_status = struct.unpack('>L', data)[0]
 
 
     def dataReceived(self, data):
-        if len(data) == 0:
-            pass
-        else:
-            self.data += data
-            if self.wait_data and self.wait_data in self.data:
-                d = self.wait_defer
-                self.data       = ''
-                self.wait_data  = None
-                self.wait_defer = None
-                d.callback(self)
+        self.output += data
+
+
+    def extReceived(self, data_type, data):
+        self.output += data # stderr, for the error message
+
+
+    def closed(self):
+        self.done.callback(self.exit_status)
+
 
 
 class Pica8OVSCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, db_ip):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, db_ip,
+                 warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
 
         self.ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
+        self.ssh_connection_cache = ssh.SSHConnectionCache(self.ssh_connection_creator, LOG_SYSTEM, refresh_interval)
+        self.warmup = warmup
+        self.flow_batcher = batcher.CommitBatcher(self._sendFlows, FLOW_BATCH_WINDOW, log_system=LOG_SYSTEM,
+                                                  on_timeout=self._closeFlowChannel)
+        self.flow_channel = None
         self.db_ip = db_ip
+        self.ovsdb_client = ovsdb.OVSDBClient(db_ip, monitor_tables={ 'Port' : [ 'name', 'trunks' ] }, log_system=LOG_SYSTEM)
 
         log.msg('SSH connection arguments %s, %s, %s, %s, %s, %s' % (host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path), system=LOG_SYSTEM)
 
 
-    @defer.inlineCallbacks
-    def _sendCommands(self, commands):
+    def warmUp(self):
+        if not self.warmup:
+            return defer.succeed(None)
+        return self.ssh_connection_cache.warmUp()
 
-        log.msg('Creating new SSH connection', system=LOG_SYSTEM)
 
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
+    def shutdown(self):
+        self.ovsdb_client.close()
+        self.ssh_connection_cache.close()
 
-        try:
-            ssh_channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(ssh_channel)
-            yield ssh_channel.channel_open
-            yield ssh_channel.sendCommands(commands)
-            # not a yield, just being nice
-            ssh_channel.loseConnection()
 
+    @defer.inlineCallbacks
+    def _sendFlows(self, fragments):
+        # one bundle for the flows of all links in the batch
+        flows = [ flow for fragment in fragments for flow in fragment ]
+        log.msg('Sending bundle of %i flow changes' % len(flows), debug=True, system=LOG_SYSTEM)
+
+        ssh_connection = yield self.ssh_connection_cache.getSSHConnection()
+        channel = FlowBundleChannel(conn=ssh_connection)
+        self.flow_channel = channel
+        try:
+            ssh_connection.openChannel(channel)
+            yield channel.channel_open
+            yield channel.sendFlows(flows)
         finally:
-            # twisted/os will flush data, before closing
-            ssh_connection.transport.loseConnection()
+            self.flow_channel = None
+
+
+    def _closeFlowChannel(self):
+        # the bundle did not complete in time, give up on the channel
+        if self.flow_channel is not None:
+            self.flow_channel.closeIt()
+            self.flow_channel = None
+
+
+    @defer.inlineCallbacks
+    def _changeTrunks(self, source_target, dest_target, mutator):
+
+        operations = createTrunkOperations(source_target.port, dest_target.port, source_target.vlan, dest_target.vlan, mutator)
+        results = yield self.ovsdb_client.transact(operations)
+        for operation, result in zip(operations, results):
+            if result.get('count') != 1:
+                raise ovsdb.OVSDBError('No port %s in OVSDB' % operation['where'][0][2])
 
+        present = mutator == 'insert'
+        def trunksChanged(tables):
+            for port, vlan in ( (source_target.port, source_target.vlan), (dest_target.port, dest_target.vlan) ):
+                row = self.ovsdb_client.findRow('Port', 'name', port)
+                if row is None or (vlan in ovsdb.toSet(row.get('trunks', ovsdb.fromSet([])))) != present:
+                    return False
+            return True
 
+        yield self.ovsdb_client.waitFor(trunksChanged)
+        log.msg('Trunks %s on %s and %s confirmed' % (mutator, source_target, dest_target), debug=True, system=LOG_SYSTEM)
+
+
+    @defer.inlineCallbacks
     def setupLink(self, source_target, dest_target):
 
-        commands = createConfigureCommands(self.db_ip, source_target.port, dest_target.port, source_target.vlan, dest_target.vlan)
-        return self._sendCommands(commands)
+        yield self._changeTrunks(source_target, dest_target, 'insert')
+        flows = createFlows(source_target.port, dest_target.port, source_target.vlan, dest_target.vlan)
+        yield self.flow_batcher.submit(flows)
 
 
+    @defer.inlineCallbacks
     def teardownLink(self, source_target, dest_target):
 
-        commands = createDeleteCommands(self.db_ip, source_target.port, dest_target.port, source_target.vlan, dest_target.vlan)
-        return self._sendCommands(commands)
+        flows = createDeleteFlows(source_target.port, dest_target.port, source_target.vlan, dest_target.vlan)
+        yield self.flow_batcher.submit(flows)
+        yield self._changeTrunks(source_target, dest_target, 'delete')
 
 
 # --------
@@ -197,10 +232,20 @@ class Pica8OVSTarget(object):
 
 class Pica8OVSConnectionManager:
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip,
+                 warmup=False, refresh_interval=ssh.DEFAULT_REFRESH_INTERVAL):
 
         self.port_map = port_map
-        self.command_sender = Pica8OVSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip)
+        self.command_sender = Pica8OVSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip,
+                                                    warmup, refresh_interval)
+
+
+    def warmUp(self):
+        return self.command_sender.warmUp()
+
+
+    def shutdown(self):
+        self.command_sender.shutdown()
 
 
     def getResource(self, port, label):
@@ -261,6 +306,8 @@ def Pica8OVSBackend(network_name, nrm_ports, parent_requester, cfg):
     ssh_public_key   = cfg[config.PICA8OVS_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.PICA8OVS_SSH_PRIVATE_KEY]
     db_ip            = cfg[config.PICA8OVS_DB_IP]
+    warmup, refresh_interval = ssh.warmUpOptions(cfg)
 
-    cm = Pica8OVSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip)
+    cm = Pica8OVSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip,
+                                   warmup, refresh_interval)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
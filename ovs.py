@@ -1,6 +1,20 @@
 """
 OpenNSA backend for OVS switching.
 
+Links are VLAN cross-connects between two ports of an Open vSwitch bridge,
+with VLAN rewrite when the labels differ. The backend keeps two long-lived
+connections to the switch: OVSDB (JSON-RPC, for the port trunks) and
+OpenFlow 1.4 (for the flows). No ovs-vsctl / ovs-ofctl processes are run.
+
+Link changes submitted within the batch window are applied together: one
+OVSDB transaction for the trunks, confirmed when ovs-vswitchd has applied it
+(cur_cfg catches up with next_cfg, as ovs-vsctl waits), and one atomic
+OpenFlow bundle for the flows of all links. If a batch fails, it is split to
+find the failing links (see common.batcher).
+
+opennsa.backends.common.fakeovs provides a stand-in switch for tests and
+benchmarks.
+
 Author: Colby Sawyer
 Date: 2-22-2022
 """
@@ -10,44 +24,247 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-#TODO this should be resolved
-from opennsa import config
 from opennsa import constants as cnt
-from opennsa.backends.common import genericbackend, ssh
-
-#TODO Update these parameters to OVS specifics
-
-# parameterized commands for layer 2 (NOT IN USE)
-COMMAND_CONFIG                  = 'equipmentgrp set shelf 1 group 7' # Equipment group that is configured
-COMMAND_SAVE_CONFIG             = 'configuration save'
-
-COMMAND_PORT_DESCRIPTION        = 'port set port %(port)s description %(desc)s' #Set description for a physical port
-COMMAND_VSWITCH_CREATE          = 'virtual-switch create vs %(switch)s' #Create virtual switch with a name
-COMMAND_SUBPORT_CREATE          = 'sub-port create sub-port %(name)s parent-port %(port)s classifier-precedence %(id)s' #Create virtual interface on a physical port
-COMMAND_SUBPORT_ADD_VLAN        = 'sub-port add sub-port %(name)s class-element %(uid)s vtag-stack %(vlan)s' #Create vlan interface on named virtual interface
-COMMAND_SUBPORT_CONFIGURE_VLAN  = 'sub-port set sub-port %(name)s ingress-l2-transform push-8100.%(vlan)s.0 egress-l2-transform pop' # Push vlan tag on receiving, pop when sending
-COMMAND_ATTACH_SUBPORT          = 'virtual-switch interface attach sub-port %(name)s vs %(switch)s' #Attach virtual interface to virtual switch
-
-#TODO Remove TL1 usage
-# parameterized commands for TL1 (OTN)
-MAX_TIMESLOT = 80
-COMMAND_LOGIN = 'ACT-USER::%(user)s:%(CTAG)s::%(pass)s'
-
-COMMAND_CRT_PTP_ETH10GFLEX = 'ENT-PTP::PTP-%(port)s:%(CTAG)s:::CONDTYPE=NONE,SERVICETYPE=ETH10GFLEX:IS,AINS' # Configure client port as 10G subrated port
-COMMAND_CONFIGURE_NUMSLOTS = 'ED-ODUCTP::ODUCTP-%(port)s-FP1:%(CTAG)s:::NUMTS=%(numslots)s' # Select number of time slots to be assigned, 1 slot = 1 Gbps ethernet
-COMMAND_PTP_OOS = 'RMV-PTP::PTP-%(port)s:%(CTAG)s' # Put client card facilities out of service
-COMMAND_CRT_ODUCTP_TSASSIGNMENT = 'ENT-ODUCTP::ODUCTP-%(port)s-FP%(FacilityID)s:%(CTAG)s:::GEP=NO,CTPMODE=TRANSPARENT,TSASSIGNMENT=%(TSASSIGN)s,RATE=ODUFLEX:IS' # Create remote-facing ODUCTP facility with given (TSASSIGN) timeslots. Uniqueness of ID in -FP<ID> is from the index of the timeslot used for the connection.
-COMMAND_CRT_TCM = 'ENT-TCM::TCMTTP-%(port)sT1:%(CTAG)s:::DMENABLE=NO,TCMMODE=TERMINATED:,AINS-DEA' # Provision TCM part
-COMMAND_ODUCTP_OOS = 'RMV-ODUCTP::ODUCTP-%(port)s-FP%(FacilityID)s:%(CTAG)s' # Put ODUCTP facility out of service
-COMMAND_ODUCTP_DLT = 'DLT-ODUCTP::ODUCTP-%(port)s-FP%(FacilityID)s:%(CTAG)s' # Delete ODUCTP facility
-COMMAND_ODUTTP_OOS = 'RMV-ODUTTP::ODUTTP-%(port)s:%(CTAG)s' # Put ODUTTP facility out of service (NOT USED)
-COMMAND_ODUTTP_DLT = 'DLT-ODUTTP::ODUTTP-%(port)s:%(CTAG)s' # Delete ODUTTP facility
-COMMAND_TCM_DLT = 'DLT-TCM::TCMTTP-%(port)T1:%(CTAG)s' # Delete TCM facility
-COMMAND_PTP_DLT = 'DLT-PTP::PTP-%(port)s:%(CTAG)s' # Delete client port
-
-
-COMMAND_CRT_CRSCNT_ODUCTP = 'ENT-CRS-ODUCTP::ODUCTP-%(sport)s-FP%(sportFacilityID)s,ODUCTP-%(dport)s-FP%(dportFacilityID)s:%(CTAG)s::%(dir)s:' # Create crossconnect between two ports
-COMMAND_DLT_CRSCNT_ODUCTP = 'DLT-CRS-ODUCTP::ODUCTP-%(sport)s-FP%(sportFacilityID)s,ODUCTP-%(dport)s-FP%(dportFacilityID)s:%(CTAG)s::%(dir)s:' # Delete crossconnect between two ports
+from opennsa.backends.common import genericbackend, ovsdb, openflow, batcher
+
+
+# config options
+OVS_HOST            = 'host'
+OVS_OVSDB_PORT      = 'ovsdb_port'
+OVS_OPENFLOW_PORT   = 'openflow_port'
+OVS_BATCH_WINDOW    = 'batch_window'
+
+DEFAULT_BATCH_WINDOW = 0.1 # seconds
+BATCH_MAX_SIZE       = 100 # links
+
+FLOW_PRIORITY = 1000
 
 # String to show in logs
 LOG_SYSTEM = 'OVS'
+
+
+
+class OVSError(Exception):
+    pass
+
+
+
+def createTrunkOperations(trunks, mutator):
+    # trunks is a list of (port, vlan), mutator is insert or delete, same as ovs-vsctl add / remove port <port> trunk <vlan>
+    operations = []
+    for port, vlan in trunks:
+        operations.append( { 'op'        : 'mutate',
+                             'table'     : 'Port',
+                             'where'     : [ [ 'name', '==', port ] ],
+                             'mutations' : [ [ 'trunks', mutator, ovsdb.fromSet( [ vlan ] ) ] ] } )
+    return operations
+
+
+def createFlowMods(source_ofport, dest_ofport, source_vlan, dest_vlan):
+
+    def actions(vlan, ofport):
+        if source_vlan == dest_vlan:
+            return [ openflow.outputAction(ofport) ]
+        return [ openflow.setVLANAction(vlan), openflow.outputAction(ofport) ]
+
+    return [ openflow.flowMod(openflow.FC_ADD, source_ofport, source_vlan, actions(dest_vlan, dest_ofport), FLOW_PRIORITY),
+             openflow.flowMod(openflow.FC_ADD, dest_ofport, dest_vlan, actions(source_vlan, source_ofport), FLOW_PRIORITY) ]
+
+
+def createDeleteFlowMods(source_ofport, dest_ofport, source_vlan, dest_vlan):
+
+    return [ openflow.flowMod(openflow.FC_DELETE_STRICT, source_ofport, source_vlan, priority=FLOW_PRIORITY),
+             openflow.flowMod(openflow.FC_DELETE_STRICT, dest_ofport, dest_vlan, priority=FLOW_PRIORITY) ]
+
+
+
+class OVSCommandSender:
+
+    def __init__(self, host, ovsdb_port=ovsdb.DEFAULT_PORT, openflow_port=openflow.DEFAULT_PORT, batch_window=DEFAULT_BATCH_WINDOW):
+
+        self.ovsdb_client = ovsdb.OVSDBClient(host, ovsdb_port, log_system=LOG_SYSTEM,
+                                              monitor_tables={ 'Interface'    : [ 'name', 'ofport' ],
+                                                               'Port'         : [ 'name', 'trunks' ],
+                                                               'Open_vSwitch' : [ 'cur_cfg' ] })
+        self.openflow_client = openflow.OpenFlowClient(host, openflow_port, log_system=LOG_SYSTEM)
+        self.batcher = batcher.CommitBatcher(self._commitBatch, batch_window, BATCH_MAX_SIZE, log_system=LOG_SYSTEM)
+
+
+    def warmUp(self):
+        return defer.gatherResults( [ self.ovsdb_client.getProtocol(), self.openflow_client.getProtocol() ], consumeErrors=True )
+
+
+    def shutdown(self):
+        self.ovsdb_client.close()
+        self.openflow_client.close()
+
+
+    def _ofport(self, port):
+        row = self.ovsdb_client.findRow('Interface', 'name', port)
+        # ofport is an empty set until ovs-vswitchd has assigned it, and -1 on failure
+        if row is None or not isinstance(row.get('ofport'), int) or row['ofport'] < 1:
+            raise OVSError('No OpenFlow port for interface %s' % port)
+        return row['ofport']
+
+
+    def _trunks(self, port):
+        row = self.ovsdb_client.findRow('Port', 'name', port)
+        return ovsdb.toSet(row.get('trunks', ovsdb.fromSet([]))) if row is not None else set()
+
+
+    @defer.inlineCallbacks
+    def _reconfigure(self, operations):
+        # change the database, and wait for ovs-vswitchd to apply it
+        operations = operations + [ { 'op' : 'mutate', 'table' : 'Open_vSwitch', 'where' : [], 'mutations' : [ [ 'next_cfg', '+=', 1 ] ] },
+                                    { 'op' : 'select', 'table' : 'Open_vSwitch', 'where' : [], 'columns' : [ 'next_cfg' ] } ]
+        results = yield self.ovsdb_client.transact(operations)
+        for operation, result in zip(operations, results):
+            if operation['table'] == 'Port' and result.get('count') != 1:
+                raise ovsdb.OVSDBError('No port %s in OVSDB' % operation['where'][0][2])
+
+        next_cfg = results[-1]['rows'][0]['next_cfg']
+        def applied(tables):
+            return any( row.get('cur_cfg', 0) >= next_cfg for row in tables.get('Open_vSwitch', {}).values() )
+
+        yield self.ovsdb_client.waitFor(applied)
+
+
+    @defer.inlineCallbacks
+    def _commitBatch(self, changes):
+        # changes are (setup, source_target, dest_target), in the order they were submitted
+
+        yield self.ovsdb_client.getProtocol() # the OpenFlow port numbers and trunks come from the monitor
+
+        # trunk changes are netted out per (port, vlan), the last change wins, so a teardown and a
+        # setup on the same port and vlan leave the trunk in place. flow mods are applied in order.
+        trunks, flow_mods = {}, [] # (port, vlan) -> present after the batch
+        for setup, source_target, dest_target in changes:
+            source_ofport, dest_ofport = self._ofport(source_target.port), self._ofport(dest_target.port)
+            for target in (source_target, dest_target):
+                trunks[ (target.port, target.vlan) ] = setup
+            if setup:
+                flow_mods += createFlowMods(source_ofport, dest_ofport, source_target.vlan, dest_target.vlan)
+            else:
+                flow_mods += createDeleteFlowMods(source_ofport, dest_ofport, source_target.vlan, dest_target.vlan)
+
+        trunk_inserts = sorted( trunk for trunk, present in trunks.items() if present )
+        trunk_deletes = sorted( trunk for trunk, present in trunks.items() if not present )
+        # only the trunks which were not there before the batch are removed if it fails
+        added = [ (port, vlan) for port, vlan in trunk_inserts if vlan not in self._trunks(port) ]
+
+        log.msg('Applying %i link change(s): %i trunk operations, %i flow mods' % (len(changes), len(trunk_inserts) + len(trunk_deletes), len(flow_mods)), debug=True, system=LOG_SYSTEM)
+
+        # trunks are added before the flows using them, and removed after
+        if trunk_inserts:
+            yield self._reconfigure(createTrunkOperations(trunk_inserts, 'insert'))
+
+        try:
+            yield self.openflow_client.bundle(flow_mods)
+        except Exception:
+            if added:
+                yield self.ovsdb_client.transact(createTrunkOperations(added, 'delete'))
+            raise
+
+        if trunk_deletes:
+            yield self._reconfigure(createTrunkOperations(trunk_deletes, 'delete'))
+
+
+    def setupLink(self, source_target, dest_target):
+        return self.batcher.submit( (True, source_target, dest_target) )
+
+
+    def teardownLink(self, source_target, dest_target):
+        return self.batcher.submit( (False, source_target, dest_target) )
+
+
+# --------
+
+
+class OVSTarget(object):
+
+    def __init__(self, port, vlan=None):
+        self.port = port
+        self.vlan = vlan
+
+    def __str__(self):
+        if self.vlan:
+            return '<OVSTarget %s#%i>' % (self.port, self.vlan)
+        else:
+            return '<OVSTarget %s>' % self.port
+
+
+
+class OVSConnectionManager:
+
+    def __init__(self, port_map, host, ovsdb_port=ovsdb.DEFAULT_PORT, openflow_port=openflow.DEFAULT_PORT, batch_window=DEFAULT_BATCH_WINDOW):
+
+        self.port_map = port_map
+        self.command_sender = OVSCommandSender(host, ovsdb_port, openflow_port, batch_window)
+
+
+    def warmUp(self):
+        return self.command_sender.warmUp()
+
+
+    def shutdown(self):
+        self.command_sender.shutdown()
+
+
+    def getResource(self, port, label):
+        assert label is None or label.type_ == cnt.ETHERNET_VLAN, 'Label type must be VLAN'
+        # resource is port + vlan (router / virtual switching)
+        label_value = '' if label is None else label.labelValue()
+        return port + ':' + label_value
+
+
+    def getTarget(self, port, label):
+        assert label is not None and label.type_ == cnt.ETHERNET_VLAN, 'Label type must be VLAN'
+        vlan = int(label.labelValue())
+        assert 1 <= vlan <= 4095, 'Invalid label value for vlan: %s' % label.labelValue()
+
+        return OVSTarget(self.port_map[port], vlan)
+
+
+    def createConnectionId(self, source_target, dest_target):
+        return 'OVS-' + str(random.randint(100000,999999))
+
+
+    def canSwapLabel(self, label_type):
+        return True
+
+
+    def setupLink(self, connection_id, source_target, dest_target, bandwidth):
+
+        def linkUp(_):
+            log.msg('Link %s -> %s up' % (source_target, dest_target), system=LOG_SYSTEM)
+
+        d = self.command_sender.setupLink(source_target, dest_target)
+        d.addCallback(linkUp)
+        return d
+
+
+    def teardownLink(self, connection_id, source_target, dest_target, bandwidth):
+
+        def linkDown(_):
+            log.msg('Link %s -> %s down' % (source_target, dest_target), system=LOG_SYSTEM)
+
+        d = self.command_sender.teardownLink(source_target, dest_target)
+        d.addCallback(linkDown)
+        return d
+
+
+
+def OVSBackend(network_name, nrm_ports, parent_requester, cfg):
+
+    name = 'OVS %s' % network_name
+    nrm_map  = dict( [ (p.name, p) for p in nrm_ports ] ) # for the generic backend
+    port_map = dict( [ (p.name, p.interface) for p in nrm_ports ] ) # for the nrm backend
+
+    # extract config items
+    host            = cfg[OVS_HOST]
+    ovsdb_port      = int(cfg.get(OVS_OVSDB_PORT, ovsdb.DEFAULT_PORT))
+    openflow_port   = int(cfg.get(OVS_OPENFLOW_PORT, openflow.DEFAULT_PORT))
+    batch_window    = float(cfg.get(OVS_BATCH_WINDOW, DEFAULT_BATCH_WINDOW))
+
+    cm = OVSConnectionManager(port_map, host, ovsdb_port, openflow_port, batch_window)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)